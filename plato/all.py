@@ -1,13 +1,16 @@
 """
-Import this file to use anything from plato without having to think about where it's located.
+Import this file to use anything from plato without having to think about where it's located.  Everything from
+plato.tools (and tdbplot, which needs the plotting libraries) is imported lazily, on first use.
 """
 from plato.core import symbolic, symbolic_multi, symbolic_simple, symbolic_stateless, symbolic_updater, SymbolicFunction, \
     tdb_trace
-from plato.tools.all import *
-from plato.tools.misc.tdb_plotting import tdbplot
+from plato.lazy_import import install_lazy_module
+from plato.tools.all import LAZY_ATTRIBUTES as _TOOLS_LAZY_ATTRIBUTES
+
+_all = install_lazy_module(__name__, dict(_TOOLS_LAZY_ATTRIBUTES, tdbplot='plato.tools.misc.tdb_plotting'))
 
 
 if __name__ == '__main__':
-    for k in sorted(locals().keys()):
-        if not k.startswith('__'):
-            print '%s: %s' % (k, locals()[k])
+    for k in sorted(dir(_all)):
+        if not k.startswith('_'):
+            print '%s: %s' % (k, getattr(_all, k))
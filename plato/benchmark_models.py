@@ -0,0 +1,352 @@
+from collections import OrderedDict, namedtuple
+from contextlib import closing
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+from artemis.fileman.local_dir import get_local_path
+from plato.core import symbolic
+from plato.tools.common.config import float_precision
+from plato.tools.common.online_predictors import GradientBasedPredictor
+from plato.tools.convnet.conv_specifiers import ConvInitSpec, NonlinearitySpec, PoolerSpec
+from plato.tools.convnet.convnet import ConvNet
+from plato.tools.dbn.stacked_dbn import StackedDeepBeliefNet, BernoulliBernoulliRBM
+from plato.tools.gan.gan import GenerativeAdversarialNetwork
+from plato.tools.lstm.long_short_term_memory import AutoencodingLSTM
+from plato.tools.mlp.mlp import MultiLayerPerceptron
+from plato.tools.optimization.optimizers import Adam, AdaMax, SimpleGradientDescent
+from plato.tools.va.variational_autoencoder import VariationalAutoencoder, EncoderDecoderNetworks
+from utils.benchmarks.predictor_comparison import imap_in_forked_processes
+import numpy as np
+import theano
+
+__author__ = 'peter'
+
+"""
+Throughput benchmarks for plato's model families.
+
+For each model family, minibatch size and floatX, we build a model, compile its training and prediction functions,
+and measure:
+    compile_time: Time to compile the function (the theano part - with the persistent compilation cache off)
+    first_pass_time: Time for the symbolic pass of the function (building the graph)
+    samples_per_sec: Steady-state throughput, after compilation and a few warm-up calls.  For the LSTM, a sample is a
+        time step of the training sequence.
+    peak_rss_mb: The peak resident memory of the process that ran the case.  Each case runs in its own freshly forked
+        process (unless isolate = False), so this includes the python interpreter and theano, but not other cases.
+
+Results are saved as JSON, and can be compared against a stored baseline, flagging any metric that is worse than the
+baseline by more than a threshold.  Usage:
+
+    results = run_model_benchmarks(families = ['mlp', 'convnet'], minibatch_sizes = [16, 128], floatxs = ['float32'])
+    save_benchmark_results(results, 'results.json')
+    regressions = compare_to_baseline(results, load_benchmark_results('baseline.json'))
+    print format_regressions(regressions)
+
+Or run this file, which benchmarks everything, and compares against (or, the first time, saves) a baseline in the
+local data directory.  It exits with status 1 if there are regressions.
+"""
+
+
+def _get_mlp_benchmark(minibatch_size, rng):
+    predictor = GradientBasedPredictor(
+        function = MultiLayerPerceptron.from_init(layer_sizes = [784, 500, 10], w_init = 0.01, hidden_activation = 'relu', output_activation = 'softmax', rng = rng),
+        cost_function = 'nll',
+        optimizer = Adam(alpha = 1e-3),
+        )
+    x = rng.rand(minibatch_size, 784)
+    y = rng.randint(10, size = minibatch_size)
+    return predictor.train, (x, y), predictor.predict, (x, )
+
+
+def _get_convnet_benchmark(minibatch_size, rng):
+    # The first blocks of a VGG net, on CIFAR-sized inputs
+    net = ConvNet.from_init(
+        input_shape = (3, 32, 32),
+        w_init = 0.01,
+        rng = rng,
+        specifiers = [
+            ConvInitSpec(n_maps = 64, filter_size = (3, 3), mode = 'same'),
+            NonlinearitySpec('relu'),
+            ConvInitSpec(n_maps = 64, filter_size = (3, 3), mode = 'same'),
+            NonlinearitySpec('relu'),
+            PoolerSpec(region = 2, stride = 2, mode = 'max'),  # (16x16)
+            ConvInitSpec(n_maps = 128, filter_size = (3, 3), mode = 'same'),
+            NonlinearitySpec('relu'),
+            PoolerSpec(region = 2, stride = 2, mode = 'max'),  # (8x8)
+            ConvInitSpec(n_maps = 10, filter_size = (8, 8), mode = 'valid'),  # (1x1)
+            NonlinearitySpec('softmax'),
+            ]
+        )
+    predictor = GradientBasedPredictor(function = net, cost_function = 'nll', optimizer = AdaMax())
+    x = rng.randn(minibatch_size, 3, 32, 32)
+    y = rng.randint(10, size = minibatch_size)
+    return predictor.train, (x, y), predictor.predict, (x, )
+
+
+def _get_lstm_benchmark(minibatch_size, rng):
+    model = AutoencodingLSTM(n_input = 8, n_hidden = 100, initializer_fcn = lambda shape: 0.01*rng.randn(*shape))
+
+    @symbolic
+    def predict(inputs):
+        hidden_reps = model.lstm.multi_step(inputs, update_states = False)
+        return model.output_activation(hidden_reps.dot(model.w_hz)+model.b_z)
+
+    sequence = np.eye(8)[rng.randint(8, size = minibatch_size)]  # A (minibatch_size, 8) one-hot sequence
+    return model.get_training_function(optimizer = AdaMax(alpha = 1e-3)), (sequence, ), predict, (sequence, )
+
+
+def _get_rbm_benchmark(minibatch_size, rng):
+    rbm = BernoulliBernoulliRBM.from_initializer(n_visible = 784, n_hidden = 500, w_init_fcn = lambda shape: 0.01*rng.randn(*shape), rng = rng)
+
+    @symbolic
+    def predict(visible):
+        return rbm.propup(visible, stochastic = False)
+
+    x = (rng.rand(minibatch_size, 784) > 0.5).astype(float)
+    return rbm.get_training_fcn(n_gibbs = 1, persistent = False, optimizer = SimpleGradientDescent(eta = 0.01)), (x, ), predict, (x, )
+
+
+def _get_dbn_benchmark(minibatch_size, rng):
+    w_init = lambda shape: 0.01*rng.randn(*shape)
+    dbn = StackedDeepBeliefNet(rbms = [
+        BernoulliBernoulliRBM.from_initializer(n_visible = 784, n_hidden = 500, w_init_fcn = w_init, rng = rng),
+        BernoulliBernoulliRBM.from_initializer(n_visible = 500, n_hidden = 100, w_init_fcn = w_init, rng = rng),
+        ])
+
+    @symbolic
+    def predict(visible):
+        return dbn.propup(visible, stochastic = False)
+
+    x = (rng.rand(minibatch_size, 784) > 0.5).astype(float)
+    return dbn.get_training_fcn(n_gibbs = 1, persistent = False, optimizer = SimpleGradientDescent(eta = 0.01)), (x, ), predict, (x, )
+
+
+def _get_vae_benchmark(minibatch_size, rng):
+    model = VariationalAutoencoder(
+        pq_pair = EncoderDecoderNetworks(x_dim = 784, z_dim = 20, encoder_hidden_sizes = [200], decoder_hidden_sizes = [200],
+            w_init = lambda n_in, n_out: 0.01*rng.randn(n_in, n_out)),
+        optimizer = AdaMax(alpha = 1e-3),
+        rng = rng
+        )
+    x = rng.rand(minibatch_size, 784)
+    return model.train, (x, ), model.sample_z_given_x, (x, )
+
+
+def _get_gan_benchmark(minibatch_size, rng):
+    noise_dim = 10
+    net = GenerativeAdversarialNetwork(
+        discriminator = MultiLayerPerceptron.from_init(w_init = 0.01, layer_sizes = [784, 100, 1], hidden_activation = 'relu', output_activation = 'sig', rng = rng),
+        generator = MultiLayerPerceptron.from_init(w_init = 0.1, layer_sizes = [noise_dim, 200, 784], hidden_activation = 'relu', output_activation = 'sig', rng = rng),
+        noise_dim = noise_dim,
+        optimizer = AdaMax(0.001),
+        rng = rng
+        )
+
+    @symbolic
+    def train(data):  # One step of each
+        net.train_discriminator(data)
+        net.train_generator(data.shape[0])
+
+    @symbolic
+    def predict(noise):
+        return net.generate(noise = noise)
+
+    return train, (rng.rand(minibatch_size, 784), ), predict, (rng.randn(minibatch_size, noise_dim), )
+
+
+MODEL_BENCHMARKS = OrderedDict([  # A dict<family_name: fcn(minibatch_size, rng) -> (train, train_args, predict, predict_args)>
+    ('mlp', _get_mlp_benchmark),
+    ('convnet', _get_convnet_benchmark),
+    ('lstm', _get_lstm_benchmark),
+    ('rbm', _get_rbm_benchmark),
+    ('dbn', _get_dbn_benchmark),
+    ('vae', _get_vae_benchmark),
+    ('gan', _get_gan_benchmark),
+    ])
+
+# For each metric: whether higher values are better, and the default fractional change (for the worse) that counts as a
+# regression.  Compile times are noisier than throughputs, so they get more slack.
+METRIC_DIRECTIONS = OrderedDict([
+    ('train_samples_per_sec', True),
+    ('predict_samples_per_sec', True),
+    ('train_compile_time', False),
+    ('predict_compile_time', False),
+    ('train_first_pass_time', False),
+    ('predict_first_pass_time', False),
+    ('peak_rss_mb', False),
+    ])
+
+DEFAULT_REGRESSION_THRESHOLDS = OrderedDict([
+    ('train_samples_per_sec', 0.1),
+    ('predict_samples_per_sec', 0.1),
+    ('train_compile_time', 0.5),
+    ('predict_compile_time', 0.5),
+    ('train_first_pass_time', 0.5),
+    ('predict_first_pass_time', 0.5),
+    ('peak_rss_mb', 0.2),
+    ])
+
+BenchmarkRegression = namedtuple('BenchmarkRegression', ['case', 'metric', 'baseline', 'current', 'change'])
+
+
+def benchmark_model(family, minibatch_size, floatx, min_time = 1., min_calls = 5, n_warmup_calls = 2, seed = 1234):
+    """
+    Benchmark the training and prediction functions of a model.
+
+    :param family: The name of a model family (see MODEL_BENCHMARKS)
+    :param minibatch_size: The number of samples per call
+    :param floatx: The floatX to build and run the model with ('float32' or 'float64')
+    :param min_time: Time each function for at least this many seconds...
+    :param min_calls: ... and at least this many calls.
+    :param n_warmup_calls: Number of untimed calls to make after compilation.
+    :param seed: Seed for the model's initial parameters and the data.
+    :return: An OrderedDict of results (see module doc).
+    """
+    with float_precision(floatx):
+        train, train_args, predict, predict_args = MODEL_BENCHMARKS[family](minibatch_size, np.random.RandomState(seed))
+        result = OrderedDict([('family', family), ('minibatch_size', minibatch_size), ('floatx', floatx)])
+        for name, fcn, args in [('train', train, train_args), ('predict', predict, predict_args)]:
+            args = tuple(a.astype(floatx) if a.dtype.kind == 'f' else a for a in args)
+            compiled_fcn = fcn.compile(add_test_values = False, persistent_cache = False)
+            first_pass_time, compile_time = compiled_fcn.metrics.first_pass_time, compiled_fcn.metrics.compile_time
+            compiled_fcn.precompile(*args)
+            result[name+'_first_pass_time'] = compiled_fcn.metrics.first_pass_time - first_pass_time
+            result[name+'_compile_time'] = compiled_fcn.metrics.compile_time - compile_time
+            for _ in xrange(n_warmup_calls):
+                compiled_fcn(*args)
+            n_calls = 0
+            start_time = time.time()
+            while n_calls < min_calls or time.time() - start_time < min_time:
+                compiled_fcn(*args)
+                n_calls += 1
+            result[name+'_samples_per_sec'] = n_calls * minibatch_size / (time.time() - start_time)
+        result['peak_rss_mb'] = _get_peak_rss_mb()
+        return result
+
+
+def run_model_benchmarks(families = None, minibatch_sizes = (16, 128), floatxs = ('float32', 'float64'), isolate = True,
+        report = True, **benchmark_kwargs):
+    """
+    Benchmark every combination of model family, minibatch size and floatX.
+
+    :param families: A list of model families (see MODEL_BENCHMARKS), or None for all of them.
+    :param minibatch_sizes: A list of minibatch sizes
+    :param floatxs: A list of floatXs
+    :param isolate: Run each case in a freshly forked process, so that cases don't affect each other's memory use (and
+        peak_rss_mb is for the case alone).
+    :param report: Print each result as it comes in.
+    :param benchmark_kwargs: Passed to benchmark_model
+    :return: A list of results (see benchmark_model)
+    """
+    if families is None:
+        families = MODEL_BENCHMARKS.keys()
+    cases = [(family, minibatch_size, floatx) for family in families for minibatch_size in minibatch_sizes for floatx in floatxs]
+    run_case = lambda (family, minibatch_size, floatx): benchmark_model(family, minibatch_size, floatx, **benchmark_kwargs)
+    case_results = imap_in_forked_processes(run_case, cases, n_workers = 1) if isolate else ((case, run_case(case)) for case in cases)
+    results = []
+    with closing(case_results):
+        for _, result in case_results:
+            if report:
+                print _format_result(result)
+            results.append(result)
+    return results
+
+
+def save_benchmark_results(results, path):
+    """
+    Save results to a JSON file, along with a description of the machine and versions they were measured with.
+    :param results: A list of results, as returned by run_model_benchmarks
+    :param path: The path of the JSON file
+    """
+    directory = os.path.dirname(path)
+    if directory != '' and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(OrderedDict([('environment', _get_environment()), ('results', results)]), f, indent = 2)
+
+
+def load_benchmark_results(path):
+    """
+    :param path: The path of a JSON file saved by save_benchmark_results
+    :return: The list of results
+    """
+    with open(path) as f:
+        return json.load(f, object_pairs_hook = OrderedDict)['results']
+
+
+def compare_to_baseline(results, baseline, thresholds = DEFAULT_REGRESSION_THRESHOLDS):
+    """
+    Compare results to a baseline.  Cases are matched on (family, minibatch_size, floatx).  Cases that are not in the
+    baseline are ignored.
+
+    :param results: A list of results (see run_model_benchmarks)
+    :param baseline: A list of results to compare against
+    :param thresholds: A dict<metric_name: fraction>.  A metric regresses if it's worse than the baseline by more than
+        this fraction of the baseline (so 0.1 means, e.g., 10% less throughput or 10% more compile time).  Metrics not
+        in the dict are not compared.
+    :return: A list of BenchmarkRegressions, where change is the fractional change from the baseline.
+    """
+    case_key = lambda r: (r['family'], r['minibatch_size'], r['floatx'])
+    baseline_results = {case_key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        if case_key(result) not in baseline_results:
+            continue
+        baseline_result = baseline_results[case_key(result)]
+        for metric, threshold in thresholds.iteritems():
+            if metric not in result or metric not in baseline_result or baseline_result[metric] <= 0:
+                continue
+            change = result[metric] / float(baseline_result[metric]) - 1
+            if (change < -threshold) if METRIC_DIRECTIONS[metric] else (change > threshold):
+                regressions.append(BenchmarkRegression(case = '%s/minibatch=%s/%s' % case_key(result), metric = metric,
+                    baseline = baseline_result[metric], current = result[metric], change = change))
+    return regressions
+
+
+def format_regressions(regressions):
+    if len(regressions) == 0:
+        return 'No regressions.'
+    return '%s regressions:\n' % (len(regressions), ) + '\n'.join('  %s: %s went from %.4g to %.4g (%+.1f%%)'
+        % (r.case, r.metric, r.baseline, r.current, 100*r.change) for r in regressions)
+
+
+def _format_result(result):
+    return '%(family)s, minibatch %(minibatch_size)s, %(floatx)s: ' \
+        'train %(train_samples_per_sec).4g samples/s (compiled in %(train_compile_time).3gs, first pass %(train_first_pass_time).3gs), ' \
+        'predict %(predict_samples_per_sec).4g samples/s (compiled in %(predict_compile_time).3gs, first pass %(predict_first_pass_time).3gs), ' \
+        'peak RSS %(peak_rss_mb).4gMB' % result
+
+
+def _get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1024. if sys.platform != 'darwin' else peak_rss / 1024.**2  # Linux gives kB, OSX gives bytes
+
+
+def _get_environment():
+    return OrderedDict([
+        ('machine', platform.node()),
+        ('processor', platform.processor()),
+        ('n_cpus', os.sysconf('SC_NPROCESSORS_ONLN') if hasattr(os, 'sysconf') else None),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('theano', theano.__version__),
+        ('blas', theano.config.blas.ldflags),
+        ('date', time.strftime('%Y-%m-%d %H:%M:%S')),
+        ])
+
+
+if __name__ == '__main__':
+    logging.getLogger('plato').setLevel(logging.WARN)
+    results = run_model_benchmarks()
+    save_benchmark_results(results, get_local_path('plato/benchmarks/model_throughput_latest.json', make_local_dir = True))
+    baseline_path = get_local_path('plato/benchmarks/model_throughput_baseline.json', make_local_dir = True)
+    if os.path.exists(baseline_path):
+        regressions = compare_to_baseline(results, load_benchmark_results(baseline_path))
+        print format_regressions(regressions)
+        sys.exit(1 if len(regressions) > 0 else 0)
+    else:
+        save_benchmark_results(results, baseline_path)
+        print 'Saved baseline to %s' % (baseline_path, )
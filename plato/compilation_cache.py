@@ -0,0 +1,295 @@
+import cPickle as pickle
+import hashlib
+import logging
+import os
+from contextlib import contextmanager
+from artemis.fileman.local_dir import get_local_path
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof.graph import io_toposort, Constant
+from theano.tensor.type import TensorType
+import theano
+import numpy as np
+
+__author__ = 'peter'
+
+"""
+A persistent, on-disk cache of compiled theano functions.
+
+The expensive part of compiling a plato function is theano's graph optimization.  This module lets
+AutoCompilingFunction skip it: after the first pass, the symbolic graph (along with the types of the input tensors) is
+hashed, and if an optimized function with the same hash is found on disk, it is loaded and rebound to the shared
+variables of the current graph instead of being recompiled.
+
+Usage:
+
+    f = my_symbolic_function.compile(persistent_cache = True)  # Use the default cache
+    f = my_symbolic_function.compile(persistent_cache = CompiledFunctionCache(directory = '/tmp/my_cache'))
+
+Or, to turn it on for everything:
+
+    set_default_compilation_cache(CompiledFunctionCache())
+
+Note that the values of shared variables are not stored in the cache (only their types), so it is always safe to
+reuse a cached function with parameters that have different values.
+"""
+
+PLATO_LOGGER = logging.getLogger('plato')
+
+
+class CompiledFunctionCache(object):
+    """
+    A size-bounded directory of pickled, optimized theano functions.  When the total size exceeds max_size, the least
+    recently used entries are evicted.
+
+    n_hits and n_misses count the calls to load that did and did not return a function.
+    """
+
+    def __init__(self, directory = None, max_size = 2**30):
+        """
+        :param directory: Directory in which to store the compiled functions.  Defaults to a folder in the artemis
+            data directory (~/.artemis/plato/compiled_functions).
+        :param max_size: Maximum total size, in bytes, of the cache.
+        """
+        if directory is None:
+            directory = get_local_path('plato/compiled_functions/')
+        self.directory = directory
+        self.max_size = max_size
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key+'.pkl')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def load(self, key, shared_variables):
+        """
+        Load a compiled function from the cache.
+
+        :param key: A key, as produced by get_graph_key
+        :param shared_variables: The list of shared variables in the graph, in the order returned by get_graph_key.
+            The loaded function will read and update these variables.
+        :return: A theano Function, or None if the key is not in the cache (or the entry could not be loaded).
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.n_misses += 1
+            return None
+        try:
+            with open(path, 'rb') as f:
+                with _no_reoptimization():
+                    stored_fcn, shared_indices, output_spec = pickle.load(f)
+            os.utime(path, None)  # Mark as recently used
+        except Exception as err:
+            PLATO_LOGGER.warn('Failed to load cached function %s (%s).  Removing it from the cache.' % (key, err))
+            self.invalidate(key)
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        _set_output_spec(stored_fcn, output_spec)
+        return _swap_shared_variables(stored_fcn, {stored_fcn.maker.inputs[i].variable: shared_variables[ix] for i, ix in shared_indices.iteritems()})
+
+    def save(self, key, fcn, shared_variables):
+        """
+        Save a compiled function to the cache.  The values of its shared variables are replaced with empty
+        placeholders, so that they do not take up space on disk.
+
+        :param key: A key, as produced by get_graph_key
+        :param fcn: A compiled theano Function
+        :param shared_variables: The list of shared variables in the graph, in the order returned by get_graph_key.
+        """
+        shared_ixs = {sv: i for i, sv in enumerate(shared_variables)}
+        placeholders = {inp.variable: _get_placeholder(inp.variable) for inp in fcn.maker.inputs if isinstance(inp.variable, SharedVariable)}
+        try:
+            lightweight_fcn = _swap_shared_variables(fcn, placeholders)
+            shared_indices = {i: shared_ixs[inp.variable] for i, inp in enumerate(fcn.maker.inputs) if isinstance(inp.variable, SharedVariable)}
+            output_spec = (fcn.unpack_single, fcn.return_none, fcn.output_keys)
+            data = pickle.dumps((lightweight_fcn, shared_indices, output_spec), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as err:
+            PLATO_LOGGER.warn('Could not save function to the compilation cache: %s' % (err, ))
+            return
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = self._path(key)+'.tmp%s' % (os.getpid(), )
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, self._path(key))  # Atomic, so that concurrent processes never see a half-written file.
+        self.evict()
+
+    def entries(self):
+        """
+        :return: A list of (key, size_in_bytes, last_access_time) for each entry in the cache, oldest first.
+        """
+        if not os.path.exists(self.directory):
+            return []
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.directory, filename))
+                entries.append((filename[:-len('.pkl')], stat.st_size, stat.st_mtime))
+        return sorted(entries, key = lambda (_, __, t): t)
+
+    def size(self):
+        return sum(s for _, s, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove least-recently-used entries until the cache fits within max_size.
+        """
+        entries = self.entries()
+        total_size = sum(s for _, s, _ in entries)
+        for key, s, _ in entries:
+            if total_size <= self.max_size:
+                break
+            self.invalidate(key)
+            total_size -= s
+
+    def invalidate(self, key):
+        """
+        Remove an entry from the cache.
+        """
+        if key in self:
+            os.remove(self._path(key))
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        for key, _, _ in self.entries():
+            self.invalidate(key)
+
+
+def get_graph_key(inputs, outputs, updates, **compilation_kwargs):
+    """
+    Compute a structural hash of a symbolic graph.  Two graphs built the same way (even in different processes) will
+    have the same key.  The key depends on the types of the inputs, on the types and positions (but not names or
+    values) of shared variables, and on the values of constants.
+
+    :param inputs: A list of input variables
+    :param outputs: A list of output variables (or a dict<str: variable> of named outputs)
+    :param updates: A list of (shared_variable, new_value) pairs
+    :param compilation_kwargs: Any other arguments that affect compilation.
+    :return: (key, shared_variables), where:
+        key is a string (or None if the graph cannot be hashed)
+        shared_variables is a list of the shared variables in the graph, in a deterministic order.
+    """
+    if isinstance(outputs, dict):
+        output_names = sorted(outputs.keys())
+        outputs = [outputs[k] for k in output_names]
+    else:
+        output_names = None
+        outputs = [] if outputs is None else [outputs] if isinstance(outputs, theano.Variable) else list(outputs)
+
+    all_outputs = outputs + [new for _, new in updates]
+    var_ids = {}
+    shared_variables = []
+    description = [
+        ('theano', theano.__version__, theano.config.floatX, theano.config.device, str(theano.config.mode)),
+        ('kwargs', sorted(compilation_kwargs.items())),
+        ('output_names', output_names),
+        ]
+
+    def var_id(var):
+        if var not in var_ids:
+            var_ids[var] = len(var_ids)
+            if var.owner is None:
+                if isinstance(var, SharedVariable):
+                    shared_variables.append(var)
+                    description.append(('shared', var_ids[var], str(var.type)))
+                elif isinstance(var, Constant):
+                    description.append(('constant', var_ids[var], str(var.type), _hash_value(var.data)))
+                elif var in inputs:
+                    description.append(('input', var_ids[var], str(var.type), inputs.index(var)))
+                else:
+                    description.append(('free', var_ids[var], str(var.type)))
+        return var_ids[var]
+
+    for inp in inputs:
+        var_id(inp)
+    try:
+        for node in io_toposort(inputs, all_outputs):
+            input_ids = [var_id(v) for v in node.inputs]
+            description.append(('node', _op_description(node.op), input_ids, [str(v.type) for v in node.outputs]))
+            for v in node.outputs:
+                var_id(v)
+        description.append(('outputs', [var_id(v) for v in outputs]))
+        description.append(('updates', [(var_id(old), var_id(new)) for old, new in updates]))
+    except _UnhashableOpError:
+        return None, shared_variables
+    return hashlib.md5(repr(description)).hexdigest(), shared_variables
+
+
+class _UnhashableOpError(Exception):
+    pass
+
+
+def _op_description(op):
+    op_type = type(op).__module__+'.'+type(op).__name__
+    if hasattr(op, '__props__'):
+        return op_type, str(op), tuple(str(getattr(op, p)) for p in op.__props__)
+    else:
+        try:
+            return op_type, str(op), hashlib.md5(pickle.dumps(op, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+        except Exception:
+            raise _UnhashableOpError()
+
+
+def _hash_value(value):
+    if isinstance(value, np.ndarray):
+        return hashlib.md5(np.ascontiguousarray(value).view(np.uint8)).hexdigest() + str((value.dtype, value.shape))
+    else:
+        return repr(value)
+
+
+def _get_placeholder(shared_var):
+    """
+    Get an (almost) empty shared variable of the same type as shared_var.
+    """
+    if isinstance(shared_var.type, TensorType):
+        empty_value = np.zeros([1 if b else 0 for b in shared_var.type.broadcastable], dtype=shared_var.dtype)
+        return theano.shared(empty_value, broadcastable=shared_var.type.broadcastable, name=shared_var.name)
+    else:
+        return shared_var  # Can't do anything clever here - the value is stored along with the function.
+
+
+def _swap_shared_variables(fcn, swap):
+    swap = {old: new for old, new in swap.iteritems() if old is not new}
+    if len(swap) == 0:
+        return fcn
+    new_fcn = fcn.copy(swap=swap)
+    _set_output_spec(new_fcn, (fcn.unpack_single, fcn.return_none, fcn.output_keys))
+    return new_fcn
+
+
+def _set_output_spec(fcn, (unpack_single, return_none, output_keys)):
+    # Function.copy and unpickling forget how outputs are to be returned, so we restore that here.
+    fcn.unpack_single = unpack_single
+    fcn.return_none = return_none
+    fcn.output_keys = output_keys
+
+
+@contextmanager
+def _no_reoptimization():
+    old_state = theano.config.reoptimize_unpickled_function
+    theano.config.reoptimize_unpickled_function = False
+    try:
+        yield
+    finally:
+        theano.config.reoptimize_unpickled_function = old_state
+
+
+_DEFAULT_CACHE = None
+
+
+def get_default_compilation_cache():
+    return _DEFAULT_CACHE
+
+
+def set_default_compilation_cache(cache):
+    """
+    :param cache: A CompiledFunctionCache that all compiled functions will use by default, or None to disable caching
+        by default.
+    """
+    global _DEFAULT_CACHE
+    _DEFAULT_CACHE = cache
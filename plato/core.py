@@ -1,17 +1,29 @@
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from functools import partial
 import inspect
+import json
 import logging
-from artemis.general.local_capture import CaptureLocals
-from artemis.general.nested_structures import flatten_struct, expand_struct
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+from weakref import WeakKeyDictionary
+from artemis.general.should_be_builtins import bad_value
+from plato.compilation_cache import CompiledFunctionCache, get_default_compilation_cache, get_graph_key
+from plato.graph_index import GraphIndex
+from plato.precision import PRECISION_POLICIES, PrecisionError, demote_float64, find_float64_nodes, \
+    find_float64_origins, format_precision_report, get_default_precision_policy
+from plato.shape_inference import infer_shape, ShapeInferenceError
+from plato.trace_sink import get_trace_sink, get_worker_trace_values
 from scipy.sparse.csr import csr_matrix
-from theano.compile.sharedvalue import SharedVariable
+from theano.compile.sharedvalue import SharedVariable, shared_constructor
 from theano.gof.graph import Variable
 import theano.tensor as tt
 from theano.tensor.type import TensorType
 import theano
 import numpy as np
 from theano.tensor.var import TensorConstant
+from utils.tools.iteration import map_in_chunks
 
 """
 This module contains the plato decorators (@symbolic, etc) and their implementations.
@@ -45,11 +57,25 @@ PLATO_LOGGER = logging.getLogger('plato')
 PLATO_LOGGER.setLevel(logging.INFO)
 
 # Add properties to the "Variable" class (the base class of all symbolic variables), so that you easily inspect
-# the initial values that are attached to them.
+# the initial values that are attached to them.  Shapes, dimensions and dtypes do not require test values: shapes are
+# inferred statically (see plato.shape_inference), and only taken from test values where that fails.
 Variable.ival = property(lambda self: (self.get_value() if isinstance(self, SharedVariable) else self.data if isinstance(self, TensorConstant) else self.tag.test_value))
-Variable.ishape = property(lambda self: self.ival.shape)
-Variable.indim = property(lambda self: self.ival.ndim)
-Variable.idtype = property(lambda self: (self.ival.dtype if isinstance(self.ival, np.ndarray) else type(self.ival)))
+
+
+def _get_ishape(var):
+    if isinstance(var, (SharedVariable, TensorConstant)):
+        return var.ival.shape
+    try:
+        return infer_shape(var)
+    except ShapeInferenceError:
+        if hasattr(var.tag, 'test_value'):
+            return var.tag.test_value.shape
+        raise
+
+
+Variable.ishape = property(_get_ishape)
+Variable.indim = property(lambda self: (self.ndim if hasattr(self, 'ndim') else self.ival.ndim))
+Variable.idtype = property(lambda self: (self.dtype if hasattr(self, 'dtype') else self.ival.dtype if isinstance(self.ival, np.ndarray) else type(self.ival)))
 
 
 def symbolic(fcn):
@@ -174,7 +200,9 @@ class _SymbolicFunctionWrapper(object):
         self.input_format.check((args, kwargs), self.fcn)
 
         with StateCatcher(swallow_updates=False) as sc:
-            if ENABLE_OMNISCENCE:
+            if _is_omniscence_enabled():
+                from artemis.general.local_capture import CaptureLocals  # Imported here, since it's rarely used
+                from artemis.general.nested_structures import flatten_struct
                 with CaptureLocals() as c:
                     if self.attached_instance is None:
                         symbolic_return = self.fcn(*args, **kwargs)
@@ -207,7 +235,7 @@ class _SymbolicFunctionWrapper(object):
     def _call_with_updates_returned(self, *args, **kwargs):
         with StateCatcher(swallow_updates=True) as sc:
             outputs = self(*args, **kwargs)
-        return outputs, sc.get_updates()
+        return OrderedDict(sc.get_updates()) if outputs is None else (outputs, sc.get_updates())  # Scan doesn't accept None outputs
 
     def to_format(self, format_decorator):
 
@@ -414,33 +442,31 @@ def _is_named_collection(arg):
     return True
 
 
-def _get_relevant_trace_variables_and_callbacks(all_outputs_and_updates):
+def _get_relevant_trace_variables_and_callbacks(all_outputs_and_updates, trace_registry, graph_index = None):
     """
     :param all_outputs: A list of symbolic variables returned, and update values.  This is
+    :param trace_registry: The _TraceRegistry of traces added while building these outputs.  Traces added outside of
+        any compilation (in _GLOBAL_TRACES) are also considered.
+    :param graph_index: A GraphIndex of all_outputs_and_updates, if the caller has already built one.  Otherwise it is
+        built here (if there are any traces).
     :return: trace_variables, trace_callbacks
         Where:
             trace_variables is a dict<str: Variable} containing {trace_var_name: trace_var}
-            trace_callbacks is a list<function> where function should do something with the named trace variable (see tdbprint for example)
+            trace_callbacks is a dict<str: function> containing {trace_var_name: function}, where function should do something with the named trace variable (see tdbprint for example)
     """
-    if len(_TRACE_VARIABLES) == 0:
+    candidate_variables = OrderedDict(_GLOBAL_TRACES.variables.items() + trace_registry.variables.items())
+    candidate_callbacks = dict(_GLOBAL_TRACES.callbacks.items() + trace_registry.callbacks.items())
+    if len(candidate_variables) == 0:
         return {}, {}
 
-    all_leaves = set().union(*[find_leaf_ancestors(v) for v in all_outputs_and_updates])
-
     # Now we need to make sure the trace variables actually belong to this function.
-    # The set of leaf ancestors to the trace variables should be a subset of the leaf-ancestors to the outputs/updates.
-    # trace_variables = {name: var for name, var in _TRACE_VARIABLES.iteritems() if find_leaf_ancestors(var).issubset(all_leaves)}
-    def computable_by_given_inputs(var, given_inputs):
-        """
-        Return True if the symbolic variable var depends only on the provided inputs, shared variables and constants
-        """
-        all_leaf_ancestors = find_leaf_ancestors(var)
-        ancestors_are_computable = [(a in given_inputs) or isinstance(a, SharedVariable) or isinstance(a, tt.Constant) for a in all_leaf_ancestors]
-        return all(ancestors_are_computable)
-
-    trace_variables = {name: var for name, var in _TRACE_VARIABLES.iteritems() if computable_by_given_inputs(var, given_inputs = all_leaves)}
-    # TODO: Fix.  We still have problems with accepting teave variables that don't belong.
-    trace_callbacks = [_TRACE_CALLBACKS[name] for name in trace_variables if name in _TRACE_CALLBACKS]
+    # The set of leaf ancestors to the trace variables should be a subset of the leaf-ancestors to the outputs/updates
+    # (plus shared variables and constants).  The graph is indexed once, so this is linear in the size of the graph no
+    # matter how many trace variables there are.
+    if graph_index is None:
+        graph_index = GraphIndex(all_outputs_and_updates)
+    trace_variables = {name: var for name, var in candidate_variables.iteritems() if graph_index.is_computable(var)}
+    trace_callbacks = OrderedDict((name, candidate_callbacks[name]) for name in trace_variables if name in candidate_callbacks)
     return trace_variables, trace_callbacks
 
 
@@ -468,7 +494,9 @@ class AutoCompilingFunction(object):
     f will be an AutoCompilingFunction
     """
 
-    def __init__(self, fcn, cast_to_floatx = 'float', fixed_args = None, add_test_values = False, debug_print_shapes=False):
+    def __init__(self, fcn, cast_to_floatx = 'float', fixed_args = None, add_test_values = False, debug_print_shapes=False,
+            persistent_cache = None, max_variants = 8, fast_path = True, capture_locals_every = 1, mode = 'fast_run',
+            expected_calls = None, recompile_after = 100, precision_policy = None):
         """
         :param fcn: A symbolic function (decorated with one of the above decorators)
         :param cast_to_floatx: Case inputs  to the global float type (define this in ~/.theanorc).
@@ -478,10 +506,45 @@ class AutoCompilingFunction(object):
         :param fixed_args: A dict<arg_name: arg_value> of fixed arguments to the function.
         :param add_test_values: Add test values to your tensor, based on the initial value of the data provided.  Advantage
             of this is it helps you catch and locate shape errors before compiling.  Disadvantage is on large computations
-            you have to do an initial pass on CPU, which can be slow.
+            you have to do an initial pass on CPU, which can be slow.  Note that if you only need the shapes of variables
+            (var.ishape, var.indim, var.idtype), you don't need test values: shapes are inferred statically.
+        :param persistent_cache: Store the optimized function on disk, and reload it (skipping theano's graph
+            optimization) when the same graph is compiled again, possibly in another process.  Can be:
+            None: Use the default cache, if one is set (see plato.compilation_cache.set_default_compilation_cache)
+            True: Use a CompiledFunctionCache in the default location
+            False: Don't use a persistent cache
+            A CompiledFunctionCache object
+        :param max_variants: The function is compiled separately for each distinct signature (number of dimensions and
+            dtypes of the inputs) that it's called with.  This is the maximum number of compiled variants to keep.  When
+            it's exceeded, the least recently used variant is discarded.  Each variant is a new first pass of the
+            function, but any shared variables that the function creates (e.g. the running average in running_average
+            or the persistent chain of an RBM) are reused from the earlier first passes (see _TracedState), so a new
+            signature, or a recompilation after eviction, doesn't fork or reset that state.
+        :param fast_path: Allow calls to skip straight to the compiled theano function (which never checks its inputs -
+            the full call path converts them itself) when all arguments are numpy arrays whose dtypes exactly match the
+            input tensors, and there are no traces, callbacks, or debug options to deal with.  This greatly reduces the
+            per-call overhead for small functions.  get_dispatch_stats()['n_fast_calls'] counts the calls that took it.
+        :param capture_locals_every: Only relevant when omniscence is enabled (see EnableOmniscence).  Returning all the
+            local variables of the function means copying out every intermediate value, which can be expensive.  So
+            each variant is compiled in a lean form, and an instrumented form that also returns the locals, and the
+            instrumented form is only run on every Nth call (or when you request it with capture_locals_next_call).
+            On other calls, locals() returns the values from the last instrumented call.
+        :param mode: How much effort theano should put into optimizing the graph:
+            'fast_run': Fully optimize the graph (theano's default mode, as configured in ~/.theanorc)
+            'fast_compile': Only do cheap graph optimizations.  Ops still run their C implementations.
+            'interpreted': No C code at all - ops run their python implementations.  Starts fastest, runs slowest.
+            'auto': Fully optimize small graphs, and graphs that are expected to be called many times.  Otherwise,
+                start with 'fast_compile', and recompile with 'fast_run' (in the background) once a variant has been
+                called recompile_after times.
+        :param expected_calls: Optionally, a hint for mode='auto' about how many times the function will be called.
+        :param recompile_after: See mode='auto'.
+        :param precision_policy: What to do about ops that run in float64 when floatX is float32 (see plato.precision):
+            'ignore', 'warn', 'raise', or 'fix'.  None means use the default policy (see set_default_precision_policy).
         """
+        assert mode in COMPILE_MODES, 'mode must be one of %s.  You gave "%s"' % (COMPILE_MODES, mode)
+        assert precision_policy is None or precision_policy in PRECISION_POLICIES, \
+            'precision_policy must be one of %s.  You gave "%s"' % (PRECISION_POLICIES, precision_policy)
         assert isinstance(fcn, _SymbolicFunctionWrapper), 'You must pass a symbolic function.  Decorate it!'
-        theano.config.compute_test_value = 'warn' if add_test_values else 'off'
         if fixed_args is not None:
             fixed_tensors = {k: (tt.constant(v) if isinstance(v, np.ndarray) else v) for k, v in fixed_args.iteritems()}
             for k, v in fixed_args.iteritems():
@@ -495,88 +558,114 @@ class AutoCompilingFunction(object):
         else:
             self._fcn = fcn
         self._original_fcn = fcn  # Needed for retrieveing locals hack
-        self._compiled_fcn = None
+        self._variants = {}  # A dict<call_signature: _CompiledVariant>
+        self._traced_state = _TracedState()  # Shared variables created in first passes, which later first passes reuse
+        self._max_variants = max_variants
+        self._arg_layout = None
+        self._n_calls = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_fast_calls = 0
+        self.compile_time = 0.
         self._cast_to_floatx = cast_to_floatx
         self._local_values = None
         self._callbacks = []
         self._add_test_values = add_test_values
         self._debug_print_shapes = debug_print_shapes
+        self._persistent_cache = persistent_cache
+        self._fast_path = fast_path
+        self._fast_variants = {}  # A dict<fast_signature: _CompiledVariant> of variants that can be called directly
+        self.metrics = get_metrics_registry().get(fcn)
+        self._compilation_lock = threading.RLock()  # Makes sure each variant is only compiled once
+        self._capture_locals_every = capture_locals_every
+        self._capture_locals_next_call = False
+        self._mode = mode
+        self._expected_calls = expected_calls
+        self._recompile_after = recompile_after
+        self._recompilations = []  # AsyncResults of variants being recompiled in the background
+        self._precision_policy = precision_policy
 
         # Create convenient debugging functions: showloc() and locinfo()
         __builtins__['showloc'] = show_all_locals
         __builtins__['locinfo'] = get_local_info
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_compilation_lock']  # Locks can't be pickled
+        state['_recompilations'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compilation_lock = threading.RLock()
+
     def __call__(self, *args, **kwargs):
         """
         :param args, kwargs are the arguments that would go into fcn, but as real numpy arrays instead of symbols
         returns the result, in numpy arrays.
         """
-
-        if self._compiled_fcn is None:  # Need to do first pass and compile.
-
-            d2t = partial(_data_to_tensor, cast_to_floatx = self._cast_to_floatx, add_test_value = self._add_test_values)
-            tensor_args = [d2t(arg) for arg in args]
-            tensor_kwargs = OrderedDict((k, d2t(a)) for k, a in kwargs.iteritems())
-            self._kwarg_order = tensor_kwargs.keys()
-            args_and_kwarg_tensors = flatten_tensor_struct(tensor_args + tensor_kwargs.values())
-
-            PLATO_LOGGER.info('Running first pass of function {f} with test values {test_state}...'.format(f=self._original_fcn.fcn_str(), test_state = 'on' if self._add_test_values else 'off'))
-            with StateCatcher(swallow_updates=True) as sc:
-                outputs = self._fcn(*tensor_args, **tensor_kwargs)
-            PLATO_LOGGER.info('Done.')
-            updates = sc.get_updates()
-            self._original_output_format = _detect_format(outputs)
-            if self._original_output_format is NamedCollectionFormat:
-                self._signal_names = outputs.keys()
-
-            if self._debug_print_shapes:
-                self._original_updates = updates
-                self._old_update_shapes = [old.get_value().shape for old, new in updates]
-
-            all_outputs_and_updates = convert_formats(outputs, AnyReturnFormat, MultiOutputFormat) + tuple(new for old, new in updates)
-            trace_variables, trace_callbacks = _get_relevant_trace_variables_and_callbacks(all_outputs_and_updates)
-            self._there_are_debug_variables = (len(trace_variables)>0 and ENABLE_TRACES) or (ENABLE_OMNISCENCE and (self._original_fcn.locals() is not None))
-            self._callbacks += trace_callbacks
-
-            if self._there_are_debug_variables:
-                # Append trace variables onto output (to be stripped off later)
-                outputs = convert_formats(outputs, src_format=self._original_output_format, dest_format=MultiOutputFormat)
-                self._trace_variable_keys = trace_variables.keys()
-                self._local_variable_keys = self._original_fcn.locals().keys()
-                self._n_outputs = len(outputs)
-                self._n_trace_vars = len(trace_variables)
-                outputs = outputs+tuple(trace_variables.values())+tuple(self._original_fcn.locals().values())
-
-            PLATO_LOGGER.info('Compiling %s with %s inputs, %s outputs, %s updates' % (self._original_fcn.fcn_str(), len(args_and_kwarg_tensors), 1 if isinstance(outputs, Variable) else 0 if outputs is None else len(outputs), len(updates)))
-            self._compiled_fcn = theano.function(inputs = args_and_kwarg_tensors, outputs = outputs, updates = updates, allow_input_downcast=self._cast_to_floatx)
-            PLATO_LOGGER.info('Done.')
-
-        arg_and_kwarg_values = flatten_tensor_struct(args + tuple(kwargs[k] for k in self._kwarg_order))  # List of numpy arrays
+        if self._fast_variants and not kwargs:
+            variant = self._fast_variants.get(tuple([(a.dtype, a.ndim) if type(a) is np.ndarray else None for a in args]))
+            if variant is not None:
+                start_time = time.time()
+                self.n_hits += 1
+                self.n_fast_calls += 1
+                self._n_calls += 1
+                variant.last_used = self._n_calls
+                out = variant.compiled_fcn(*args)
+                pending = self.metrics.pending_latencies
+                pending.append(time.time()-start_time)
+                if len(pending) >= FunctionMetrics.sample_period:
+                    self.metrics.flush(sampled_bytes = (sum([a.nbytes for a in args]), _get_nbytes(out)))
+                return out if variant.signal_names is None else OrderedDict((k, out[k]) for k in variant.signal_names)
+
+        signature = _get_call_signature(args, kwargs, cast_to_floatx=self._cast_to_floatx)
+        variant = self._variants.get(signature)
+        if variant is None:  # Need to do first pass and compile.
+            variant = self._get_or_compile_variant(signature, args, kwargs)
+        else:
+            self.n_hits += 1
+        start_time = time.time()
+        self._n_calls += 1
+        variant.last_used = self._n_calls
+        variant.n_calls += 1
+        if variant.recompile_after is not None and variant.n_calls >= variant.recompile_after:
+            variant.recompile_after = None
+            self._recompilations.append(_get_compilation_pool().apply_async(self._recompile_variant, (variant, 'fast_run')))
+
+        arg_and_kwarg_values = flatten_tensor_struct(args + tuple(kwargs[k] for k in variant.kwarg_order))  # List of numpy arrays
         arg_and_kwarg_values = [a.get_value() if isinstance(a, SharedVariable) else a for a in arg_and_kwarg_values]  # Allows passing in Shared Variables
 
         # Now, run the actual numeric function!
-        if self._there_are_debug_variables:
+        capture_locals = variant.instrumented_fcn is not None and \
+            (self._capture_locals_next_call or (self._n_calls-1) % self._capture_locals_every == 0)
+        compiled_fcn = variant.instrumented_fcn if capture_locals else variant.compiled_fcn
+        arg_and_kwarg_values = _filter_inputs(compiled_fcn, arg_and_kwarg_values)
+        trace_values = {}
+        if variant.there_are_debug_variables:
             # Separate out the debug variables from the output.
-            all_out = self._compiled_fcn(*arg_and_kwarg_values)
-            true_out = all_out[:self._n_outputs]
-            trace_out = all_out[self._n_outputs:self._n_outputs+self._n_trace_vars]
-            local_out = all_out[self._n_outputs+self._n_trace_vars:]
-            trace_values = {k: v for k, v in zip(self._trace_variable_keys, trace_out)}
+            all_out = compiled_fcn(*arg_and_kwarg_values)
+            true_out = all_out[:variant.n_outputs]
+            trace_out = all_out[variant.n_outputs:variant.n_outputs+variant.n_trace_vars]
+            trace_values = {k: v for k, v in zip(variant.trace_variable_keys, trace_out)}
             _TRACE_VALUES.update(trace_values)
-            self._local_values = {k: v for k, v in zip(self._local_variable_keys, local_out)}
-            if self._original_output_format is NamedCollectionFormat:
-                true_out = OrderedDict((k, v) for k, v in zip(self._signal_names, true_out))
+            if capture_locals:
+                local_out = all_out[variant.n_outputs+variant.n_trace_vars:]
+                self._local_values = {k: v for k, v in zip(variant.local_variable_keys, local_out)}
+                self._capture_locals_next_call = False
+            if variant.original_output_format is NamedCollectionFormat:
+                true_out = OrderedDict((k, v) for k, v in zip(variant.signal_names, true_out))
             else:
-                true_out = convert_formats(true_out, MultiOutputFormat, self._original_output_format)
+                true_out = convert_formats(true_out, MultiOutputFormat, variant.original_output_format)
         else:
-            true_out = all_out = self._compiled_fcn(*arg_and_kwarg_values)
-            if self._original_output_format is NamedCollectionFormat:
-                true_out = OrderedDict((k, true_out[k]) for k in self._signal_names)
+            true_out = all_out = compiled_fcn(*arg_and_kwarg_values)
+            if variant.original_output_format is NamedCollectionFormat:
+                true_out = OrderedDict((k, true_out[k]) for k in variant.signal_names)
 
         if self._debug_print_shapes:
             if self._debug_print_shapes=='first':
                 self._debug_print_shapes = False
-            new_update_shapes = [old.get_value().shape for old, new in self._original_updates]
+            new_update_shapes = [old.get_value().shape for old, new in variant.original_updates]
             PLATO_LOGGER.info("Shape info for running function {f}: \n  Inputs Shapes ({n_in}): {inp}\n  Output Shapes ({n_out}): {out}\n  Update Shapes ({n_up}): {updates}".format(
                 f = self._original_fcn.fcn_str(),
                 n_in = len(arg_and_kwarg_values),
@@ -584,23 +673,292 @@ class AutoCompilingFunction(object):
                 n_out = len(true_out),
                 out = str(true_out.shape).replace(' ', '') if isinstance(true_out, np.ndarray) else str(', '.join([str(a.shape).replace(' ', '') for a in all_out])),
                 n_up = len(new_update_shapes),
-                updates = str(', '.join([('%s->%s' % (os, ns)).replace(' ', '') for os, ns in zip(self._old_update_shapes, new_update_shapes)]))
+                updates = str(', '.join([('%s->%s' % (os, ns)).replace(' ', '') for os, ns in zip(variant.old_update_shapes, new_update_shapes)]))
             ))
 
+        trace_sink = get_trace_sink()
+        if trace_sink is not None and len(variant.trace_callbacks) > 0:
+            trace_sink.submit(trace_values, variant.trace_callbacks)
+        else:
+            for c in variant.trace_callbacks.values():
+                c()
         for c in self._callbacks:
             c()
 
+        if self._fast_path and not kwargs and not self._debug_print_shapes and not self._callbacks and not variant.trace_callbacks \
+                and not variant.there_are_debug_variables and variant.recompile_after is None \
+                and all(type(a) is np.ndarray and a.dtype == sig[1] for a, sig in zip(args, signature)):
+            # Next time we get arrays of this type, we can skip all the bookkeeping above.
+            self._fast_variants[tuple((a.dtype, a.ndim) for a in args)] = variant
+
+        self.metrics.record_call(time.time()-start_time, _get_nbytes(arg_and_kwarg_values), _get_nbytes(all_out))
         return true_out
 
+    def _get_or_compile_variant(self, signature, args, kwargs):
+        """
+        Get the compiled variant for this signature, compiling it if it does not exist yet.  Different functions can be
+        compiled in different threads at the same time (though theano's part of the compilation is done one at a time -
+        see _COMPILATION_LOCK).
+        """
+        with self._compilation_lock:
+            variant = self._variants.get(signature)
+            if variant is not None:  # Was compiled in another thread while we were waiting.
+                self.n_hits += 1
+                return variant
+            arg_layout = (len(args), sorted(kwargs.keys()))
+            if self._arg_layout is None:
+                self._arg_layout = arg_layout
+            elif arg_layout != self._arg_layout:
+                missing_kwargs = [k for k in self._arg_layout[1] if k not in kwargs]
+                message = 'Function %s was first called with %s positional arguments and keyword arguments %s.  It must be called the same way every time, but now it was called with %s positional arguments and keyword arguments %s.' \
+                    % (self._original_fcn.fcn_str(), self._arg_layout[0], self._arg_layout[1], arg_layout[0], arg_layout[1])
+                raise KeyError(message) if len(missing_kwargs) > 0 else TypeError(message)
+            self.n_misses += 1
+            start_time = time.time()
+            variant = self._compile_variant(args, kwargs)
+            self.compile_time += time.time() - start_time
+            if len(self._variants) >= self._max_variants:  # Evict the least recently used variant
+                del self._variants[min(self._variants, key = lambda sig: self._variants[sig].last_used)]
+                self._fast_variants.clear()
+            self._variants[signature] = variant
+            return variant
+
+    def precompile(self, *args, **kwargs):
+        """
+        Do the first pass and compile the function for the given example arguments, without running it.  Later calls
+        with arguments of the same signature (ndim, dtype) will go straight to numeric execution.
+        :return: self
+        """
+        signature = _get_call_signature(args, kwargs, cast_to_floatx=self._cast_to_floatx)
+        if signature not in self._variants:
+            self._get_or_compile_variant(signature, args, kwargs)
+        return self
+
+    def compile_async(self, *args, **kwargs):
+        """
+        Like precompile, but compile on a background thread.  The first passes of several functions can run in parallel
+        (theano's own graph optimization is still done one function at a time), and the calling thread can get on
+        with other work in the meantime.  If the function is called with the same signature before compilation is
+        finished, the call will wait for it.
+
+        The background thread compiles in the calling thread's graph-building state (e.g. within EnableOmniscence or
+        AccumulateUpdates, or the test value mode of an enclosing first pass), as precompile would.
+
+        :return: An AsyncResult (see multiprocessing.pool.AsyncResult), whose get() method returns this function once
+            compiled, or raises the exception raised during compilation.
+        """
+        return _get_compilation_pool().apply_async(_call_in_thread_state, (_get_thread_state(), self.precompile, args, kwargs))
+
+    def map(self, data, chunk_size = 1024, out = None, pipeline = False):
+        """
+        Run the function over large arrays, chunk by chunk, writing the results into an output array.  This avoids the
+        memory cost of calling the function on everything at once.  Every output of the function must have its first
+        axis aligned with the inputs.
+
+        :param data: An array, or a tuple of arrays with the same length (one for each argument of the function).
+        :param chunk_size: Number of samples to pass to the function in each call.
+        :param out: Optionally, a preallocated output (e.g. a np.memmap), in the same structure as the function's
+            output.  If None, it is allocated after the first chunk.
+        :param pipeline: Slice the next chunk and copy out the previous result on a background thread while the
+            function computes the current chunk.
+        :return: The output, as if you had called the function on all the data at once.
+        """
+        return map_in_chunks(self, data, chunk_size = chunk_size, out = out, pipeline = pipeline)
+
+    def _compile_variant(self, args, kwargs):
+        """
+        Do the first (symbolic) pass of the function with tensors matching the given arguments, and compile it.
+        :return: A _CompiledVariant
+        """
+        variant = _CompiledVariant()
+        d2t = partial(_data_to_tensor, cast_to_floatx = self._cast_to_floatx, add_test_value = self._add_test_values)
+        tensor_args = [d2t(arg) for arg in args]
+        tensor_kwargs = OrderedDict((k, d2t(kwargs[k])) for k in sorted(kwargs.keys()))
+        variant.kwarg_order = tensor_kwargs.keys()
+        args_and_kwarg_tensors = flatten_tensor_struct(tensor_args + tensor_kwargs.values())
+
+        PLATO_LOGGER.info('Running first pass of function {f} with test values {test_state}...'.format(f=self._original_fcn.fcn_str(), test_state = 'on' if self._add_test_values else 'off'))
+        start_time = time.time()
+        with _COMPUTE_TEST_VALUE_MODE('warn' if self._add_test_values else 'off'), _TraceRegistry() as trace_registry, \
+                StateCatcher(swallow_updates=True) as sc, self._traced_state.first_pass():
+            outputs = self._fcn(*tensor_args, **tensor_kwargs)
+        first_pass_time = time.time() - start_time
+        PLATO_LOGGER.info('Done.')
+        updates = sc.get_updates()
+        if sc.n_merged_updates > 0:
+            PLATO_LOGGER.info('Merged {n} accumulated updates into earlier updates of the same variables in {f}'.format(
+                n=sc.n_merged_updates, f=self._original_fcn.fcn_str()))
+        variant.original_output_format = _detect_format(outputs)
+        if variant.original_output_format is NamedCollectionFormat:
+            variant.signal_names = outputs.keys()
+
+        if self._debug_print_shapes:
+            variant.original_updates = updates
+            variant.old_update_shapes = [old.get_value().shape for old, new in updates]
+
+        all_outputs_and_updates = convert_formats(outputs, AnyReturnFormat, MultiOutputFormat) + tuple(new for old, new in updates)
+        graph_index = GraphIndex(all_outputs_and_updates) if self._mode == 'auto' else None  # Indexed once, for traces and the node count
+        trace_variables, trace_callbacks = _get_relevant_trace_variables_and_callbacks(all_outputs_and_updates, trace_registry, graph_index = graph_index)
+        capture_locals = _is_omniscence_enabled() and (self._original_fcn.locals() is not None)
+        variant.there_are_debug_variables = (len(trace_variables)>0 and ENABLE_TRACES) or capture_locals
+        variant.trace_callbacks = trace_callbacks
+
+        if variant.there_are_debug_variables:
+            # Append trace variables onto output (to be stripped off later)
+            outputs = convert_formats(outputs, src_format=variant.original_output_format, dest_format=MultiOutputFormat)
+            variant.trace_variable_keys = trace_variables.keys()
+            variant.n_outputs = len(outputs)
+            variant.n_trace_vars = len(trace_variables)
+            outputs = outputs+tuple(trace_variables.values())
+
+        if capture_locals:
+            # The instrumented form also returns the locals.
+            variant.local_variable_keys = self._original_fcn.locals().keys()
+            instrumented_outputs = outputs+tuple(self._original_fcn.locals().values())
+        else:
+            instrumented_outputs = None
+
+        precision_policy = self._precision_policy if self._precision_policy is not None else get_default_precision_policy()
+        if precision_policy == 'fix':
+            outputs, instrumented_outputs, updates = _demote_float64_graph(outputs, instrumented_outputs, updates)
+
+        if self._mode == 'auto':
+            n_graph_nodes = sum(v.owner is not None for v in graph_index.variables())
+            full_optimization = n_graph_nodes <= AUTO_MODE_SMALL_GRAPH_SIZE or \
+                (self._expected_calls is not None and self._expected_calls >= self._recompile_after)
+            variant.mode = 'fast_run' if full_optimization else 'fast_compile'
+            if not full_optimization:  # Hang on to the graph so that we can recompile it later.
+                variant.graph = (args_and_kwarg_tensors, outputs, instrumented_outputs, updates)
+                variant.recompile_after = self._recompile_after
+        else:
+            variant.mode = self._mode
+
+        start_time = time.time()
+        self._compile_forms(variant, variant.mode, args_and_kwarg_tensors, outputs, instrumented_outputs, updates)
+        variant.updated_variables = [old for old, _ in updates]
+        variant.updated_variables += [inp.variable for inp in variant.compiled_fcn.maker.expanded_inputs  # e.g. random streams
+            if inp.update is not None and inp.variable not in variant.updated_variables]
+        self.metrics.record_compilation(first_pass_time = first_pass_time, compile_time = time.time() - start_time,
+            n_nodes = len(variant.compiled_fcn.maker.fgraph.apply_nodes))
+        if precision_policy != 'ignore':
+            self._check_precision(variant, precision_policy, outputs, instrumented_outputs, updates)
+        return variant
+
+    def _check_precision(self, variant, precision_policy, outputs, instrumented_outputs, updates):
+        """
+        Look for ops that run in float64 in the compiled forms of a variant, and warn or raise accordingly.
+        """
+        float64_nodes = find_float64_nodes(variant.compiled_fcn)
+        if variant.instrumented_fcn is not None and variant.instrumented_fcn is not variant.compiled_fcn:
+            float64_nodes += find_float64_nodes(variant.instrumented_fcn)
+        if len(float64_nodes) == 0:
+            return
+        graph_outputs = _flatten_outputs(instrumented_outputs if instrumented_outputs is not None else outputs) + [new for _, new in updates]
+        message = format_precision_report(self._original_fcn.fcn_str(), float64_nodes, find_float64_origins(graph_outputs))
+        if precision_policy == 'raise':
+            raise PrecisionError(message)
+        else:
+            PLATO_LOGGER.warn(message)
+
+    def _compile_forms(self, variant, mode, inputs, outputs, instrumented_outputs, updates):
+        """
+        Compile the lean (and if there are instrumented_outputs, the instrumented) theano functions of a variant.  If
+        we capture locals on every call, the instrumented form is the only one we need.
+        """
+        instrumented_fcn = None if instrumented_outputs is None else \
+            self._compile_theano_function(inputs = inputs, outputs = instrumented_outputs, updates = updates, mode = mode)
+        variant.compiled_fcn = instrumented_fcn if instrumented_fcn is not None and self._capture_locals_every == 1 else \
+            self._compile_theano_function(inputs = inputs, outputs = outputs, updates = updates, mode = mode)
+        variant.instrumented_fcn = instrumented_fcn
+        for fcn in (variant.compiled_fcn, variant.instrumented_fcn):
+            if fcn is not None:
+                fcn.trust_input = True  # Never toggled.  The full call path filters inputs itself.
+
+    def _recompile_variant(self, variant, mode):
+        """
+        Recompile a variant from its graph with a different mode.  The variant keeps running in its old form until this
+        is done.
+        """
+        start_time = time.time()
+        self._compile_forms(variant, mode, *variant.graph)
+        variant.mode = mode
+        variant.graph = None
+        self.compile_time += time.time() - start_time
+        self.metrics.record_compilation(first_pass_time = 0., compile_time = time.time() - start_time,
+            n_nodes = len(variant.compiled_fcn.maker.fgraph.apply_nodes))
+
+    def wait_until_recompiled(self):
+        """
+        Wait for any variants being recompiled in the background (see mode='auto') to finish.
+        """
+        while len(self._recompilations) > 0:
+            self._recompilations.pop(0).get()
+
+    def _compile_theano_function(self, inputs, outputs, updates, mode = 'fast_run'):
+        """
+        Compile the theano function, or load it from the persistent cache if it's already been compiled.
+        """
+        cache = \
+            get_default_compilation_cache() if self._persistent_cache is None else \
+            CompiledFunctionCache() if self._persistent_cache is True else \
+            None if self._persistent_cache is False else \
+            self._persistent_cache
+
+        if cache is not None:
+            key, shared_variables = get_graph_key(inputs, outputs, updates, allow_input_downcast=self._cast_to_floatx, mode=mode)
+            if key is not None:
+                with _COMPILATION_LOCK:
+                    compiled_fcn = cache.load(key, shared_variables)
+                if compiled_fcn is not None:
+                    PLATO_LOGGER.info('Loaded compiled form of %s from cache.' % (self._original_fcn.fcn_str(), ))
+                    return compiled_fcn
+
+        PLATO_LOGGER.info('Compiling %s with %s inputs, %s outputs, %s updates in mode %s' % (self._original_fcn.fcn_str(), len(inputs), 1 if isinstance(outputs, Variable) else 0 if outputs is None else len(outputs), len(updates), mode))
+        with _COMPILATION_LOCK:
+            compiled_fcn = theano.function(inputs = inputs, outputs = outputs, updates = updates, allow_input_downcast=self._cast_to_floatx,
+                mode = _get_theano_mode(mode))
+            if cache is not None and key is not None:
+                cache.save(key, compiled_fcn, shared_variables)
+        PLATO_LOGGER.info('Done.')
+        return compiled_fcn
+
     def __str__(self):
         return 'Compiled form of %s' % (self._original_fcn.fcn_str(), )
 
     def add_callback(self, fcn):
         self._callbacks.append(fcn)
+        self._fast_variants.clear()  # Callbacks need the full call path.
+
+    def get_dispatch_stats(self):
+        """
+        :return: A dict of statistics on how calls have been dispatched to the compiled variants of this function.
+        """
+        return dict(n_variants = len(self._variants), n_hits = self.n_hits, n_misses = self.n_misses,
+            n_fast_calls = self.n_fast_calls, compile_time = self.compile_time)
+
+    def capture_locals_next_call(self):
+        """
+        Run the instrumented form of the function on the next call, so that its locals are captured (see
+        capture_locals_every).  Has no effect unless the function was compiled with omniscence enabled.
+        """
+        self._capture_locals_next_call = True
 
     def locals(self):
+        from artemis.general.nested_structures import expand_struct
         return expand_struct(self._local_values)
 
+    def get_state_variables(self):
+        """
+        :return: A list of the shared variables that the compiled function updates (e.g. the parameters of a model and
+            the state of its optimizer), in the order the updates were made, followed by those that theano updates
+            because they have a default_update (e.g. the state of random streams).  Only compiled variants count, so
+            call precompile first if the function may not have been called yet.
+        """
+        state_variables = []
+        for variant in self._variants.values():
+            state_variables += [v for v in variant.updated_variables if v not in state_variables]
+        return state_variables
+
     @property
     def symbolic(self):
         """ Return the symbolic function """
@@ -612,18 +970,22 @@ ENABLE_TRACES = True
 
 def set_enable_traces(state):
     global ENABLE_TRACES
+    if not state and get_trace_sink() is not None:
+        PLATO_LOGGER.warn('Disabling traces while a TraceSink is set.  Functions compiled from now on will not send it anything.')
     ENABLE_TRACES = state
 
 
 class EnableOmniscence():
+    """
+    Enable omniscence for functions built and compiled within this context (in this thread only).
+    """
 
     def __enter__(self):
-        global ENABLE_OMNISCENCE
-        ENABLE_OMNISCENCE = True
+        self._old_state = _SYMBOLIC_STATE.omniscence
+        _SYMBOLIC_STATE.omniscence = True
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        global ENABLE_OMNISCENCE
-        ENABLE_OMNISCENCE = False
+        _SYMBOLIC_STATE.omniscence = self._old_state
 
 
 ENABLE_OMNISCENCE = False
@@ -631,16 +993,528 @@ ENABLE_OMNISCENCE = False
 
 def set_enable_omniscence(state):
     """
-    A possible useful but evil feature wherein we can peek at the local variables of a compiled function.
+    A possible useful but evil feature wherein we can peek at the local variables of a compiled function.  This sets
+    the default for all threads.  Use "with EnableOmniscence():" to enable it for just the current thread.
     """
     global ENABLE_OMNISCENCE
     ENABLE_OMNISCENCE = state
 
 
+def _is_omniscence_enabled():
+    return ENABLE_OMNISCENCE if _SYMBOLIC_STATE.omniscence is None else _SYMBOLIC_STATE.omniscence
+
+
 def _is_symbol_or_value(var):
     return isinstance(var, tt.TensorType) or isinstance(var, np.ndarray) or np.isscalar(var)
 
 
+class _SymbolicState(threading.local):
+    """
+    State that is used while building symbolic graphs.  This is local to each thread, so that different threads can
+    build graphs at the same time.
+    """
+    def __init__(self):
+        self.state_catcher = None  # The innermost StateCatcher
+        self.accumulate_updates = False  # True within an AccumulateUpdates context
+        self.omniscence = None  # True/False within an EnableOmniscence context.  None means: use ENABLE_OMNISCENCE
+        self.trace_registry = None  # The _TraceRegistry of the first pass currently being run
+        self.traced_state = None  # The _TracedState of the function whose first pass is currently being run
+
+
+_SYMBOLIC_STATE = _SymbolicState()
+
+
+class _TracedState(object):
+    """
+    The shared variables created in the first passes of a function (see AutoCompilingFunction), so that later first
+    passes (for a new signature, or after a variant was evicted) reuse them instead of creating their own.  In a first
+    pass, the n'th shared variable created is the n'th one created in an earlier first pass, if it has the same name,
+    shape and dtype (if not, e.g. because it depends on the shape of an input, a new one is created).
+    """
+
+    def __init__(self):
+        self._variables = []  # A list of lists: all the shared variables created at each position
+        self._position = 0
+
+    @contextmanager
+    def first_pass(self):
+        old_traced_state, _SYMBOLIC_STATE.traced_state = _SYMBOLIC_STATE.traced_state, self
+        self._position = 0
+        try:
+            yield
+        finally:
+            _SYMBOLIC_STATE.traced_state = old_traced_state
+
+    def get_shared_variable(self, value, name, kwargs):
+        """
+        :return: The shared variable created at this position in earlier first passes, or a new one.
+        """
+        if self._position == len(self._variables):
+            self._variables.append([])
+        candidates = self._variables[self._position]
+        self._position += 1
+        for shared_var in candidates:
+            if shared_var.name == name and _get_shape_and_dtype(shared_var.get_value(borrow=True)) == _get_shape_and_dtype(value):
+                return shared_var
+        _SYMBOLIC_STATE.traced_state = None  # So that theano.shared creates the variable, rather than coming back here
+        try:
+            shared_var = theano.shared(value, name = name, **kwargs)
+        finally:
+            _SYMBOLIC_STATE.traced_state = self
+        candidates.append(shared_var)
+        return shared_var
+
+
+def _get_shape_and_dtype(value):
+    return (value.shape, value.dtype) if hasattr(value, 'shape') and hasattr(value, 'dtype') else (np.shape(value), np.asarray(value).dtype)
+
+
+@shared_constructor
+def _reuse_traced_state(value, name = None, **kwargs):
+    """
+    A constructor for theano.shared (theano tries the last registered first), which, within the first pass of a
+    function, hands out the shared variables created in its earlier first passes (see _TracedState).
+    """
+    traced_state = _SYMBOLIC_STATE.traced_state
+    if traced_state is None:
+        raise TypeError('Not in a first pass')  # theano then tries the next constructor
+    return traced_state.get_shared_variable(value, name, kwargs)
+
+
+def _get_thread_state():
+    """
+    :return: The calling thread's graph-building state, which another thread can take on with _call_in_thread_state.
+    """
+    return _SYMBOLIC_STATE.accumulate_updates, _SYMBOLIC_STATE.omniscence, _COMPUTE_TEST_VALUE_MODE.get_current_mode()
+
+
+def _call_in_thread_state(thread_state, fcn, args, kwargs):
+    """
+    Call a function in the graph-building state of another thread (see _get_thread_state), and restore the state of
+    this thread afterwards.
+    """
+    old_state = _SYMBOLIC_STATE.accumulate_updates, _SYMBOLIC_STATE.omniscence
+    _SYMBOLIC_STATE.accumulate_updates, _SYMBOLIC_STATE.omniscence, compute_test_value_mode = thread_state
+    try:
+        with _COMPUTE_TEST_VALUE_MODE.inherit(compute_test_value_mode):
+            return fcn(*args, **kwargs)
+    finally:
+        _SYMBOLIC_STATE.accumulate_updates, _SYMBOLIC_STATE.omniscence = old_state
+
+
+class _ComputeTestValueMode(object):
+    """
+    theano.config.compute_test_value is a process-wide setting.  This lets any number of threads build graphs with one
+    mode at the same time, while threads wanting a different mode wait until they are done.  Usage:
+
+        with _COMPUTE_TEST_VALUE_MODE('warn'):
+            # build graph...
+
+    A nested use within the same thread (e.g. compiling a function inside the first pass of another) just keeps the
+    mode of the outer one, since switching would mean waiting for ourselves.  So does a thread that inherits the mode
+    of another (see inherit).  The original setting is restored when the last thread leaves.
+
+    Computing test values means compiling a thunk for every op, which is not thread-safe, so while test values are on,
+    we also hold the _COMPILATION_LOCK.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._n_users = 0
+        self._base_mode = None
+        self._local = threading.local()
+
+    def __call__(self, mode):
+        self._local.requested_mode = mode
+        return self
+
+    def get_current_mode(self):
+        """
+        :return: The mode that this thread is building graphs in, or None if it is not in this context.
+        """
+        return theano.config.compute_test_value if getattr(self._local, 'depth', 0) > 0 else None
+
+    @contextmanager
+    def inherit(self, mode):
+        """
+        Within this context, uses of this context in this thread keep the given mode (the mode of another thread, see
+        get_current_mode), as if nested in it.  Does nothing if mode is None.
+        """
+        old_mode = getattr(self._local, 'inherited_mode', None)
+        self._local.inherited_mode = mode
+        try:
+            yield
+        finally:
+            self._local.inherited_mode = old_mode
+
+    def __enter__(self):
+        depth = getattr(self._local, 'depth', 0)
+        with self._condition:
+            if depth == 0:
+                inherited_mode = getattr(self._local, 'inherited_mode', None)
+                mode = inherited_mode if inherited_mode is not None else self._local.requested_mode
+                while self._n_users > 0 and theano.config.compute_test_value != mode:
+                    self._condition.wait()
+                if self._n_users == 0:
+                    self._base_mode = theano.config.compute_test_value
+                    theano.config.compute_test_value = mode
+            self._n_users += 1
+            self._local.depth = depth + 1
+        self._local.holds_lock = theano.config.compute_test_value != 'off'
+        if self._local.holds_lock:
+            _COMPILATION_LOCK.acquire()
+
+    def __exit__(self, *args):
+        if self._local.holds_lock:
+            _COMPILATION_LOCK.release()
+        with self._condition:
+            self._n_users -= 1
+            self._local.depth -= 1
+            if self._n_users == 0:
+                theano.config.compute_test_value = self._base_mode
+                self._condition.notify_all()
+
+
+_COMPUTE_TEST_VALUE_MODE = _ComputeTestValueMode()
+_COMPILATION_LOCK = threading.RLock()  # Theano's compilation (and module cache) is not thread-safe.
+_COMPILATION_POOL = None
+N_COMPILATION_THREADS = 4  # Number of threads used by compile_async
+
+
+COMPILE_MODES = ('fast_run', 'fast_compile', 'interpreted', 'auto')
+AUTO_MODE_SMALL_GRAPH_SIZE = 100  # With mode='auto', graphs with up to this many nodes are always fully optimized
+
+
+def _get_theano_mode(mode):
+    """
+    :param mode: One of COMPILE_MODES (except 'auto')
+    :return: The mode argument for theano.function
+    """
+    return \
+        None if mode == 'fast_run' else \
+        theano.compile.mode.Mode(linker = 'cvm' if theano.config.cxx else 'vm', optimizer = 'fast_compile') if mode == 'fast_compile' else \
+        'FAST_COMPILE' if mode == 'interpreted' else \
+        bad_value(mode)
+
+
+def _flatten_outputs(outputs):
+    """
+    :param outputs: The outputs of a symbolic function: None, a variable, a tuple of variables, or a dict of variables
+    :return: A list of the output variables
+    """
+    return [] if outputs is None else [outputs] if isinstance(outputs, Variable) else \
+        list(outputs.values()) if isinstance(outputs, dict) else list(outputs)
+
+
+def _demote_float64_graph(outputs, instrumented_outputs, updates):
+    """
+    Rebuild the graph of a function to compute in floatX instead of float64 (see plato.precision.demote_float64).
+    Update values are cast back to the dtypes of the shared variables they update, since these can't be changed.
+    :return: The new outputs (in the same structure), instrumented outputs, and updates.
+    """
+    flat_outputs = _flatten_outputs(outputs)
+    flat_instrumented_outputs = _flatten_outputs(instrumented_outputs)
+    new = demote_float64(flat_outputs + flat_instrumented_outputs + [new for _, new in updates])
+    new_flat_outputs = new[:len(flat_outputs)]
+    new_outputs = \
+        None if outputs is None else \
+        new_flat_outputs[0] if isinstance(outputs, Variable) else \
+        OrderedDict(zip(outputs.keys(), new_flat_outputs)) if isinstance(outputs, dict) else \
+        tuple(new_flat_outputs)
+    new_instrumented_outputs = None if instrumented_outputs is None else \
+        tuple(new[len(flat_outputs):len(flat_outputs)+len(flat_instrumented_outputs)])
+    new_updates = [(shared_var, new_val if new_val.type == shared_var.type else tt.patternbroadcast(tt.cast(new_val, shared_var.dtype), shared_var.broadcastable))
+        for (shared_var, _), new_val in zip(updates, new[len(flat_outputs)+len(flat_instrumented_outputs):])]
+    return new_outputs, new_instrumented_outputs, new_updates
+
+
+def _get_compilation_pool():
+    global _COMPILATION_POOL
+    if _COMPILATION_POOL is None:
+        _COMPILATION_POOL = ThreadPool(processes=N_COMPILATION_THREADS)
+    return _COMPILATION_POOL
+
+
+class _CompiledVariant(object):
+    """
+    The compiled theano function for one input signature of an AutoCompilingFunction, along with everything needed
+    to pack/unpack its inputs and outputs.
+    """
+    compiled_fcn = None
+    instrumented_fcn = None  # Only exists when compiled with omniscence.  Also returns the locals of the function.
+    kwarg_order = ()
+    original_output_format = None
+    signal_names = None
+    there_are_debug_variables = False
+    trace_variable_keys = ()
+    local_variable_keys = ()
+    n_outputs = 0
+    n_trace_vars = 0
+    trace_callbacks = {}
+    mode = 'fast_run'
+    graph = None  # (inputs, outputs, instrumented_outputs, updates), kept if we may need to recompile
+    recompile_after = None  # Number of calls after which to recompile with mode='fast_run'
+    n_calls = 0
+    original_updates = ()
+    updated_variables = ()  # The shared variables updated by the function
+    old_update_shapes = ()
+    last_used = 0
+
+
+class FunctionMetrics(object):
+    """
+    Performance metrics for one symbolic function, accumulated over all of its compiled variants.  These are always
+    recorded, and cheap enough to record that you don't need to turn them off.
+
+    To keep the overhead down on the fast call path (see AutoCompilingFunction), calls there only append their latency
+    to a pending list, which is folded into the totals every few calls, and the sizes of the inputs and outputs are
+    measured on one of every sample_period calls and assumed to be the same for the calls in between.
+    """
+
+    n_latency_samples = 1000  # Latency percentiles are computed over this many of the most recent calls
+    sample_period = 16
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.n_compilations = 0
+        self.first_pass_time = 0.
+        self.compile_time = 0.
+        self.n_nodes = 0
+        self._n_calls = 0
+        self._total_call_time = 0.
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._sampled_bytes = (0, 0)
+        self._latencies = deque(maxlen=self.n_latency_samples)
+        self.pending_latencies = []
+
+    def record_compilation(self, first_pass_time, compile_time, n_nodes):
+        """
+        :param first_pass_time: Time taken to do the symbolic pass of the function
+        :param compile_time: Time taken to compile (or load from the persistent cache) the theano function.
+        :param n_nodes: Number of nodes in the optimized graph of the compiled function.
+        """
+        self.n_compilations += 1
+        self.first_pass_time += first_pass_time
+        self.compile_time += compile_time
+        self.n_nodes = n_nodes
+
+    def record_call(self, latency, bytes_in, bytes_out):
+        self._n_calls += 1
+        self._total_call_time += latency
+        self._bytes_in += bytes_in
+        self._bytes_out += bytes_out
+        self._latencies.append(latency)
+
+    def flush(self, sampled_bytes = None):
+        """
+        Fold the pending latencies from fast-path calls into the totals.
+        :param sampled_bytes: Optionally, a (bytes_in, bytes_out) tuple measured on the most recent call, which is
+            taken to be the size of the data for every pending call.
+        """
+        if sampled_bytes is not None:
+            self._sampled_bytes = sampled_bytes
+        pending = self.pending_latencies
+        if len(pending) > 0:
+            self.pending_latencies = []
+            self._n_calls += len(pending)
+            self._total_call_time += sum(pending)
+            self._bytes_in += self._sampled_bytes[0]*len(pending)
+            self._bytes_out += self._sampled_bytes[1]*len(pending)
+            self._latencies.extend(pending)
+
+    @property
+    def n_calls(self):
+        self.flush()
+        return self._n_calls
+
+    @property
+    def total_call_time(self):
+        self.flush()
+        return self._total_call_time
+
+    @property
+    def bytes_in(self):
+        self.flush()
+        return self._bytes_in
+
+    @property
+    def bytes_out(self):
+        self.flush()
+        return self._bytes_out
+
+    def get_latency_percentiles(self, percentiles = (50, 90, 99)):
+        """
+        :param percentiles: A list of percentiles to compute.
+        :return: An OrderedDict<percentile: latency_in_seconds>, computed over recent calls.
+        """
+        self.flush()
+        if len(self._latencies) == 0:
+            return OrderedDict((p, None) for p in percentiles)
+        return OrderedDict(zip(percentiles, np.percentile(self._latencies, percentiles).tolist()))
+
+    def to_dict(self):
+        return OrderedDict([
+            ('name', self.name),
+            ('n_compilations', self.n_compilations),
+            ('first_pass_time', self.first_pass_time),
+            ('compile_time', self.compile_time),
+            ('n_nodes', self.n_nodes),
+            ('n_calls', self.n_calls),
+            ('total_call_time', self.total_call_time),
+            ('mean_call_time', self.total_call_time/self.n_calls if self.n_calls > 0 else None),
+            ('latency_percentiles', OrderedDict(('p%s' % (p, ), t) for p, t in self.get_latency_percentiles().iteritems())),
+            ('bytes_in', self.bytes_in),
+            ('bytes_out', self.bytes_out),
+            ])
+
+
+class MetricsRegistry(object):
+    """
+    A collection of FunctionMetrics, one per symbolic function.  They are keyed by the function object itself, and only
+    weakly, so the metrics of a function are dropped along with it, and functions with the same name don't share them.
+    """
+
+    def __init__(self):
+        self._metrics = WeakKeyDictionary()  # A dict<symbolic function: (creation index, FunctionMetrics)>
+        self._n_created = 0
+
+    def get(self, fcn):
+        """
+        :param fcn: A symbolic function
+        :return: The FunctionMetrics for that function (created if it doesn't yet exist)
+        """
+        if fcn not in self._metrics:
+            self._metrics[fcn] = (self._n_created, FunctionMetrics(fcn.fcn_str()))
+            self._n_created += 1
+        return self._metrics[fcn][1]
+
+    def get_all(self, sort_by = None):
+        """
+        :param sort_by: Optionally, the name of an attribute of FunctionMetrics (e.g. 'total_call_time') to sort by,
+            in descending order.  So the hot spot comes first.
+        :return: A list of FunctionMetrics, in the order they were created unless sorted.
+        """
+        metrics = [m for _, m in sorted(self._metrics.values(), key = lambda (index, _): index)]
+        return metrics if sort_by is None else sorted(metrics, key = lambda m: getattr(m, sort_by), reverse=True)
+
+    def to_dict(self):
+        """
+        :return: A dict<function name: dict of metrics>.  If several functions have the same name, the later ones get a
+            suffix: "name (2)", "name (3)", ...
+        """
+        metrics_dict = OrderedDict()
+        for m in self.get_all():
+            name, i = m.name, 1
+            while name in metrics_dict:
+                i += 1
+                name = '%s (%s)' % (m.name, i)
+            metrics_dict[name] = m.to_dict()
+        return metrics_dict
+
+    def dump_json(self, path):
+        """
+        :param path: A file path to write the metrics of all functions to, in JSON format.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def reset(self):
+        for m in self.get_all():
+            m.reset()
+
+
+_METRICS_REGISTRY = MetricsRegistry()
+
+
+def get_metrics_registry():
+    """
+    :return: The MetricsRegistry containing the performance metrics of all compiled functions.
+    """
+    return _METRICS_REGISTRY
+
+
+def _get_nbytes(data):
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    elif isinstance(data, (list, tuple)):
+        return sum([_get_nbytes(d) for d in data])
+    elif isinstance(data, dict):
+        return sum([_get_nbytes(d) for d in data.values()])
+    elif isinstance(data, csr_matrix):
+        return data.data.nbytes + data.indices.nbytes + data.indptr.nbytes
+    else:
+        return 0
+
+
+def _filter_inputs(compiled_fcn, values):
+    """
+    Do the input checking that a theano function skips when it has trust_input on: convert each value to the type of its
+    input (e.g. an int32 array for an int64 input), or raise if it can't be.
+
+    :param compiled_fcn: A compiled theano function
+    :param values: The values of its (explicit) inputs
+    :return: A list of the converted values
+    """
+    n_inputs = sum(not container.implicit for container in compiled_fcn.input_storage)
+    assert len(values) == n_inputs, 'The theano function takes %s inputs, but was given %s' % (n_inputs, len(values))
+    filtered_values = []
+    for i, (value, container) in enumerate(zip(values, compiled_fcn.input_storage)):
+        if value is not None:
+            try:
+                value = container.type.filter(value, strict=container.strict, allow_downcast=container.allow_downcast)
+            except Exception as e:
+                e.args = ('Bad input argument to theano function at index %s (0-based)' % (i, ), ) + e.args
+                raise
+        filtered_values.append(value)
+    return filtered_values
+
+
+def _get_call_signature(args, kwargs, cast_to_floatx):
+    """
+    Get a hashable signature of the arguments to a compiled function.  Two calls with the same signature can be
+    handled by the same compiled function.
+    """
+    return tuple(_get_data_signature(a, cast_to_floatx) for a in args) + \
+        tuple((k, _get_data_signature(kwargs[k], cast_to_floatx)) for k in sorted(kwargs.keys()))
+
+
+def _get_data_signature(data, cast_to_floatx):
+    """
+    Get the signature of a single argument: The (ndim, dtype) of the tensor that _data_to_tensor would create for it.
+    """
+    if isinstance(data, (list, tuple)):
+        return tuple(_get_data_signature(d, cast_to_floatx) for d in data)
+    if isinstance(data, SharedVariable):
+        data = data.get_value(borrow=True)
+    return (
+        'csr' if isinstance(data, csr_matrix) else 0 if np.isscalar(data) else data.ndim,
+        _get_tensor_dtype(data, cast_to_floatx)
+        )
+
+
+def _get_tensor_dtype(data, cast_to_floatx):
+    """
+    Get the dtype of the tensor that will represent the data.  See _data_to_tensor.
+    """
+    is_dtype = lambda x, dtype: isinstance(x, dtype) or isinstance(x, (np.ndarray, csr_matrix)) and x.dtype == dtype
+
+    # Need to also downcast ints to int32 if floatX is float32, otherwise things like int_array.mean() return float64
+    # objects, which (a) slows things down and (b) causes an error when you try to update 32-bit shared variabkles
+    # with 64 bit values.
+
+    return \
+        theano.config.floatX if (cast_to_floatx == 'all' or (cast_to_floatx=='float' and is_dtype(data, float))) else \
+        'int32' if (cast_to_floatx=='float' and theano.config.floatX == 'float32' and is_dtype(data, int)) else \
+        'int64' if isinstance(data, (bool, int)) else \
+        'float64' if isinstance(data, float) else \
+        'int8' if data.dtype==bool else \
+        data.dtype
+
+
 def _data_to_tensor(data, name = None, cast_to_floatx = True, add_test_value = True):
     """
     Given the numpy data from the first function call, create the appropriate tensors
@@ -674,35 +1548,18 @@ def _data_to_tensor(data, name = None, cast_to_floatx = True, add_test_value = T
                 "don't that's cool, ignore this.  Otherwise, to fix this problem, you either cast your inputs to floats beforehand, "
                 "or compile your symbolic functions with: fcn.compile(cast_to_floatx='all')")
 
-    is_dtype = lambda x, dtype: isinstance(x, dtype) or isinstance(x, (np.ndarray, csr_matrix)) and x.dtype == dtype
-
-    # Need to also downcast ints to int32 if floatX is float32, otherwise things like int_array.mean() return float64
-    # objects, which (a) slows things down and (b) causes an error when you try to update 32-bit shared variabkles
-    # with 64 bit values.
-
-    dtype = \
-        theano.config.floatX if (cast_to_floatx == 'all' or (cast_to_floatx=='float' and is_dtype(data, float))) else \
-        'int32' if (cast_to_floatx=='float' and theano.config.floatX == 'float32' and is_dtype(data, int)) else \
-        'int64' if isinstance(data, (bool, int)) else \
-        'float64' if isinstance(data, float) else \
-        'int8' if data.dtype==bool else \
-        data.dtype
+    dtype = _get_tensor_dtype(data, cast_to_floatx)
     if isinstance(data, csr_matrix):
-        # Here we make a bunch of hacks to accomodate sparse matrices so that we don't have to change any of our other
-        # code when handling them.   This was assembled in haste before a deadline.  Possibly it could be cleaner.  Probably.
+        # Sparse inputs stay sparse.  Use theano.dot(x, w) to multiply them (this also works for dense x), and
+        # select_rows to index them.
         from theano import sparse
-        tensor = sparse.csr_matrix(name='unnamed' if name is None else name, dtype=dtype, )
+        tensor = sparse.csr_matrix(name='unnamed' if name is None else name, dtype=dtype)
+        tensor.tag.test_shape = data.shape
         if add_test_value:
-            tensor.tag.test_value = data.astype(theano.config.floatX)
-        # Do what theano couldn't and add the dot method to sparse
-        def flattenit(var, ndim):
-            assert var.indim == ndim, "This is a horrendous hack.  We don't actually flatten, we just check to see if it's the right shape.  It's not.  Also it needs test values on to work."
-            return var
-        sparse.SparseVariable.flatten = property(lambda self: lambda ndim: flattenit(self, ndim))
-        sparse.SparseVariable.dot = property(lambda self: lambda other: theano.dot(self, other))
-
+            tensor.tag.test_value = data.astype(dtype)
     else:
         tensor = TensorType(dtype, (None, )*ndim)(name)
+        tensor.tag.test_shape = np.shape(data)
         if add_test_value:
             tensor.tag.test_value = data.astype(dtype) if isinstance(data, np.ndarray) else np.array(data).astype(dtype)
     return tensor
@@ -744,6 +1601,21 @@ def array_info(arr):
         return '%s of shape %s' % (arr.__class__.__name__, arr.shape, )
 
 
+def select_rows(data, indices):
+    """
+    Symbolically index the rows of a (dense or sparse) matrix.  data[indices] does not work on sparse variables when
+    indices is an integer vector.
+    :param data: A symbolic tensor or sparse matrix
+    :param indices: A symbolic integer vector (or slice)
+    :return: The selected rows
+    """
+    from theano import sparse
+    if isinstance(data.type, sparse.SparseType) and not isinstance(indices, slice):
+        return sparse.get_item_list(data, indices)
+    else:
+        return data[indices]
+
+
 def find_shared_ancestors(variable):
     """
     Given a variable, return a list of all shared variables that it depends upon.  This can be useful for
@@ -751,44 +1623,55 @@ def find_shared_ancestors(variable):
     :param variable: A theano variable
     :return: A list of SharedVariables.
     """
-    if isinstance(variable, SharedVariable):
-        return [variable]
-    else:
-        return list(set(sum([find_shared_ancestors(p) for p in variable.get_parents()], [])))
+    return GraphIndex([variable]).shared_variables()
 
 
-def find_all_ancestors(variable, memo = None):
+def find_all_ancestors(variable):
     """
     Return a set including the all ancestors of the given variable
     :param variable: A Theano Tensor
     :return: A set containing all ancestors, including the given variable.
     """
+    return set(GraphIndex([variable]).variables())
 
-    if memo is None:
-        memo = set()
 
-    memo.add(variable)
+def find_leaf_ancestors(variable):
+    return set(GraphIndex([variable]).leaves())
 
-    for p in variable.get_parents():
-        if p not in memo:
-            find_all_ancestors(p, memo = memo)
 
-    return memo
+class _TraceRegistry(object):
+    """
+    The trace variables added during the first pass of a function.  Each compilation gets its own registry, so traces
+    added while building one function don't end up in another.  Usage:
+
+        with _TraceRegistry() as trace_registry:
+            # Build graph.  Calls to tdb_trace in this thread will add to trace_registry
+    """
 
+    def __init__(self):
+        self.variables = OrderedDict()  # A dict of trace-variable-name: Trace Variable
+        self.callbacks = OrderedDict()  # A dict of trace-variable-name: Callback to call after trace ver is used.
 
-def find_leaf_ancestors(variable):
-    all_ancestors = find_all_ancestors(variable)
-    leaf_ancestors = {var for var in all_ancestors if len(var.get_parents()) == 0}
-    return leaf_ancestors
+    def __enter__(self):
+        self._outer_registry = _SYMBOLIC_STATE.trace_registry
+        _SYMBOLIC_STATE.trace_registry = self
+        return self
+
+    def __exit__(self, *args):
+        _SYMBOLIC_STATE.trace_registry = self._outer_registry
+
+    def clear(self):
+        self.variables.clear()
+        self.callbacks.clear()
 
 
-_TRACE_VARIABLES = OrderedDict()  # A dict of trace-variable-name: Trace Variable
+_GLOBAL_TRACES = _TraceRegistry()  # Traces added outside of any compilation.  These are considered in every compilation.
 _TRACE_VALUES = OrderedDict()  # A dict of trace variable name: Most recently computed value
-_TRACE_CALLBACKS = OrderedDict()  # A dict of trace-variable-name: Callback to call after trace ver is used.
 
 
 def get_tdb_traces():
-    return _TRACE_VALUES
+    worker_trace_values = get_worker_trace_values()  # Within the callback of a TraceSink
+    return _TRACE_VALUES if worker_trace_values is None else worker_trace_values
 
 
 def tdb_trace(var, name = None, callback = None):
@@ -798,20 +1681,23 @@ def tdb_trace(var, name = None, callback = None):
 
     :param var: A symbolic variable
     :param name: The name that you like to use to refer to the variable.
-    :param callback: Optionally, a callback to add at the end.
+    :param callback: Optionally, a callback to add at the end.  If a TraceSink is set (see plato.trace_sink), the
+        callback is run by the sink instead.
     :return:
     """
     if name is None:
         # TODO: Get default by sneakily grabbing name from calling scope.
         name = '%s@%s' % (str(var), hex(id(var)))
-    _TRACE_VARIABLES[name] = var
+    registry = _SYMBOLIC_STATE.trace_registry if _SYMBOLIC_STATE.trace_registry is not None else _GLOBAL_TRACES
+    registry.variables[name] = var
     if callback is not None:
-        _TRACE_CALLBACKS[name] = callback
+        registry.callbacks[name] = callback
 
 
 def clear_tdb_traces():
-    _TRACE_CALLBACKS.clear()
-    _TRACE_VARIABLES.clear()
+    _GLOBAL_TRACES.clear()
+    if _SYMBOLIC_STATE.trace_registry is not None:
+        _SYMBOLIC_STATE.trace_registry.clear()
 
 
 def printit(var_name, var_val):
@@ -822,19 +1708,15 @@ def tdbprint(var, name = None):
     if name is None:
         # TODO: Get default by sneakily grabbing name from calling scope.
         name = '%s@%s' % (str(var), hex(id(var)))
-    tdb_trace(var, name, callback = lambda: printit(var_name = name, var_val = _TRACE_VALUES[name]))
-
-
-STATE_CATCHER = None
+    tdb_trace(var, name, callback = lambda: printit(var_name = name, var_val = get_tdb_traces()[name]))
 
 
 def _get_state_catcher():
-    return STATE_CATCHER
+    return _SYMBOLIC_STATE.state_catcher
 
 
 def _set_state_catcher(val):
-    global STATE_CATCHER
-    STATE_CATCHER = val
+    _SYMBOLIC_STATE.state_catcher = val
 
 
 def add_update(shared_var, new_val):
@@ -868,7 +1750,9 @@ class StateCatcher(object):
     def __enter__(self):
         self._outer_catcher = _get_state_catcher()
         _set_state_catcher(self)
-        self._updates = OrderedDict()
+        self._updates = OrderedDict()  # A dict<shared_var: list of new values>
+        self._fused_updates = None
+        self.n_merged_updates = 0  # Number of updates that were accumulated onto an earlier update of the same variable
         return self
 
     def __exit__(self, *args):
@@ -876,20 +1760,48 @@ class StateCatcher(object):
 
     def add_update(self, shared_var, new_val):
         if shared_var in self._updates:
-            if _ACCUMULATE_UPDATES:
-                self._updates[shared_var] = self._updates[shared_var] + new_val - shared_var  # (w+dw1)+(w+dw2)-w = w+dw1+dw2
+            if _SYMBOLIC_STATE.accumulate_updates:
+                self._updates[shared_var].append(new_val)  # Fused into w+dw1+dw2+... in get_updates
+                self.n_merged_updates += 1
             else:
-                raise AssertionError("You tried to update shared-variable %s with tensor %s, but you've already updated it with tensor %s.\nIf you want to accumulate both updates, call your update from inside a 'with AccumulateUpdates():'" % (shared_var, new_val, self._updates[shared_var]))
+                raise AssertionError("You tried to update shared-variable %s with tensor %s, but you've already updated it with tensor %s.\nIf you want to accumulate both updates, call your update from inside a 'with AccumulateUpdates():'" % (shared_var, new_val, self._updates[shared_var][0]))
         else:
-            self._updates[shared_var] = new_val
+            self._updates[shared_var] = [new_val]
+        self._fused_updates = None
         if self._outer_catcher is not None and not self.swallow_updates:  # Allows for nested StateCatchers (outer ones do not have to worry about inner ones stealing their updates)
             self._outer_catcher.add_update(shared_var, new_val)
 
     def get_updates(self):
-        return self._updates.items()
+        if self._fused_updates is None:
+            self._fused_updates = [(shared_var, new_vals[0] if len(new_vals)==1 else _fuse_updates(shared_var, new_vals))
+                for shared_var, new_vals in self._updates.iteritems()]
+        return list(self._fused_updates)
 
 
-_ACCUMULATE_UPDATES = False
+def _fuse_updates(shared_var, new_vals):
+    """
+    Combine several updates to a shared variable: w -> w+dw1, w -> w+dw2 become one update w -> w+dw1+dw2.
+    :param shared_var: A shared variable
+    :param new_vals: A list of new values for it
+    :return: A single new value, which adds up the changes made by all the new values.
+    """
+    return tt.add(shared_var, *[_get_update_delta(shared_var, new_val) for new_val in new_vals])
+
+
+def _get_update_delta(shared_var, new_val):
+    """
+    :return: A symbolic expression for new_val-shared_var.  If new_val is already of the form shared_var+delta (as is
+        the case with most optimizers) or shared_var-delta, we just take delta from it rather than adding a subtraction.
+    """
+    owner = new_val.owner
+    if owner is not None and isinstance(owner.op, tt.Elemwise):
+        if isinstance(owner.op.scalar_op, theano.scalar.Add) and shared_var in owner.inputs:
+            other_inputs = list(owner.inputs)
+            other_inputs.remove(shared_var)
+            return other_inputs[0] if len(other_inputs)==1 else tt.add(*other_inputs)
+        elif isinstance(owner.op.scalar_op, theano.scalar.Sub) and owner.inputs[0] is shared_var:
+            return -owner.inputs[1]
+    return new_val - shared_var
 
 
 class AccumulateUpdates():
@@ -898,16 +1810,18 @@ class AccumulateUpdates():
     different objectives, you may want to add them: w_new = w + delta_w_1 + delta_w_2.  It's generally best to avoid
     this, and instead add the gradients, and update those with a single optimizer, but this we provide this anyway
     because we at Plato believe you should be able to hurt yourself if you want to.
+
+    All the updates to a variable are fused into a single expression w + (dw1 + dw2 + ...), so the graph does not grow
+    with chains of redundant additions and subtractions of w.  StateCatcher.n_merged_updates counts how many updates were
+    merged this way.
     """
 
     def __enter__(self, ):
-        global _ACCUMULATE_UPDATES
-        self._oldstate = _ACCUMULATE_UPDATES
-        _ACCUMULATE_UPDATES = True
+        self._oldstate = _SYMBOLIC_STATE.accumulate_updates
+        _SYMBOLIC_STATE.accumulate_updates = True
 
     def __exit__(self, *args):
-        global _ACCUMULATE_UPDATES
-        _ACCUMULATE_UPDATES = self._oldstate
+        _SYMBOLIC_STATE.accumulate_updates = self._oldstate
 
 
 def assert_compatible_shape(actual_shape, desired_shape, name = None):
@@ -940,7 +1854,7 @@ def initialize_param(initial_value, shape = None, name = None, cast_floats_to_fl
     - With None, which we take to mean that this was an optional variable that should not be included, so return None
       for variable, param, and shape.
 
-    :param initial_value: An array, scalar, or symbolic variable.:
+    :param initial_value: An array (or scipy.sparse.csr_matrix), scalar, or symbolic variable.:
     :param shape: The shape that the variable should have.  None if it is already fully specified by initial_value.
         If shape is a tuple, elements of shape s can be:
         - integers: In which case, they mean (the dimension of in this direction shall be <s>
@@ -970,6 +1884,12 @@ def initialize_param(initial_value, shape = None, name = None, cast_floats_to_fl
         variable = theano.shared(typecast(initial_value), name = name, borrow = True, allow_downcast=True, **shared_kwargs)
         params = [variable]
         variable_shape = initial_value.shape
+    elif isinstance(initial_value, csr_matrix):
+        from theano import sparse
+        assert_compatible_shape(initial_value.shape, shape, name = name)
+        variable = sparse.shared(typecast(initial_value), name = name, borrow = True, **shared_kwargs)
+        params = [variable]
+        variable_shape = initial_value.shape
     elif isinstance(initial_value, Variable):
         assert name is None or initial_value.name == name, "Can't give name '%s' to an already-existing symbolic variable" % (name, )
         params = find_shared_ancestors(initial_value)
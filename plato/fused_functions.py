@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from plato.core import symbolic, _detect_format, SingleOutputFormat, MultiOutputFormat, NamedCollectionFormat, \
+    NoOutputFormat
+
+__author__ = 'peter'
+
+"""
+Compile several symbolic functions into a single theano function.
+
+Training loops often call a few compiled functions that share most of their computation - e.g. a training step, and
+a prediction on the same minibatch.  Compiled separately, each one does its own forward pass.  If they are built
+into one graph, theano merges the common subgraphs, so the forward pass is done once.
+
+Usage:
+
+    fused = FusedSymbolicFunction([
+        ('train', predictor.train, ['x', 'y']),
+        ('predict', predictor.predict, ['x']),
+        ])
+    train_and_predict = fused.compile('train', 'predict')
+    out = train_and_predict(x=x_minibatch, y=y_minibatch)
+    predictions = out['predict']
+
+Each call to compile creates an entry point that computes the named subset of the functions.  Entry points take the
+union of the inputs of their member functions (as keyword arguments, or positionally in order of first appearance),
+and return an OrderedDict of the outputs of the members:
+    - A single output is named by the member: 'predict'
+    - Multiple outputs are indexed: 'predict[0]', 'predict[1]'
+    - Named outputs are prefixed: 'predict.probs'
+Members that only produce updates contribute no outputs.  As with any theano function, all outputs are computed before
+any updates are applied, so in the example above, the predictions are made with the parameters from before the
+training step.
+"""
+
+
+class FusedSymbolicFunction(object):
+
+    def __init__(self, functions):
+        """
+        :param functions: A list of (name, symbolic_function, input_names) tuples, where input_names is a list of
+            names of the arguments to pass to the function.  Functions which share an input name are passed the same
+            tensor.
+        """
+        self._functions = OrderedDict()
+        for name, fcn, input_names in functions:
+            assert name not in self._functions, 'Function name "%s" is used twice' % (name, )
+            self._functions[name] = (fcn, tuple(input_names))
+
+    def get_input_names(self, *names):
+        """
+        :param names: Names of functions to include (default: all of them)
+        :return: A list of the input names required by these functions, in order of first appearance.
+        """
+        if len(names) == 0:
+            names = self._functions.keys()
+        input_names = []
+        for name in names:
+            for input_name in self._functions[name][1]:
+                if input_name not in input_names:
+                    input_names.append(input_name)
+        return input_names
+
+    def entry_point(self, *names):
+        """
+        :param names: Names of the functions to include (default: all of them)
+        :return: A symbolic function computing these functions in one graph.
+        """
+        if len(names) == 0:
+            names = self._functions.keys()
+        for name in names:
+            assert name in self._functions, 'No function named "%s".  Choose from %s' % (name, self._functions.keys())
+        input_names = self.get_input_names(*names)
+
+        @symbolic
+        def fused_function(*args, **kwargs):
+            assert len(args) <= len(input_names), 'Entry point takes %s inputs %s.  You gave %s positional arguments' % (len(input_names), input_names, len(args))
+            inputs = dict(zip(input_names, args))
+            for k, v in kwargs.iteritems():
+                assert k not in inputs, 'Got multiple values for input "%s"' % (k, )
+                inputs[k] = v
+            assert set(inputs.keys()) == set(input_names), 'Entry point needs inputs %s.  You gave %s' % (input_names, inputs.keys())
+            outputs = OrderedDict()
+            for name in names:
+                fcn, fcn_input_names = self._functions[name]
+                out = fcn(*[inputs[n] for n in fcn_input_names])
+                out_format = _detect_format(out)
+                if out_format is SingleOutputFormat:
+                    outputs[name] = out
+                elif out_format is MultiOutputFormat:
+                    outputs.update(('%s[%s]' % (name, i), o) for i, o in enumerate(out))
+                elif out_format is NamedCollectionFormat:
+                    outputs.update(('%s.%s' % (name, k), o) for k, o in out.iteritems())
+                else:
+                    assert out_format is NoOutputFormat, 'Fused functions must return a tensor, a tuple of tensors, or a dict of tensors.  "%s" returned %s' % (name, out)
+            return outputs if len(outputs) > 0 else None
+
+        return fused_function
+
+    def compile(self, *names, **compilation_kwargs):
+        """
+        Compile an entry point.
+
+        :param names: Names of the functions to include (default: all of them)
+        :param compilation_kwargs: See AutoCompilingFunction
+        :return: An AutoCompilingFunction
+        """
+        return self.entry_point(*names).compile(**compilation_kwargs)
@@ -0,0 +1,100 @@
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof.graph import Constant
+
+__author__ = 'peter'
+
+"""
+An index of the ancestry of a symbolic graph.
+
+Walking a theano graph recursively is slow (and can hit the recursion limit) on deep graphs like VGG with optimizer
+updates attached.  A GraphIndex walks the graph once, iteratively, and then answers questions about ancestry (which
+variables, leaves, and shared variables the outputs depend on, and whether some other variable can be computed from the
+same leaves) without walking it again.  Building the index and all subsequent queries together take O(V+E) time.
+
+Usage:
+
+    index = GraphIndex([cost])
+    params = index.shared_variables()
+"""
+
+
+class GraphIndex(object):
+
+    def __init__(self, outputs):
+        """
+        :param outputs: A list of symbolic variables.  The index covers these variables and all of their ancestors.
+        """
+        self.outputs = list(outputs)
+        self._variables = _toposort_variables(self.outputs)
+        self._variable_set = set(self._variables)
+        self._leaves = [v for v in self._variables if v.owner is None]
+        self._computable = {}  # A dict<variable: bool> memo for is_computable
+
+    def __contains__(self, var):
+        return var in self._variable_set
+
+    def variables(self):
+        """
+        :return: A list of all variables in the graph, in topological order (ancestors before descendents).
+        """
+        return list(self._variables)
+
+    def leaves(self):
+        """
+        :return: A list of the variables in the graph that are not computed from other variables (inputs, shared
+            variables and constants), in topological order.
+        """
+        return list(self._leaves)
+
+    def shared_variables(self):
+        """
+        :return: A list of the shared variables that the outputs depend on, in topological order.
+        """
+        return [v for v in self._leaves if isinstance(v, SharedVariable)]
+
+    def is_computable(self, var):
+        """
+        :param var: Any symbolic variable (it need not be in the graph).
+        :return: True if var could be computed from the leaves of this graph (plus any shared variables and constants).
+            That is, if adding var as an extra output of the graph would not require any new inputs.
+        """
+        stack = [var]
+        while len(stack) > 0:
+            v = stack[-1]
+            if v in self._computable:
+                stack.pop()
+            elif v in self._variable_set or isinstance(v, (SharedVariable, Constant)):
+                self._computable[v] = True
+                stack.pop()
+            elif v.owner is None:
+                self._computable[v] = False
+                stack.pop()
+            else:
+                unknown_inputs = [inp for inp in v.owner.inputs if inp not in self._computable]
+                if len(unknown_inputs) > 0:
+                    stack.extend(unknown_inputs)
+                else:
+                    self._computable[v] = all(self._computable[inp] for inp in v.owner.inputs)
+                    stack.pop()
+        return self._computable[var]
+
+
+def _toposort_variables(outputs):
+    """
+    Iterative depth-first search through the ancestors of the outputs.
+    :param outputs: A list of variables
+    :return: A list of variables, with each variable appearing after all of its ancestors.
+    """
+    known = set()
+    ordered = []
+    stack = [(v, False) for v in reversed(outputs)]
+    while len(stack) > 0:
+        var, parents_done = stack.pop()
+        if parents_done:
+            ordered.append(var)
+        elif var not in known:
+            known.add(var)
+            stack.append((var, True))
+            if var.owner is not None:
+                stack.extend((inp, False) for inp in reversed(var.owner.inputs) if inp not in known)
+    return ordered
@@ -131,9 +131,9 @@ class SlowBatchNormalize(object):
 
     def __call__(self, x):
         # x should have
-        assert x.ishape[0]==1, "This method only works for minibatches of size 1, but you used a minibatch of size: %s" % (x.tag.test_value.shape[0])
-        running_mean = create_shared_variable(np.zeros(x.tag.test_value.shape[1:]))
-        running_mean_sq = create_shared_variable(np.zeros(x.tag.test_value.shape[1:]))
+        assert x.ishape[0]==1, "This method only works for minibatches of size 1, but you used a minibatch of size: %s" % (x.ishape[0])
+        running_mean = create_shared_variable(np.zeros(x.ishape[1:]))
+        running_mean_sq = create_shared_variable(np.zeros(x.ishape[1:]))
         new_running_mean = running_mean * self.decay_constant + x[0] * (1-self.decay_constant).astype(theano.config.floatX)
         new_running_mean_sq = running_mean_sq * self.decay_constant + (x[0]**2) * (1-self.decay_constant).astype(theano.config.floatX)
         add_update(running_mean, new_running_mean)
@@ -155,8 +155,8 @@ class SlowBatchCenter(object):
 
     def __call__(self, x):
         # x should have
-        assert x.ishape[0]==1, "This method only works for minibatches of size 1, but you used a minibatch of size: %s" % (x.tag.test_value.shape[0])
-        running_mean = create_shared_variable(np.zeros(x.tag.test_value.shape[1:]))
+        assert x.ishape[0]==1, "This method only works for minibatches of size 1, but you used a minibatch of size: %s" % (x.ishape[0])
+        running_mean = create_shared_variable(np.zeros(x.ishape[1:]))
         new_running_mean = running_mean * self.decay_constant + x[0] * (1-self.decay_constant).astype(theano.config.floatX)
         add_update(running_mean, new_running_mean)
         return x - running_mean
@@ -0,0 +1,64 @@
+import importlib
+import sys
+from types import ModuleType
+
+__author__ = 'peter'
+
+"""
+Modules whose attributes are only imported when they are first accessed.
+
+Facade modules like plato.tools.all import every model family, which means importing theano's convolution, scan,
+plotting, etc. even if you only need one of them.  A lazy module looks the same from outside, but each attribute is
+imported from its home module on first access.  Usage (at the end of the facade module):
+
+    install_lazy_module(__name__, {
+        'ConvNet': 'plato.tools.convnet.convnet',
+        'MultiLayerPerceptron': 'plato.tools.mlp.mlp',
+        })
+
+Now "from plato.tools.all import MultiLayerPerceptron" only imports plato.tools.mlp.mlp.  Note that
+"from plato.tools.all import *" still imports everything: the lazy attributes, and the module's own public names.
+"""
+
+
+class LazyModule(ModuleType):
+
+    def __init__(self, name, lazy_attributes, doc = None):
+        """
+        :param name: The module name
+        :param lazy_attributes: A dict<attribute_name: name of the module to import it from>
+        :param doc: The module docstring
+        """
+        ModuleType.__init__(self, name, doc)
+        self._lazy_attributes = lazy_attributes
+        self.__all__ = sorted(lazy_attributes.keys())
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails - i.e. for attributes that have not been imported yet.
+        if name.startswith('__') or name not in self._lazy_attributes:
+            raise AttributeError("Module '%s' has no attribute '%s'" % (self.__name__, name))
+        value = getattr(importlib.import_module(self._lazy_attributes[name]), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys()) | set(self._lazy_attributes.keys()))
+
+
+def install_lazy_module(name, lazy_attributes):
+    """
+    Replace a module (in sys.modules) with a LazyModule.  Call this from the module itself.  Anything that the module
+    has already defined remains available on the lazy module.
+
+    :param name: The name of the module (just pass __name__)
+    :param lazy_attributes: A dict<attribute_name: name of the module to import it from>
+    :return: The LazyModule
+    """
+    module = sys.modules[name]
+    lazy_module = LazyModule(name, lazy_attributes, doc = module.__doc__)
+    lazy_module.__dict__.update((k, v) for k, v in module.__dict__.iteritems() if k not in ('__doc__', '__all__'))
+    public_names = module.__all__ if hasattr(module, '__all__') else [k for k in module.__dict__ if not k.startswith('_')]
+    lazy_module.__all__ = sorted(set(public_names) | set(lazy_attributes.keys()))
+    lazy_module._original_module = module  # Keep the original alive - otherwise python 2 clears its globals.
+    sys.modules[name] = lazy_module
+    return lazy_module
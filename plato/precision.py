@@ -0,0 +1,177 @@
+from collections import namedtuple
+import os
+from plato.graph_index import GraphIndex
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof.graph import Constant
+import theano
+import theano.tensor as tt
+from theano.tensor.type import TensorType
+
+__author__ = 'peter'
+
+"""
+Detect (and optionally remove) float64 computation in graphs that are meant to run in floatX.
+
+When floatX is float32, a float64 can still sneak into a graph.  For example, an int64 shared variable times a float
+gives a float64, and a float64 numpy constant stays a float64.  Every op downstream is then upcast to float64, which
+halves CPU throughput and can force ops off the GPU, without any error.
+
+This module finds those ops in a compiled function and traces them back to where the float64 entered the graph (the
+line of code that created the upcasting expression, if theano recorded it).  AutoCompilingFunction applies it according
+to a precision policy:
+
+    'ignore': Don't check
+    'warn': Log a report of the float64 ops and their origins
+    'raise': Raise a PrecisionError with the report
+    'fix': Rewrite the graph before compiling: float64 constants become floatX constants, float64 shared variables and
+        inputs are cast to floatX where they are read, and integer inputs of upcasting elementwise ops are cast to
+        floatX.  Updates are cast back to the dtype of the shared variable they update.  Then warn about anything that
+        is still float64.
+
+Usage:
+
+    set_default_precision_policy('raise')  # For all functions
+    f = my_symbolic_function.compile(precision_policy = 'fix')  # For one function
+
+None of this does anything when floatX is float64.
+"""
+
+PRECISION_POLICIES = ('ignore', 'warn', 'raise', 'fix')
+_INTEGER_DTYPES = ('int32', 'int64', 'uint32', 'uint64')  # Integer types that upcast float32 to float64
+_THEANO_DIR = os.path.dirname(theano.__file__)
+
+
+class PrecisionError(Exception):
+    pass
+
+
+Float64Origin = namedtuple('Float64Origin', ['variable', 'reason', 'location'])
+
+
+def find_float64_nodes(compiled_fcn):
+    """
+    :param compiled_fcn: A compiled theano function
+    :return: A list of the apply nodes in the compiled graph that produce a float64 output, in the order they run.
+    """
+    if theano.config.floatX == 'float64':
+        return []
+    return [node for node in compiled_fcn.maker.fgraph.toposort() if any(_get_dtype(out) == 'float64' for out in node.outputs)]
+
+
+def find_float64_origins(variables):
+    """
+    Find the places where float64 enters a (pre-compilation) graph: float64 leaves (shared variables, inputs, and
+    constants), and ops that produce a float64 from inputs which are not float64.
+    :param variables: A list of symbolic variables
+    :return: A list of Float64Origin, in topological order.
+    """
+    if theano.config.floatX == 'float64':
+        return []
+    origins = []
+    for var in GraphIndex(variables).variables():
+        if _get_dtype(var) != 'float64':
+            continue
+        if var.owner is None:
+            reason = \
+                'float64 constant' if isinstance(var, Constant) else \
+                'float64 shared variable' if isinstance(var, SharedVariable) else \
+                'float64 input'
+            origins.append(Float64Origin(var, reason, _get_location(var)))
+        elif not any(_get_dtype(inp) == 'float64' for inp in var.owner.inputs):
+            reason = 'upcast from (%s)' % (', '.join(str(_get_dtype(inp)) for inp in var.owner.inputs), )
+            origins.append(Float64Origin(var, reason, _get_location(var)))
+    return origins
+
+
+def format_precision_report(name, float64_nodes, origins):
+    """
+    :param name: The name of the function
+    :param float64_nodes: The list of float64 apply nodes (see find_float64_nodes)
+    :param origins: The list of Float64Origins (see find_float64_origins)
+    :return: A string describing the float64 ops and where they came from.
+    """
+    lines = ['%s ops in the compiled form of %s run in float64 (floatX is %s):' % (len(float64_nodes), name, theano.config.floatX)]
+    lines += ['  %s' % (node, ) for node in float64_nodes]
+    if len(origins) > 0:
+        lines.append('float64 enters the graph at:')
+        lines += ['  %s: %s%s' % (origin.reason, origin.variable, '' if origin.location is None else ', at '+origin.location) for origin in origins]
+    return '\n'.join(lines)
+
+
+def demote_float64(variables, dtype = None):
+    """
+    Rebuild a graph so that it computes in dtype instead of float64 (see the 'fix' policy above).  The original graph is
+    not modified.
+    :param variables: A list of symbolic variables
+    :param dtype: The dtype to demote to.  Defaults to floatX.
+    :return: A list of the corresponding variables of the new graph.  Variables that are unaffected are returned as is.
+    """
+    if dtype is None:
+        dtype = theano.config.floatX
+    if dtype == 'float64':
+        return list(variables)
+    replacements = {}  # A dict<old_variable: new_variable>
+    rebuilt_nodes = set()
+    for var in GraphIndex(variables).variables():
+        if var.owner is None:
+            if _get_dtype(var) == 'float64' and isinstance(var.type, TensorType):
+                replacements[var] = tt.constant(var.data.astype(dtype), name = var.name) if isinstance(var, Constant) else tt.cast(var, dtype)
+            continue
+        node = var.owner
+        if node in rebuilt_nodes:
+            continue
+        rebuilt_nodes.add(node)
+        new_inputs = [replacements.get(inp, inp) for inp in node.inputs]
+        if isinstance(node.op, tt.Elemwise) and any(_get_dtype(out) == 'float64' for out in node.outputs) \
+                and not any(_get_dtype(inp) == 'float64' for inp in new_inputs):
+            new_inputs = [tt.cast(inp, dtype) if _get_dtype(inp) in _INTEGER_DTYPES else inp for inp in new_inputs]
+        if all(new is old for new, old in zip(new_inputs, node.inputs)):
+            continue
+        try:
+            new_node = node.op.make_node(*new_inputs)
+        except (TypeError, ValueError):
+            # The op insists on its original input types.
+            new_node = node.op.make_node(*[_cast_like(new, old) for new, old in zip(new_inputs, node.inputs)])
+        for old, new in zip(node.outputs, new_node.outputs):
+            if getattr(old.tag, 'trace', None) is not None:
+                new.tag.trace = old.tag.trace
+            replacements[old] = new
+    return [replacements.get(v, v) for v in variables]
+
+
+def _cast_like(new, old):
+    return tt.cast(new, old.dtype) if isinstance(new.type, TensorType) and new.type != old.type else new
+
+
+def _get_dtype(var):
+    return getattr(var.type, 'dtype', None)
+
+
+def _get_location(var):
+    """
+    :return: The "file:line: code" of the last line outside of theano that was executed when the variable was created,
+        or None if theano didn't record a trace (see theano.config.traceback.limit).
+    """
+    trace = getattr(var.tag, 'trace', None)
+    if not trace:
+        return None
+    for file_name, line_no, _, code in reversed(trace[-1]):
+        if not os.path.abspath(file_name).startswith(_THEANO_DIR):
+            return '%s:%s: %s' % (file_name, line_no, code)
+    return None
+
+
+_PRECISION_POLICY = 'ignore'
+
+
+def set_default_precision_policy(policy):
+    """
+    :param policy: The precision policy for functions compiled without one (see PRECISION_POLICIES)
+    """
+    assert policy in PRECISION_POLICIES, 'Policy must be one of %s.  You gave "%s"' % (PRECISION_POLICIES, policy)
+    global _PRECISION_POLICY
+    _PRECISION_POLICY = policy
+
+
+def get_default_precision_policy():
+    return _PRECISION_POLICY
@@ -0,0 +1,53 @@
+import logging
+import time
+from plato.core import symbolic
+import theano
+import theano.tensor as tt
+import numpy as np
+
+__author__ = 'peter'
+
+"""
+Measures the per-call overhead that plato adds on top of a compiled theano function.  The function here is tiny, so
+nearly all of the time is overhead.
+
+Results (CPU, floatX = float64, minibatch of 4x5 times 5x3):
+    Raw theano function (with input checking):  ~16us per call
+    fast_path = False:                          ~43us per call
+    fast_path = True:                           ~10us per call
+"""
+
+
+def profile_call_overhead(n_calls = 20000, minibatch_size = 4, n_in = 5, n_out = 3):
+
+    @symbolic
+    def linear(x, w):
+        return x.dot(w)
+
+    x = np.random.randn(minibatch_size, n_in).astype(theano.config.floatX)
+    w = np.random.randn(n_in, n_out).astype(theano.config.floatX)
+
+    x_sym = tt.matrix()
+    w_sym = tt.matrix()
+    functions = [
+        ('Raw theano function', theano.function([x_sym, w_sym], x_sym.dot(w_sym))),
+        ('fast_path = False', linear.compile(fast_path = False)),
+        ('fast_path = True', linear.compile(fast_path = True)),
+        ]
+
+    times = []
+    for name, f in functions:
+        f(x, w)  # Compile, and prime the fast path
+        f(x, w)
+        start_time = time.time()
+        for _ in xrange(n_calls):
+            f(x, w)
+        time_per_call = (time.time() - start_time)/n_calls
+        print '%s: %.3gus per call' % (name, time_per_call*1e6)
+        times.append((name, time_per_call))
+    return times
+
+
+if __name__ == '__main__':
+    logging.getLogger('plato').setLevel(logging.WARN)
+    profile_call_overhead()
@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+__author__ = 'peter'
+
+"""
+Measures the wall time of importing plato modules in a fresh python process, which is what CLI workers and test runs
+pay on startup.  Most of the time of importing plato.core is spent importing theano.
+
+Results (CPU, warm theano cache):
+    import theano:             ~0.95s
+    import plato.core:         ~1.05s  (was ~1.35s when theano's MRG random streams were imported eagerly)
+    import plato.all:          ~1.0s   (was ~1.65s when all model families were imported eagerly)
+    from plato.all import *:   ~1.55s
+"""
+
+STATEMENTS = [
+    'import theano',
+    'import plato.core',
+    'import plato.all',
+    'from plato.all import *',
+    ]
+
+
+def time_import(statement, n_repeats = 5):
+    """
+    :param statement: A python statement, e.g. "import plato.core"
+    :param n_repeats: Number of fresh processes to time it in.
+    :return: The median wall time (in seconds) of running a python process that just executes the statement.
+    """
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([p for p in sys.path if p]))
+    times = []
+    for _ in xrange(n_repeats):
+        start_time = time.time()
+        subprocess.check_call([sys.executable, '-c', statement], env = env)
+        times.append(time.time() - start_time)
+    return np.median(times)
+
+
+def profile_import_time(statements = STATEMENTS, n_repeats = 5):
+    times = []
+    for statement in statements:
+        t = time_import(statement, n_repeats = n_repeats)
+        print '%s: %.3gs' % (statement, t)
+        times.append((statement, t))
+    return times
+
+
+if __name__ == '__main__':
+    profile_import_time()
@@ -0,0 +1,203 @@
+from theano.compile import ops
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof.graph import Constant, Variable
+import theano.tensor as tt
+import numpy as np
+import sys
+
+__author__ = 'peter'
+
+"""
+Static shape inference for symbolic variables.
+
+Test values (add_test_values=True) let you inspect the shapes of intermediate variables while building a graph, but
+they do so by actually computing every intermediate value, which can be extremely slow for big models (the first pass
+of VGG takes minutes with test values on).  Usually we only want the shapes.
+
+This module answers shape questions by abstract interpretation of the graph: each variable is given either a
+concrete value (for small things like shapes, indices, and scalar constants, which are cheap to compute), or just a
+shape (for everything else).  Shapes of op outputs are derived using the ops' own infer_shape methods, whose symbolic
+output is then evaluated on the concrete values.
+
+Input tensors created by AutoCompilingFunction carry their shape in tag.test_shape, so Variable.ishape works during
+the first pass regardless of whether test values are on.
+"""
+
+
+# Arrays with at most this many elements are tracked as concrete values.  Anything bigger is tracked by shape only.
+MAX_CONCRETE_SIZE = 64
+
+
+class ShapeInferenceError(Exception):
+    pass
+
+
+class _ShapeOnly(object):
+    """
+    The abstract value of a variable whose shape, but not value, is known.
+    """
+    def __init__(self, shape):
+        self.shape = tuple(int(d) for d in shape)
+
+
+class _Unknown(object):
+    """
+    The abstract value of a variable whose shape could not be inferred.
+    """
+    def __init__(self, reason):
+        self.reason = reason
+
+
+def infer_shape(var):
+    """
+    Infer the shape that a variable will have, given the shapes of the inputs to its graph.
+
+    :param var: A theano variable
+    :return: A tuple of ints
+    """
+    value = _get_abstract_value(var)
+    if isinstance(value, _Unknown):
+        raise ShapeInferenceError('Could not infer the shape of %s: %s.  Compile with add_test_values=True to get '
+            'shapes from test values instead.' % (var, value.reason))
+    return tuple(int(d) for d in value.shape)
+
+
+def _get_abstract_value(var):
+    """
+    Evaluate the abstract value of a variable, walking back through the graph until we hit variables whose abstract
+    values are known.  Results are memoized in the variables' tags, except for those that depend on shared variables,
+    whose values (and so shapes) can change with set_value.
+    """
+    shared_dependent_values = {}  # Values of shared variables and of anything computed from them, for this evaluation only.
+
+    def get_memo(v):
+        return shared_dependent_values[v] if v in shared_dependent_values else getattr(v.tag, 'abstract_value', None)
+
+    stack = [var]
+    while len(stack) > 0:
+        v = stack[-1]
+        if get_memo(v) is not None:
+            stack.pop()
+        elif v.owner is None:
+            value = _get_leaf_value(v)
+            if isinstance(v, SharedVariable):
+                shared_dependent_values[v] = value
+            else:
+                v.tag.abstract_value = value
+            stack.pop()
+        else:
+            input_values = [get_memo(inp) for inp in v.owner.inputs]
+            if any(iv is None for iv in input_values):
+                stack.extend(inp for inp, iv in zip(v.owner.inputs, input_values) if iv is None)
+            else:
+                depends_on_shared = any(inp in shared_dependent_values for inp in v.owner.inputs)
+                for out, out_value in zip(v.owner.outputs, _evaluate_node(v.owner, input_values)):
+                    if depends_on_shared:
+                        shared_dependent_values[out] = out_value
+                    else:
+                        out.tag.abstract_value = out_value
+                stack.pop()
+    return get_memo(var)
+
+
+def _get_leaf_value(var):
+    if isinstance(var, SharedVariable):
+        return _to_abstract(var.get_value(borrow=True))
+    elif isinstance(var, Constant):
+        return _to_abstract(var.data)
+    elif hasattr(var.tag, 'test_value'):
+        return _to_abstract(var.tag.test_value)
+    elif hasattr(var.tag, 'test_shape'):
+        return _ShapeOnly(var.tag.test_shape)
+    else:
+        return _Unknown('%s is an input with no known shape' % (var, ))
+
+
+def _to_abstract(value):
+    if isinstance(value, np.ndarray) and value.size <= MAX_CONCRETE_SIZE:
+        return value
+    elif np.isscalar(value):
+        return np.array(value)
+    elif hasattr(value, 'shape'):
+        return _ShapeOnly(value.shape)
+    else:
+        return _Unknown('%s is not an array' % (type(value).__name__, ))
+
+
+def _evaluate_node(node, input_values):
+    """
+    :param node: An Apply node
+    :param input_values: The abstract values of the node's inputs
+    :return: A list of abstract values for the outputs of the node.
+    """
+    if isinstance(node.op, ops.Shape):
+        if isinstance(input_values[0], _Unknown):
+            return [input_values[0]]
+        return [np.array(input_values[0].shape, dtype='int64')]
+    elif isinstance(node.op, ops.Shape_i):
+        if isinstance(input_values[0], _Unknown):
+            return [input_values[0]]
+        return [np.array(input_values[0].shape[node.op.i], dtype='int64')]
+
+    elif _is_mrg_uniform(node.op):
+        # MRG random ops don't implement infer_shape.  They return (new_rstate, flat_sample_of_the_given_size).
+        if not isinstance(input_values[1], np.ndarray):
+            return [_Unknown('the size of random sample %s is not known' % (node.outputs[1], ))]*2
+        return [input_values[0], _ShapeOnly((np.prod(input_values[1]), ))]
+
+    if all(isinstance(v, np.ndarray) for v in input_values):
+        # All inputs are small and known, so just compute the outputs.
+        output_storage = [[None] for _ in node.outputs]
+        try:
+            node.op.perform(node, [np.asarray(v, dtype=inp.dtype) for v, inp in zip(input_values, node.inputs)], output_storage)
+            return [_to_abstract(s[0]) for s in output_storage]
+        except Exception:
+            pass  # Fall back on shape inference.
+
+    unknown = [v for v in input_values if isinstance(v, _Unknown)]
+    if len(unknown) > 0:
+        return [unknown[0]]*len(node.outputs)
+
+    if not hasattr(node.op, 'infer_shape'):
+        return [_Unknown('op %s does not implement infer_shape' % (node.op, ))]*len(node.outputs)
+    input_shapes = [tuple(tt.constant(d, dtype='int64') for d in v.shape) if isinstance(inp.type, tt.TensorType) else None
+        for inp, v in zip(node.inputs, input_values)]
+    try:
+        output_shapes = node.op.infer_shape(node, input_shapes)
+    except Exception as err:
+        return [_Unknown('infer_shape of op %s failed with %s: %s' % (node.op, type(err).__name__, err))]*len(node.outputs)
+
+    output_values = []
+    for out, shape in zip(node.outputs, output_shapes):
+        if shape is None:
+            output_values.append(_Unknown('op %s gave no shape for output %s' % (node.op, out)))
+            continue
+        dims = [_evaluate_scalar(d) for d in shape]
+        missing = [d for d in dims if isinstance(d, _Unknown)]
+        output_values.append(missing[0] if len(missing) > 0 else _ShapeOnly(dims))
+    return output_values
+
+
+def _evaluate_scalar(dim):
+    """
+    Evaluate one element of a shape returned by infer_shape.  This is a (usually tiny) symbolic expression of the
+    node's inputs and the constant input shapes.
+    """
+    if not isinstance(dim, Variable):
+        return int(dim)
+    value = _get_abstract_value(dim)
+    if isinstance(value, np.ndarray):
+        return int(value)
+    elif isinstance(value, _Unknown):
+        return value
+    else:
+        return _Unknown('the shape depends on the values in %s, which are not known' % (dim, ))
+
+
+def _is_mrg_uniform(op):
+    """
+    theano.sandbox.rng_mrg is slow to import, and if it hasn't been imported, there can't be any MRG random ops in the
+    graph - so we don't import it just to check.
+    """
+    rng_mrg = sys.modules.get('theano.sandbox.rng_mrg')
+    return rng_mrg is not None and isinstance(op, rng_mrg.mrg_uniform_base)
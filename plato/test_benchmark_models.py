@@ -0,0 +1,32 @@
+from plato.benchmark_models import run_model_benchmarks, save_benchmark_results, load_benchmark_results, \
+    compare_to_baseline, format_regressions
+import os
+import tempfile
+
+__author__ = 'peter'
+
+
+def test_benchmark_models():
+
+    results = run_model_benchmarks(families = ['mlp', 'rbm'], minibatch_sizes = [4], floatxs = ['float32'], min_time = 0.05)
+    assert [(r['family'], r['minibatch_size'], r['floatx']) for r in results] == [('mlp', 4, 'float32'), ('rbm', 4, 'float32')]
+    for r in results:
+        assert r['train_samples_per_sec'] > 0 and r['predict_samples_per_sec'] > 0
+        assert r['train_compile_time'] > 0 and r['train_first_pass_time'] > 0
+        assert r['peak_rss_mb'] > 10
+
+    path = os.path.join(tempfile.mkdtemp(), 'results.json')
+    save_benchmark_results(results, path)
+    assert load_benchmark_results(path) == results
+    assert compare_to_baseline(results, load_benchmark_results(path)) == []
+
+    faster_baseline = [dict(r, train_samples_per_sec = 2*r['train_samples_per_sec']) for r in results]
+    regressions = compare_to_baseline(results, faster_baseline)
+    assert [(r.case, r.metric) for r in regressions] == [('mlp/minibatch=4/float32', 'train_samples_per_sec'), ('rbm/minibatch=4/float32', 'train_samples_per_sec')]
+    assert all(abs(r.change + 0.5) < 1e-9 for r in regressions)
+    assert '2 regressions' in format_regressions(regressions)
+    assert compare_to_baseline(results, faster_baseline, thresholds = {'train_samples_per_sec': 0.6}) == []
+
+
+if __name__ == '__main__':
+    test_benchmark_models()
@@ -0,0 +1,100 @@
+from contextlib import contextmanager
+import shutil
+import tempfile
+from plato.compilation_cache import CompiledFunctionCache, get_graph_key
+from plato.core import symbolic, add_update, create_shared_variable
+import theano.tensor as tt
+import numpy as np
+import theano
+
+__author__ = 'peter'
+
+
+class Accumulator(object):
+
+    def __init__(self, initial_value):
+        self.total = create_shared_variable(initial_value, name = 'total')
+
+    @symbolic
+    def add(self, x):
+        new_total = self.total + (x*2).sum()
+        add_update(self.total, new_total)
+        return new_total
+
+
+@contextmanager
+def _forbid_compilation():
+    old_function = theano.function
+
+    def compile_function(*args, **kwargs):
+        raise AssertionError('Function should have been loaded from the cache, not compiled.')
+
+    theano.function = compile_function
+    try:
+        yield
+    finally:
+        theano.function = old_function
+
+
+def test_graph_key():
+
+    def build_graph(dtype, name = None):
+        x = tt.TensorType(dtype, (False, ))('x')
+        w = create_shared_variable(np.random.randn(3), name = name)
+        return [x], [(x*w).sum()], [(w, w+x)]
+
+    key_1, shared_1 = get_graph_key(*build_graph('float64'))
+    key_2, shared_2 = get_graph_key(*build_graph('float64'))
+    key_3, _ = get_graph_key(*build_graph('int32'))
+    key_4, _ = get_graph_key(*build_graph('float64', name = 'w_7'))
+    assert key_1 == key_2  # Graphs are structurally identical, even though shared variables differ.
+    assert key_1 != key_3  # Input signature differs.
+    assert key_1 == key_4  # Names of shared variables don't matter
+    assert len(shared_1) == len(shared_2) == 1 and shared_1[0] is not shared_2[0]
+
+
+def test_compilation_cache():
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = CompiledFunctionCache(directory=cache_dir)
+
+        acc_1 = Accumulator(0.)
+        f1 = acc_1.add.compile(persistent_cache=cache)
+        assert f1(np.array([1., 2.])) == 6.
+        assert len(cache.entries()) == 1
+        assert (cache.n_hits, cache.n_misses) == (0, 1)
+
+        # A new graph with the same structure should be loaded from the cache (without calling theano.function), and
+        # bound to the new shared variable.
+        acc_2 = Accumulator(100.)
+        f2 = acc_2.add.compile(persistent_cache=cache)
+        with _forbid_compilation():
+            assert f2(np.array([1., 2.])) == 106.
+        assert (cache.n_hits, cache.n_misses) == (1, 1)
+        assert f2(np.array([1., 2.])) == 112.
+        assert acc_2.total.get_value() == 112.
+        assert acc_1.total.get_value() == 6.
+        assert len(cache.entries()) == 1
+
+        # A different input signature gets a different entry
+        f3 = Accumulator(0.).add.compile(persistent_cache=cache)
+        f3(np.array([[1., 2.]]))
+        assert len(cache.entries()) == 2
+        assert (cache.n_hits, cache.n_misses) == (1, 2)
+
+        # Eviction and invalidation
+        cache.max_size = max(s for _, s, _ in cache.entries())
+        cache.evict()
+        assert len(cache.entries()) == 1
+        cache.clear()
+        assert len(cache.entries()) == 0
+        f4 = Accumulator(3.).add.compile(persistent_cache=cache)
+        assert f4(np.array([1., 2.])) == 9.
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    test_graph_key()
+    test_compilation_cache()
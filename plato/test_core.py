@@ -3,11 +3,21 @@ from plato.interfaces.helpers import create_shared_variable
 from pytest import raises
 from plato.core import symbolic_simple, symbolic_updater, SymbolicFormatError, \
     tdb_trace, get_tdb_traces, symbolic, set_enable_omniscence, EnableOmniscence, clear_tdb_traces, add_update, \
-    symbolic_multi, symbolic_stateless, create_shared_variable
+    symbolic_multi, symbolic_stateless, create_shared_variable, get_metrics_registry, StateCatcher, \
+    AccumulateUpdates
+from multiprocessing.pool import ThreadPool
+import plato.core
+from plato.shape_inference import ShapeInferenceError
+import gc
+import threading
 import pytest
 import theano
 import theano.tensor as tt
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 import numpy as np
+import json
+import os
+import tempfile
 
 __author__ = 'peter'
 
@@ -249,6 +259,33 @@ def test_omniscence():
             assert average_fcn.locals()['sum_a_b'] == 9
 
 
+def test_sampled_omniscence():
+    """
+    With capture_locals_every=N, locals are only returned (and copied out) on every Nth call, or when requested.
+    """
+
+    @symbolic_simple
+    def average(a, b):
+        sum_a_b = a+b
+        return sum_a_b/2.
+
+    with EnableOmniscence():
+        average_fcn = average.compile(capture_locals_every = 3)
+        assert average_fcn(3, 6) == 4.5
+        assert average_fcn.locals()['sum_a_b'] == 9  # First call is captured
+        variant, = average_fcn._variants.values()
+        assert variant.compiled_fcn is not variant.instrumented_fcn
+        assert average_fcn(1, 2) == 1.5
+        assert average_fcn.locals()['sum_a_b'] == 9  # Not captured: we still see the old value
+        average_fcn.capture_locals_next_call()
+        assert average_fcn(1, 2) == 1.5
+        assert average_fcn.locals()['sum_a_b'] == 3
+        assert average_fcn(2, 2) == 2
+        assert average_fcn.locals()['sum_a_b'] == 4  # 4th call is captured
+        assert average_fcn(3, 2) == 2.5
+        assert average_fcn.locals()['sum_a_b'] == 4
+
+
 def test_method_caching_bug():
     """
     Previously there was a bug in BaseSymbolicFunction.__get__ where dispatched
@@ -512,6 +549,408 @@ def test_named_outputs_with_trace():
     assert np.allclose(get_tdb_traces()['tan(x)'], np.tan(x))
 
 
+def test_multi_signature_dispatch():
+
+    @symbolic
+    def sum_of_squares(x):
+        return (x**2).sum()
+
+    f = sum_of_squares.compile(cast_to_floatx=None, max_variants=2)
+    assert f(np.array([1., 2.])) == 5
+    assert f(np.array([[1., 2.], [3., 4.]])) == 30  # Different ndim: compiles a new variant
+    assert f(np.array([1, 2], dtype='int32')) == 5  # Different dtype: compiles a new variant, evicting the vector one
+    assert f(np.array([3., 4.])) == 25  # Vector variant must be recompiled
+    assert f(np.array([5, 6], dtype='int32')) == 61
+    stats = f.get_dispatch_stats()
+    assert stats['n_variants'] == 2
+    assert stats['n_misses'] == 4
+    assert stats['n_hits'] == 1
+
+
+def test_variants_share_created_state():
+
+    @symbolic
+    def count_calls(x):
+        n_calls = theano.shared(np.array(0, dtype='int64'), name='n_calls')
+        add_update(n_calls, n_calls+1)
+        return n_calls + 1 + tt.cast(x.sum()*0, 'int64')
+
+    f = count_calls.compile(cast_to_floatx=None, max_variants=1)
+    assert f(np.zeros(2)) == 1
+    assert f(np.zeros(2, dtype='int32')) == 2  # A new variant (evicting the last one) updates the same counter
+    assert f(np.zeros(2)) == 3  # And so does the recompiled one
+    assert f(np.zeros((2, 2))) == 4
+    assert f.get_dispatch_stats()['n_misses'] == 4
+
+    @symbolic
+    def running_sum(x):
+        total = theano.shared(np.zeros(x.ishape), name='total')  # The shape depends on the input
+        add_update(total, total+x)
+        return total+x
+
+    f = running_sum.compile(cast_to_floatx=None, max_variants=1)
+    assert np.array_equal(f(np.ones(2)), [1, 1])
+    assert np.array_equal(f(np.ones((2, 2))), [[1, 1], [1, 1]])  # A different shape gets its own total
+    assert np.array_equal(f(np.ones(2)), [2, 2])
+
+
+def test_get_state_variables():
+
+    rng = MRG_RandomStreams(1234)
+    w = theano.shared(np.zeros(3), name = 'w')
+
+    @symbolic
+    def noisy_step(x):
+        add_update(w, w + x + rng.uniform(size = (3, ), nstreams = 3))
+
+    f = noisy_step.compile()
+    f(np.zeros(3))
+    w_state, rng_state = f.get_state_variables()  # The random stream's state is updated through its default_update
+    assert w_state is w
+    assert rng_state.default_update is not None and rng_state.get_value().shape == (3, 6)
+
+
+def test_precompile_and_compile_async():
+
+    @symbolic
+    def add_one(x):
+        return x+1
+
+    f = add_one.compile()
+    f.precompile(np.zeros(3))
+    assert f.get_dispatch_stats()['n_misses'] == 1
+    assert np.array_equal(f(np.arange(3.)), [1, 2, 3])
+    assert f.get_dispatch_stats()['n_misses'] == 1
+
+    compilation = f.compile_async(np.zeros((2, 2)))
+    assert compilation.get() is f
+    assert np.array_equal(f(np.ones((2, 2))), 2*np.ones((2, 2)))
+    stats = f.get_dispatch_stats()
+    assert stats['n_misses'] == 2 and stats['n_variants'] == 2
+
+
+def test_fast_path():
+
+    @symbolic
+    class Accumulator(object):
+
+        def __init__(self):
+            self.total = theano.shared(np.zeros(3, dtype=theano.config.floatX))
+
+        def __call__(self, x):
+            add_update(self.total, self.total+x)
+            return {'total': self.total+x, 'double': 2*x}
+
+    x = np.array([1., 2., 3.], dtype=theano.config.floatX)
+    acc = Accumulator()
+    f = acc.compile()
+    slow_out = f(x)
+    assert f.get_dispatch_stats()['n_fast_calls'] == 0
+    out = f(x)  # Fast path
+    assert f.get_dispatch_stats()['n_fast_calls'] == 1
+    assert out.keys() == slow_out.keys()
+    assert np.array_equal(out['total'], 2*x) and np.array_equal(out['double'], 2*x)
+    assert np.array_equal(acc.total.get_value(), 2*x)
+
+    # Arguments whose dtypes don't match exactly take the full path, which converts them, even for a variant that has
+    # been called on the fast path.
+    other_dtype = 'float32' if theano.config.floatX == 'float64' else 'float64'
+    out = f(x.astype(other_dtype))
+    assert np.allclose(out['total'], 3*x)
+    assert f.get_dispatch_stats()['n_fast_calls'] == 1
+
+    f.add_callback(lambda: None)
+    f(x)
+    f(x)
+    assert f.get_dispatch_stats()['n_fast_calls'] == 1  # Callbacks need the full call path
+    assert np.allclose(acc.total.get_value(), 5*x)
+
+
+def test_shape_inference():
+    """
+    ishape is answered by static shape inference when there are no test values, so shape-dependent graph construction
+    doesn't require a numeric first pass.
+    """
+    rng = MRG_RandomStreams(seed = 1234)
+
+    @symbolic
+    def noisy_layer(x, w):
+        assert not hasattr(x.tag, 'test_value')
+        h = tt.tanh(x.dot(w))
+        assert h.ishape == (3, 5)
+        assert h.reshape((h.shape[0]*5, -1)).ishape == (15, 1)
+        assert h[1:, ::2].ishape == (2, 3)
+        assert tt.concatenate([h, h.T.dot(h)], axis=0).ishape == (8, 5)
+        assert h.sum(axis=0).dimshuffle('x', 0).ishape == (1, 5)
+        return h + rng.normal(size = h.ishape)
+
+    f = noisy_layer.compile(add_test_values = False)
+    assert f(np.random.randn(3, 4), np.random.randn(4, 5)).shape == (3, 5)
+
+    # Shapes computed from shared variables are not remembered, because set_value can change them.
+    w = theano.shared(np.zeros((4, 5)))
+    x = tt.matrix()
+    x.tag.test_shape = (3, 4)
+    h = x.dot(w)
+    assert h.ishape == (3, 5)
+    w.set_value(np.zeros((4, 6)))
+    assert h.ishape == (3, 6)
+    assert x.T.ishape == (4, 3)
+
+    # Static inference is used even where there are test values, which are only used where it fails.
+    h.tag.test_value = np.zeros((7, 7))
+    assert h.ishape == (3, 6)
+    z = tt.matrix()
+    z.tag.test_value = np.zeros((2, 3))
+    assert z.T.ishape == (3, 2)
+    with pytest.raises(ShapeInferenceError):
+        tt.matrix().T.ishape
+
+
+def test_metrics():
+
+    @symbolic
+    def linear(x, w):
+        return x.dot(w)
+
+    f = linear.compile()
+    x = np.random.randn(4, 5).astype(theano.config.floatX)
+    w = np.random.randn(5, 3).astype(theano.config.floatX)
+    for _ in xrange(50):  # Most of these go through the fast path
+        f(x, w)
+
+    metrics = f.metrics
+    assert metrics is get_metrics_registry().get(linear)
+    assert metrics.n_compilations == 1
+    assert metrics.n_nodes > 0
+    assert metrics.first_pass_time > 0 and metrics.compile_time > 0
+    assert metrics.n_calls == 50
+    assert metrics.bytes_in == 50*(x.nbytes+w.nbytes)
+    assert metrics.bytes_out == 50*x.dot(w).nbytes
+    percentiles = metrics.get_latency_percentiles((50, 99))
+    assert 0 < percentiles[50] <= percentiles[99]
+    assert metrics in get_metrics_registry().get_all(sort_by='total_call_time')
+
+    _, path = tempfile.mkstemp(suffix='.json')
+    try:
+        get_metrics_registry().dump_json(path)
+        with open(path) as fp:
+            dumped = json.load(fp)
+        assert dumped[linear.fcn_str()]['n_calls'] == 50
+    finally:
+        os.remove(path)
+
+    # Metrics are kept by function, not by name, and are dropped along with the function.
+    @symbolic
+    def linear(x, w):
+        return x.dot(w)
+
+    other_metrics = get_metrics_registry().get(linear)
+    assert other_metrics is not metrics
+    del f, linear
+    gc.collect()
+    assert metrics not in get_metrics_registry().get_all() and other_metrics not in get_metrics_registry().get_all()
+
+
+def test_map():
+
+    rng = np.random.RandomState(1234)
+    w = create_shared_variable(rng.randn(5, 3))
+
+    @symbolic
+    def layer(x):
+        return tt.tanh(x.dot(w))
+
+    @symbolic
+    def scale_and_shift(x, y):
+        return x*y[:, None], x+y[:, None]
+
+    x = rng.randn(1000, 5).astype(theano.config.floatX)
+    y = rng.randn(1000).astype(theano.config.floatX)
+    atol = 1e-5 if theano.config.floatX == 'float32' else 1e-8
+
+    f = layer.compile()
+    expected = np.tanh(x.dot(w.get_value()))
+    assert np.allclose(f.map(x, chunk_size=64), expected, atol=atol)
+    out = np.empty((1000, 3), dtype=theano.config.floatX)
+    assert f.map(x, chunk_size=128, out=out, pipeline=True) is out
+    assert np.allclose(out, expected, atol=atol)
+    assert f.map(x[:0], chunk_size=64).shape == (0, 3)
+
+    scaled, shifted = scale_and_shift.compile().map((x, y), chunk_size=300, pipeline=True)
+    assert np.allclose(scaled, x*y[:, None], atol=atol) and np.allclose(shifted, x+y[:, None], atol=atol)
+
+
+def test_accumulate_updates():
+
+    w = create_shared_variable(np.zeros(3))
+
+    @symbolic
+    def multi_objective_step(x):
+        with AccumulateUpdates():
+            add_update(w, w+x)
+            add_update(w, w-2*x)
+            add_update(w, 3*w)  # Not of the form w+delta
+        return w.sum()
+
+    with StateCatcher(swallow_updates=True) as sc:
+        multi_objective_step(tt.vector('x'))
+    (shared_var, new_val), = sc.get_updates()
+    assert shared_var is w and sc.n_merged_updates == 2
+    assert new_val.owner.inputs[0] is w  # Fused into w + dx1 + dx2 + dx3
+
+    f = multi_objective_step.compile()
+    w.set_value(np.ones(3))
+    x = np.arange(3).astype(theano.config.floatX)
+    f(x)
+    assert np.allclose(w.get_value(), 1+x-2*x+2*1)
+
+    with raises(AssertionError):
+        with StateCatcher(swallow_updates=True):
+            add_update(w, w+1)
+            add_update(w, w+2)
+
+
+def test_compile_modes():
+
+    w = create_shared_variable(np.zeros(3))
+
+    @symbolic
+    def step(x):
+        add_update(w, w+x)
+        return (w+x).sum()
+
+    m = create_shared_variable(np.eye(3)*0.9)
+
+    @symbolic
+    def long_chain(x):
+        for _ in xrange(60):
+            x = tt.tanh(x.dot(m))+0.1
+        return x
+
+    x = np.arange(3).astype(theano.config.floatX)
+    for mode in ('fast_run', 'fast_compile', 'interpreted'):
+        w.set_value(np.zeros(3))
+        f = step.compile(mode=mode)
+        assert f(x) == 3
+        assert f(x) == 6
+        assert np.array_equal(w.get_value(), 2*x)
+        variant, = f._variants.values()
+        assert variant.mode == mode
+
+    # Small graphs (and those we expect to call many times) are fully optimized from the start
+    f = step.compile(mode='auto')
+    f(x)
+    assert f._variants.values()[0].mode == 'fast_run'
+    f = long_chain.compile(mode='auto', expected_calls=1000)
+    f(x)
+    assert f._variants.values()[0].mode == 'fast_run'
+
+    # Large graphs start with light optimization, and are recompiled after enough calls.
+    f = long_chain.compile(mode='auto', recompile_after=3)
+    expected = f(x)
+    variant, = f._variants.values()
+    assert variant.mode == 'fast_compile'
+    assert np.allclose(f(x), expected)
+    assert np.allclose(f(x), expected)
+    f.wait_until_recompiled()
+    assert variant.mode == 'fast_run' and variant.graph is None
+    assert np.allclose(f(x), expected)
+    n_fast_calls = f.get_dispatch_stats()['n_fast_calls']
+    assert np.allclose(f(x), expected)
+    assert f.get_dispatch_stats()['n_fast_calls'] == n_fast_calls + 1  # Now that it's fully optimized, it can take the fast path
+
+    # The graph is only indexed once per compilation, for both the traces and the node count.
+    @symbolic
+    def traced_chain(x):
+        y = long_chain(x)
+        tdb_trace(y, name = 'y')
+        return y
+
+    graph_index_class = plato.core.GraphIndex
+    n_graph_indices = []
+
+    class CountingGraphIndex(graph_index_class):
+        def __init__(self, outputs):
+            n_graph_indices.append(1)
+            graph_index_class.__init__(self, outputs)
+
+    plato.core.GraphIndex = CountingGraphIndex
+    try:
+        traced_chain.compile(mode='auto').precompile(x)
+    finally:
+        plato.core.GraphIndex = graph_index_class
+        clear_tdb_traces()
+    assert len(n_graph_indices) == 1
+
+    with raises(AssertionError):
+        step.compile(mode='fast_as_possible')
+
+
+def test_thread_local_state():
+
+    # A StateCatcher in one thread does not catch updates from another
+    w = create_shared_variable(0.)
+    errors = []
+
+    def add_update_in_other_thread():
+        try:
+            add_update(w, w+1)
+        except AssertionError:
+            errors.append('No state catcher in this thread')
+
+    with StateCatcher(swallow_updates=True) as sc:
+        thread = threading.Thread(target=add_update_in_other_thread)
+        thread.start()
+        thread.join()
+    assert sc.get_updates() == [] and len(errors) == 1
+
+    # Functions can be built and compiled in parallel, each with its own updates and traces.
+    def build_and_run(i):
+        counter = create_shared_variable(0.)
+
+        @symbolic
+        def count_and_scale(x):
+            add_update(counter, counter+1)
+            y = x*i
+            tdb_trace(y, name = 'y_%s' % (i, ))
+            return y
+
+        f = count_and_scale.compile(add_test_values = i % 2 == 0)
+        out = [f(np.arange(3.)) for _ in xrange(3)][-1]
+        return out, counter.get_value(), len(f._variants.values()[0].trace_variable_keys)
+
+    results = ThreadPool(processes=4).map(build_and_run, range(8))
+    clear_tdb_traces()
+    for i, (out, count, n_traces) in enumerate(results):
+        assert np.allclose(out, np.arange(3.)*i)
+        assert count == 3
+        assert n_traces == 1  # Only this function's own trace
+
+    # compile_async compiles in the calling thread's state, as precompile would.
+    @symbolic
+    def double_step(x):
+        add_update(w, w+x)
+        add_update(w, w+x)
+        return x
+
+    with AccumulateUpdates():
+        f = double_step.compile().compile_async(1.).get()
+    w.set_value(0.)
+    f(1.)
+    assert w.get_value() == 2
+
+    @symbolic
+    def square(x):
+        y = x*x
+        return y
+
+    with EnableOmniscence():
+        f = square.compile().compile_async(1.).get()
+    f(3.)
+    assert f.locals()['y'] == 9
+
+
 if __name__ == '__main__':
 
     test_ival_ishape()
@@ -520,6 +959,7 @@ if __name__ == '__main__':
     test_scan()
     test_strrep()
     test_omniscence()
+    test_sampled_omniscence()
     test_named_arguments()
     test_stateless_symbolic_function()
     test_stateful_symbolic_function()
@@ -532,3 +972,14 @@ if __name__ == '__main__':
     test_dual_decoration()
     test_named_outputs()
     test_named_outputs_with_trace()
+    test_multi_signature_dispatch()
+    test_variants_share_created_state()
+    test_get_state_variables()
+    test_precompile_and_compile_async()
+    test_fast_path()
+    test_shape_inference()
+    test_metrics()
+    test_map()
+    test_accumulate_updates()
+    test_compile_modes()
+    test_thread_local_state()
@@ -0,0 +1,65 @@
+from plato.core import symbolic
+from plato.fused_functions import FusedSymbolicFunction
+from plato.tools.optimization.optimizers import SimpleGradientDescent
+from plato.tools.regressors.online_regressor import OnlineRegressor
+import numpy as np
+
+__author__ = 'peter'
+
+
+def _n_nodes(compiled_fcn):
+    variant, = compiled_fcn._variants.values()
+    return len(variant.compiled_fcn.maker.fgraph.apply_nodes)
+
+
+def test_fused_functions():
+
+    rng = np.random.RandomState(1234)
+    x = rng.randn(10, 4)
+    y = rng.randn(10, 3)
+
+    predictor = OnlineRegressor(input_size=4, output_size=3, regressor_type='linear', optimizer=SimpleGradientDescent(eta=0.1))
+    predictor.w.set_value(rng.randn(4, 3))
+
+    @symbolic
+    def cost(x, y):
+        return ((predictor.predict(x)-y)**2).sum(axis=1).mean()
+
+    fused = FusedSymbolicFunction([
+        ('train', predictor.train, ['x', 'y']),
+        ('predict', predictor.predict, ['x']),
+        ('cost', cost, ['x', 'y']),
+        ])
+    assert fused.get_input_names() == ['x', 'y']
+    assert fused.get_input_names('predict') == ['x']
+
+    predict = fused.compile('predict')
+    train = predictor.train.compile()
+    train_and_report = fused.compile()
+
+    w_before, b_before = predictor.w.get_value(), predictor.b.get_value()
+    expected_predictions = predict(x)['predict']
+    out = train_and_report(x=x, y=y)
+    assert out.keys() == ['predict', 'cost']
+    assert np.allclose(out['predict'], expected_predictions)  # Outputs are computed before updates are applied
+    assert np.allclose(out['cost'], ((expected_predictions-y)**2).sum(axis=1).mean())
+    w_after_fused_step = predictor.w.get_value()
+    assert not np.allclose(w_after_fused_step, w_before)
+
+    # The fused step should do the same update as the ordinary training function
+    predictor.w.set_value(w_before)
+    predictor.b.set_value(b_before)
+    train(x, y)
+    assert np.allclose(predictor.w.get_value(), w_after_fused_step)
+
+    # Positional arguments follow the order of first appearance
+    assert np.allclose(fused.compile('cost', 'predict')(x, y)['predict'], predict(x)['predict'])
+
+    # The forward pass is shared, so the fused graph is smaller than the separate graphs put together
+    train_and_predict = fused.compile('train', 'predict')
+    train_and_predict(x, y)
+    assert _n_nodes(train_and_predict) < _n_nodes(train) + _n_nodes(predict)
+
+
+if __name__ == '__main__':
+    test_fused_functions()
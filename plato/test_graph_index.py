@@ -0,0 +1,45 @@
+from plato.core import create_shared_variable, find_shared_ancestors
+from plato.graph_index import GraphIndex
+import theano.tensor as tt
+import numpy as np
+
+__author__ = 'peter'
+
+
+def test_graph_index():
+
+    x = tt.matrix('x')
+    y = tt.matrix('y')
+    w = create_shared_variable(np.random.randn(3, 4), name = 'w')
+    b = create_shared_variable(np.zeros(4), name = 'b')
+    h = tt.tanh(x.dot(w)+b)
+    out = h.sum()*2
+
+    index = GraphIndex([out])
+    assert set(index.shared_variables()) == {w, b}
+    assert x in index.leaves() and y not in index.leaves()
+    variables = index.variables()
+    assert variables[-1] is out
+    assert variables.index(h) < variables.index(out)
+    assert variables.index(w) < variables.index(h)
+
+    assert index.is_computable(h.mean())
+    assert index.is_computable(w**2)  # Shared variables and constants are always available
+    assert not index.is_computable(h+y)
+
+
+def test_deep_graph():
+    """
+    Recursive graph traversal would exceed the recursion limit here.
+    """
+    w = create_shared_variable(np.random.randn(3, 3), name = 'w')
+    v = tt.vector('v')
+    for _ in xrange(5000):
+        v = v + w.dot(v)
+    params = find_shared_ancestors(v)
+    assert params == [w]
+
+
+if __name__ == '__main__':
+    test_graph_index()
+    test_deep_graph()
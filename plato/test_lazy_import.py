@@ -0,0 +1,43 @@
+import subprocess
+import sys
+import os
+
+__author__ = 'peter'
+
+
+def _run_in_fresh_process(code):
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([p for p in sys.path if p]))
+    return subprocess.check_output([sys.executable, '-c', code], env = env).strip().split('\n')[-1]
+
+
+def test_lazy_import():
+
+    loaded = _run_in_fresh_process(
+        'import sys\n'
+        'import plato.core\n'
+        'core_modules = set(sys.modules)\n'
+        'from plato.all import symbolic, MultiLayerPerceptron\n'
+        'print ["theano.sandbox.rng_mrg" in core_modules, "plato.tools.mlp.mlp" in sys.modules, "plato.tools.convnet.convnet" in sys.modules]'
+        )
+    assert loaded == '[False, True, False]'
+
+    # A star-import gets the module's own names (e.g. symbolic, imported from plato.core) as well as the lazy ones.
+    star_imported = _run_in_fresh_process(
+        'from plato.all import *\n'
+        'print sorted(set(["symbolic", "tdb_trace", "SymbolicFunction", "MultiLayerPerceptron", "tdbplot"]) - set(dir()))'
+        )
+    assert star_imported == '[]'
+
+    import plato.tools.all as pt
+    from plato.tools.optimization.optimizers import Adam
+    assert pt.Adam is Adam
+    assert 'Adam' in dir(pt)
+    try:
+        pt.NotAModel
+        raise Exception('Should have raised an AttributeError')
+    except AttributeError:
+        pass
+
+
+if __name__ == '__main__':
+    test_lazy_import()
@@ -0,0 +1,88 @@
+from plato.core import symbolic, add_update, create_shared_variable
+from plato.precision import PrecisionError, find_float64_nodes, demote_float64
+from plato.tools.common.basic import running_average
+from plato.tools.common.config import float_precision
+from plato.tools.optimization.optimizers import Adam
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+
+__author__ = 'peter'
+
+
+def test_precision_policy():
+    with float_precision('float32'):
+        def make_scaler():
+            n = theano.shared(np.array(2, dtype = 'int64'))  # Upcasts whatever it touches to float64
+
+            @symbolic
+            def scale(x):
+                y = x * (1./n) + np.float64(1)
+                add_update(n, n+1)
+                return y
+            return scale
+
+        x = np.arange(4).astype('float32')
+
+        f = make_scaler().compile(precision_policy = 'raise')
+        with pytest.raises(PrecisionError) as err:
+            f(x)
+        assert 'upcast from (float32, int64)' in str(err.value)
+        assert 'test_precision.py' in str(err.value)  # Points to the line that introduced the float64
+
+        f = make_scaler().compile(precision_policy = 'fix')
+        out = f(x)
+        assert out.dtype == 'float32'
+        assert np.allclose(out, x/2.+1)
+        assert np.allclose(f(x), x/3.+1)  # The update to the int64 counter still works
+        assert len(find_float64_nodes(f._variants.values()[0].compiled_fcn)) == 0
+
+        f = make_scaler().compile(precision_policy = 'warn')
+        assert np.allclose(f(x), x/2.+1)
+
+
+def test_demote_float64():
+    with float_precision('float32'):
+        x = tt.vector('x', dtype = 'float32')
+        y = x + theano.shared(np.ones(3))
+        assert y.dtype == 'float64'
+        new_y, = demote_float64([y])
+        assert new_y.dtype == 'float32'
+        assert np.allclose(new_y.eval({x: np.arange(3).astype('float32')}), [1, 2, 3])
+        z = x * 2
+        assert demote_float64([z])[0] is z  # Unaffected variables are returned as is
+
+
+def test_plato_tools_stay_in_floatx():
+    with float_precision('float32'):
+        @symbolic
+        def train(x):
+            w = create_shared_variable(np.zeros(3))
+            Adam()(parameters = [w], cost = ((x.dot(w)-1)**2).sum())
+            return running_average(x)
+
+        f = train.compile(precision_policy = 'raise')
+        out = f(np.random.RandomState(0).randn(5, 3).astype('float32'))
+        assert out.dtype == 'float32'
+
+
+def test_running_average_counter_does_not_saturate():
+    """
+    A float32 counter stops counting at 2**24 (because 2**24+1 rounds back down to 2**24).
+    """
+    with float_precision('float32'):
+        f = running_average.compile(precision_policy = 'raise')
+        f(np.ones(3, dtype = 'float32'))
+        counter, = [v for v in f.get_state_variables() if v.ndim == 0]
+        counter.set_value(np.array(2**24, dtype = counter.dtype))
+        out = f(np.ones(3, dtype = 'float32'))
+        assert out.dtype == 'float32'
+        assert counter.get_value() == 2**24+1
+
+
+if __name__ == '__main__':
+    test_precision_policy()
+    test_demote_float64()
+    test_plato_tools_stay_in_floatx()
+    test_running_average_counter_does_not_saturate()
@@ -0,0 +1,80 @@
+import threading
+from plato.core import symbolic, tdb_trace, get_tdb_traces, clear_tdb_traces, set_enable_traces
+from plato.trace_sink import TraceSink, set_trace_sink
+from pytest import raises
+import numpy as np
+
+__author__ = 'peter'
+
+
+def test_trace_sink():
+
+    seen = []
+    worker_threads = set()
+
+    def record(name):
+        seen.append((name, float(get_tdb_traces()[name])))
+        worker_threads.add(threading.current_thread())
+
+    @symbolic
+    def add_stuff(a, b):
+        tdb_trace(a+b, name = 'sum', callback = lambda: record('sum'))
+        tdb_trace(a*b, name = 'product', callback = lambda: record('product'))
+        return a-b
+
+    # By default, callbacks run on the calling thread (matplotlib isn't thread-safe), at most every min_interval seconds
+    for background in (False, True):
+        del seen[:]
+        worker_threads.clear()
+        sink = TraceSink(capacity = 100, min_interval = 1000., background = background)
+        sink.set_sample_period('product', 3)
+        set_trace_sink(sink)
+        try:
+            f = add_stuff.compile()
+            for i in xrange(6):
+                assert f(float(i), 2.) == i-2
+            assert get_tdb_traces()['sum'] == 7  # The calling thread still sees the latest values
+            if not background:
+                assert [v for k, v in seen if k == 'sum'] == [2]  # The rest wait for min_interval to pass
+            sink.flush()
+            assert [v for k, v in seen if k == 'sum'] == [2, 3, 4, 5, 6, 7]
+            assert [v for k, v in seen if k == 'product'] == [0, 6]  # Only every third call
+            assert worker_threads == ({sink._thread} if background else {threading.current_thread()})
+        finally:
+            set_trace_sink(None)
+            sink.close()
+            clear_tdb_traces()
+
+    # Without traces, the sink would never get anything.
+    set_enable_traces(False)
+    try:
+        with raises(AssertionError):
+            set_trace_sink(TraceSink())
+    finally:
+        set_enable_traces(True)
+
+
+def test_trace_sink_drops_oldest():
+
+    unblock = threading.Event()
+    seen = []
+
+    def slow_callback():
+        unblock.wait()
+        seen.append(get_tdb_traces()['x'])
+
+    sink = TraceSink(capacity = 2, background = True)
+    for i in xrange(5):
+        sink.submit({'x': np.array(i)}, {'x': slow_callback})
+    unblock.set()
+    sink.close()
+    # The first entry may have been picked up by the worker before the buffer filled up.  Of the rest, only the
+    # newest ones are kept.
+    assert seen[-2:] == [3, 4]
+    assert sink.n_dropped == 5 - len(seen)
+    assert sink.n_processed == len(seen)
+
+
+if __name__ == '__main__':
+    test_trace_sink()
+    test_trace_sink_drops_oldest()
@@ -1,14 +1,30 @@
-from plato.tools.convnet.convnet import ConvNet
-from plato.tools.dbn.dbn import DeepBeliefNet
-from plato.tools.dbn.stacked_dbn import StackedDeepBeliefNet
-from plato.tools.dtp.difference_target_prop import DifferenceTargetMLP
-from plato.tools.lstm.long_short_term_memory import AutoencodingLSTM, LSTMLayer
-from plato.tools.mlp.mlp import MultiLayerPerceptron
-from plato.tools.optimization.cost import negative_log_likelihood, get_named_cost_function
-from plato.tools.optimization.optimizers import SimpleGradientDescent, GradientDescent, Adam, AdaMax, RMSProp, \
-    get_named_optimizer
-from plato.tools.pretrained_networks.vggnet import get_vgg_net
-from plato.tools.regressors.offline_linear_regression import LinearRegression
-from plato.tools.regressors.online_regressor import OnlineRegressor
-from plato.tools.va.gaussian_variational_autoencoder import GaussianVariationalAutoencoder
-from plato.tools.va.variational_autoencoder import VariationalAutoencoder
+"""
+All the model families and optimizers in plato.tools, in one place.  This is a lazy module (see plato.lazy_import):
+each name is only imported when you first use it, so you don't pay for importing every model family.
+"""
+from plato.lazy_import import install_lazy_module
+
+LAZY_ATTRIBUTES = {
+    'ConvNet': 'plato.tools.convnet.convnet',
+    'DeepBeliefNet': 'plato.tools.dbn.dbn',
+    'StackedDeepBeliefNet': 'plato.tools.dbn.stacked_dbn',
+    'DifferenceTargetMLP': 'plato.tools.dtp.difference_target_prop',
+    'AutoencodingLSTM': 'plato.tools.lstm.long_short_term_memory',
+    'LSTMLayer': 'plato.tools.lstm.long_short_term_memory',
+    'MultiLayerPerceptron': 'plato.tools.mlp.mlp',
+    'negative_log_likelihood': 'plato.tools.optimization.cost',
+    'get_named_cost_function': 'plato.tools.optimization.cost',
+    'SimpleGradientDescent': 'plato.tools.optimization.optimizers',
+    'GradientDescent': 'plato.tools.optimization.optimizers',
+    'Adam': 'plato.tools.optimization.optimizers',
+    'AdaMax': 'plato.tools.optimization.optimizers',
+    'RMSProp': 'plato.tools.optimization.optimizers',
+    'get_named_optimizer': 'plato.tools.optimization.optimizers',
+    'get_vgg_net': 'plato.tools.pretrained_networks.vggnet',
+    'LinearRegression': 'plato.tools.regressors.offline_linear_regression',
+    'OnlineRegressor': 'plato.tools.regressors.online_regressor',
+    'GaussianVariationalAutoencoder': 'plato.tools.va.gaussian_variational_autoencoder',
+    'VariationalAutoencoder': 'plato.tools.va.variational_autoencoder',
+    }
+
+install_lazy_module(__name__, LAZY_ATTRIBUTES)
@@ -15,9 +15,10 @@ def softmax(x, axis):
 
 @symbolic_simple
 def running_average(data):
-    n_points = theano.shared(np.array(1).astype(int))
-    avg = theano.shared(np.zeros_like(data.tag.test_value).astype(theano.config.floatX))
-    new_avg = data*(1./n_points) + avg*(n_points-1.)/n_points
+    n_points = theano.shared(np.array(1, dtype='int64'))  # A float32 counter would stop counting at 2**24
+    avg = theano.shared(np.zeros(data.ishape, dtype=theano.config.floatX))
+    n = tt.cast(n_points, theano.config.floatX)  # Otherwise the int counter would upcast the average to float64
+    new_avg = data*(1./n) + avg*(n-1.)/n
     add_update(avg, new_avg)
     add_update(n_points, n_points+1)
     return new_avg
@@ -20,5 +20,7 @@ def float_precision(value):
     assert value in ('float32', 'float64'), "Precision must be 'float32' or 'float64', not '%s'" % (value, )
     old_precision = theano.config.floatX
     theano.config.floatX = value
-    yield
-    theano.config.floatX = old_precision
+    try:
+        yield
+    finally:
+        theano.config.floatX = old_precision
@@ -0,0 +1,57 @@
+from plato.core import symbolic_multi
+from utils.benchmarks.train_and_test import get_streaming_metric_name
+import theano.tensor as tt
+
+__author__ = 'peter'
+
+"""
+Symbolic versions of the evaluation functions in utils.benchmarks.train_and_test that can be computed incrementally.
+
+Computing the score in the graph means that a compiled test function only has to return two scalars (the sum and count
+of per-sample scores), rather than the predictions for a whole data set.  Usage:
+
+    metric_sums = get_symbolic_metric_sums('percent_argmax_correct')
+
+    @symbolic
+    def test(x, y):
+        return metric_sums(predictor.predict(x), y)
+
+    f = test.compile()
+    accumulator = get_metric_accumulator('percent_argmax_correct')
+    for x, y in chunks:
+        accumulator.add_sums(*f(x, y))
+    score = accumulator.get_score()
+"""
+
+
+def _collapse_onehot(output):
+    return tt.argmax(output, axis = 1) if output.ndim == 2 else output
+
+
+SYMBOLIC_SAMPLE_SCORES = {  # Symbolic equivalents of the per-sample score functions in STREAMING_METRICS
+    'mean_squared_error': lambda actual, target: tt.sum((actual-target)**2, axis = -1),
+    'mean_l1_error': lambda actual, target: tt.sum(abs(actual-target), axis = -1),
+    'percent_correct': lambda actual, target: tt.eq(actual, target),
+    'percent_argmax_correct': lambda actual, target: tt.eq(_collapse_onehot(actual), _collapse_onehot(target)),
+    'percent_argmax_incorrect': lambda actual, target: tt.neq(_collapse_onehot(actual), _collapse_onehot(target)),
+    }
+
+
+def get_symbolic_metric_sums(evaluation_function):
+    """
+    :param evaluation_function: The name of an evaluation function, or the function itself
+    :return: A symbolic function (actual, target) -> (total, count) giving the sum and number of the per-sample scores,
+        which can be fed to MetricAccumulator.add_sums.  Or None if the evaluation function can not be computed
+        incrementally.
+    """
+    name = get_streaming_metric_name(evaluation_function)
+    if name is None:
+        return None
+    sample_score_function = SYMBOLIC_SAMPLE_SCORES[name]
+
+    @symbolic_multi
+    def metric_sums(actual, target):
+        scores = sample_score_function(actual, target)
+        return scores.sum(), scores.size
+
+    return metric_sums
@@ -89,13 +89,38 @@ class CompiledSymbolicPredictor(IPredictor, IParameterized):
     A Predictor containing the compiled methods for a SymbolicPredictor.
     """
 
-    def __init__(self, symbolic_predictor, **kwargs):
+    def __init__(self, symbolic_predictor, example_inputs = None, example_targets = None, **kwargs):
+        """
+        :param symbolic_predictor: An ISymbolicPredictor
+        :param example_inputs: Optionally, an example (n_samples, ...) array of inputs.  If provided, the predict
+            function (and the train function, if example_targets is also provided) starts compiling in the background
+            right away, instead of on the first call.  See wait_until_compiled.
+        :param example_targets: Optionally, an example (n_samples, ...) array of targets.
+        :param kwargs: Passed to the compile method of the train/predict functions.
+        """
         self.train_function = symbolic_predictor.train.compile(**kwargs)
         self.predict_function = symbolic_predictor.predict.compile(**kwargs)
         self._params = symbolic_predictor.parameters if isinstance(symbolic_predictor, IParameterized) else []
         self.symbolic_predictor=symbolic_predictor
+        self._compilations = []
+        self._pending_state = None  # State to load once the training function is compiled (see set_state)
+        if example_inputs is not None:
+            if example_targets is not None:
+                self._compilations.append(self.train_function.compile_async(example_inputs, example_targets))
+            self._compilations.append(self.predict_function.compile_async(example_inputs))
+
+    def wait_until_compiled(self):
+        """
+        Block until any compilations started in the constructor are finished.
+        """
+        for c in self._compilations:
+            c.get()
 
     def train(self, input_data, target_data):
+        if self._pending_state is not None:
+            self.train_function.precompile(input_data, target_data)
+            state, self._pending_state = self._pending_state, None
+            self.set_state(state)
         self.train_function(input_data, target_data)
 
     def predict(self, input_data):
@@ -105,6 +130,32 @@ class CompiledSymbolicPredictor(IPredictor, IParameterized):
     def parameters(self):
         return self._params
 
+    def _get_state_variables(self):
+        return self._params + [v for v in self.train_function.get_state_variables() if v not in self._params]
+
+    def get_state(self):
+        """
+        :return: A list of the values of the parameters and of everything else the training function updates (e.g. the
+            state of the optimizer).
+        """
+        return list(self._pending_state) if self._pending_state is not None else [v.get_value() for v in self._get_state_variables()]
+
+    def set_state(self, state):
+        """
+        :param state: A state returned by get_state.  If it includes optimizer state, but the training function has not
+            been compiled yet (so the optimizer's variables don't exist), the parameters are set now, and the rest is
+            set when the training function is compiled.
+        """
+        state_variables = self._get_state_variables()
+        if len(state) > len(state_variables):
+            self._pending_state = list(state)
+            state_variables = self._params
+        assert len(state) == len(state_variables) or self._pending_state is not None, \
+            "You want to load %s values into %s state variables?  Not going to happen." % (len(state), len(state_variables))
+        for var, value in zip(state_variables, state):
+            assert var.get_value(borrow = True).shape == value.shape, 'Shape mismatch for %s: Variable: %s, Value: %s' % (var, var.get_value(borrow = True).shape, value.shape)
+            var.set_value(value)
+
 
 class FeedForwardModule(IParameterized):
 
@@ -5,6 +5,10 @@ from plato.tools.optimization.optimizers import SimpleGradientDescent
 from utils.benchmarks.train_and_test import percent_argmax_correct
 from utils.tools.iteration import zip_minibatch_iterate
 from utils.datasets.synthetic_clusters import get_synthetic_clusters_dataset
+from utils.predictors.i_predictor import IPredictor, PredictorStateError
+import numpy as np
+import pytest
+import theano
 
 __author__ = 'peter'
 
@@ -42,5 +46,55 @@ def test_symbolic_predicors():
     assert final_score > 98
 
 
+def test_symbolic_predictor_warmup():
+
+    dataset = get_synthetic_clusters_dataset()
+
+    symbolic_predictor = GradientBasedPredictor(
+        function = MultiLayerPerceptron.from_init(
+            layer_sizes = [dataset.input_size, 100, dataset.n_categories],
+            output_activation='softmax',
+            w_init = 0.1,
+            rng = 3252
+            ),
+        cost_function=negative_log_likelihood_dangerous,
+        optimizer=SimpleGradientDescent(eta = 0.1),
+        )
+
+    # Start compiling train and predict in the background as soon as the predictor is created.
+    predictor = symbolic_predictor.compile(example_inputs = dataset.training_set.input[:10], example_targets = dataset.training_set.target[:10])
+    predictor.wait_until_compiled()
+    assert predictor.train_function.get_dispatch_stats()['n_variants'] == 1
+    assert predictor.predict_function.get_dispatch_stats()['n_variants'] == 1
+
+    predictor.train(dataset.training_set.input[:10], dataset.training_set.target[:10])
+    predictor.predict(dataset.test_set.input)
+    assert predictor.train_function.get_dispatch_stats()['n_misses'] == 1
+    assert predictor.predict_function.get_dispatch_stats()['n_misses'] == 1
+
+
+def test_get_state_with_shared_variables():
+    """
+    A copy of a shared variable would not be the variable that the compiled functions update, so the default get_state
+    must refuse to copy predictors that hold them.
+    """
+
+    class LinearPredictor(IPredictor):
+
+        def __init__(self):
+            self.w = theano.shared(np.zeros((3, 2)))
+
+        def train(self, input_data, target_data):
+            pass
+
+        def predict(self, input_data):
+            return input_data.dot(self.w.get_value())
+
+    with pytest.raises(PredictorStateError):
+        LinearPredictor().get_state()
+
+
 if __name__ == '__main__':
     test_symbolic_predicors()
+    test_symbolic_predictor_warmup()
+    test_get_state_with_shared_variables()
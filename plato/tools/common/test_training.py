@@ -1,11 +1,44 @@
+from plato.core import add_update
+from plato.interfaces.decorators import symbolic_simple, symbolic_updater
+from plato.tools.common.online_predictors import ISymbolicPredictor
 from plato.tools.common.training import assess_online_symbolic_predictor
-from plato.tools.optimization.optimizers import GradientDescent
+from plato.tools.optimization.optimizers import GradientDescent, Adam
 from plato.tools.regressors.online_regressor import OnlineRegressor
+from utils.benchmarks.predictor_comparison import assess_online_predictor
 from utils.datasets.synthetic_clusters import get_synthetic_clusters_dataset
+from utils.tools.checkpointing import PeriodicCheckpointer
+import numpy as np
+import os
+import pytest
+import tempfile
+import theano
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 
 __author__ = 'peter'
 
 
+class StepCountingPredictor(ISymbolicPredictor):
+    """
+    Wraps a predictor, and counts its training steps in a shared variable that it creates as it trains, as predictors
+    with state of their own (e.g. an RBM with a persistent chain) do.
+    """
+
+    def __init__(self, predictor):
+        self.predictor = predictor
+        self.step_counters = []
+
+    @symbolic_simple
+    def predict(self, x):
+        return self.predictor.predict(x)
+
+    @symbolic_updater
+    def train(self, x, targets):
+        self.predictor.train(x, targets)
+        n_steps = theano.shared(np.array(0, dtype='int64'), name = 'n_steps')
+        self.step_counters.append(n_steps)
+        add_update(n_steps, n_steps+1)
+
+
 def test_assess_online_symbolic_predictor():
 
 
@@ -33,5 +66,159 @@ def test_assess_online_symbolic_predictor():
     assert scores[0] <= 40
     assert scores[-1] >= 99
 
+
+def test_multi_step_training_calls():
+
+    dataset = get_synthetic_clusters_dataset(dtype = 'float32')
+
+    # Stateful optimizers, and a predictor with a step counter of its own, check that the scan updates the same state as
+    # the single training step.
+    n_steps = int(np.ceil(2. * dataset.training_set.n_samples / 20))
+    for get_optimizer in (lambda: GradientDescent(eta = 0.01), lambda: Adam(alpha = 0.01), lambda: GradientDescent(eta = 0.01, momentum = 0.9)):
+        records = {}
+        predictors = {}
+        for steps_per_call in (1, 8):  # With 8, the last 49 steps are done as 6 scans and 1 single step
+            predictor = predictors[steps_per_call] = StepCountingPredictor(OnlineRegressor(
+                        input_size = dataset.input_size,
+                        output_size=dataset.n_categories,
+                        optimizer=get_optimizer(),
+                        regressor_type = 'multinomial'
+                        ))
+            records[steps_per_call] = assess_online_symbolic_predictor(
+                predictor = predictor,
+                dataset = dataset,
+                evaluation_function='percent_argmax_correct',
+                test_epochs=[0, 0.5, 1, 2],
+                minibatch_size=20,
+                steps_per_call=steps_per_call,
+            )
+            assert len(set(predictor.step_counters)) == 1 and predictor.step_counters[0].get_value() == n_steps
+
+        # Blocks of steps are cut short at test points, so we train on exactly the same minibatches.
+        for set_name in ('Training', 'Test'):
+            assert np.allclose(records[1].get_scores(set_name), records[8].get_scores(set_name))
+        for p1, p8 in zip(predictors[1].predictor.parameters, predictors[8].predictor.parameters):
+            assert np.allclose(p1.get_value(), p8.get_value(), atol = 1e-5)
+        assert records[8].get_scores('Test')[-1] >= 99
+
+
+def test_chunked_symbolic_evaluation():
+
+    dataset = get_synthetic_clusters_dataset(dtype = 'float32')
+
+    records = {}
+    for test_batch_size in (None, 64):
+        predictor = OnlineRegressor(
+                    input_size = dataset.input_size,
+                    output_size=dataset.n_categories,
+                    optimizer=GradientDescent(eta = 0.01),
+                    regressor_type = 'multinomial'
+                    )
+        records[test_batch_size] = assess_online_symbolic_predictor(
+            predictor = predictor,
+            dataset = dataset,
+            evaluation_function='percent_argmax_correct',
+            test_epochs=[0, 0.5, 1],
+            minibatch_size=20,
+            test_batch_size=test_batch_size,
+        )
+    for set_name in ('Training', 'Test'):
+        assert np.allclose(records[None].get_scores(set_name), records[64].get_scores(set_name))
+    assert records[64].get_scores('Test')[0] <= 40
+    assert records[64].get_scores('Test')[-1] >= 99
+
+
+def test_training_matches_compiled_predictor_loop():
+    """
+    assess_online_symbolic_predictor compiles its own training and test functions.  They must share the predictor's
+    state (its own, and its optimizer's), so that training goes exactly as it does in the loop of
+    assess_online_predictor, which calls the predictor's compiled train and predict functions.
+    """
+
+    dataset = get_synthetic_clusters_dataset(dtype = 'float32')
+    n_steps = int(np.ceil(2. * dataset.training_set.n_samples / 20))
+
+    for get_optimizer in (lambda: Adam(alpha = 0.01), lambda: GradientDescent(eta = 0.01, momentum = 0.9)):
+        records = {}
+        predictors = {}
+        for loop in ('symbolic', 'compiled'):
+            predictor = predictors[loop] = StepCountingPredictor(OnlineRegressor(input_size = dataset.input_size,
+                output_size=dataset.n_categories, optimizer=get_optimizer(), regressor_type = 'multinomial'))
+            kwargs = dict(dataset = dataset, evaluation_function='percent_argmax_correct', test_epochs=[0, 0.5, 1, 2], minibatch_size=20,
+                test_callback = lambda _, p=predictor: p.predictor.parameters[0].get_value().sum())
+            records[loop] = assess_online_symbolic_predictor(predictor = predictor, **kwargs) if loop == 'symbolic' else \
+                assess_online_predictor(predictor = predictor.compile(), **kwargs)
+            assert len(set(predictor.step_counters)) == 1 and predictor.step_counters[0].get_value() == n_steps
+        for set_name in ('Training', 'Test', 'callback'):
+            assert np.allclose(records['symbolic'].get_scores(set_name), records['compiled'].get_scores(set_name))
+        for p1, p2 in zip(predictors['symbolic'].predictor.parameters, predictors['compiled'].predictor.parameters):
+            assert np.allclose(p1.get_value(), p2.get_value(), atol = 1e-5)
+
+
+class InputDropoutPredictor(ISymbolicPredictor):
+    """
+    Wraps a predictor, and trains it on inputs with random dropout, from a theano random stream.
+    """
+
+    def __init__(self, predictor, drop_rate = 0.5, seed = 1234):
+        self.predictor = predictor
+        self.drop_rate = drop_rate
+        self.rng = MRG_RandomStreams(seed)
+
+    @symbolic_simple
+    def predict(self, x):
+        return self.predictor.predict(x)
+
+    @symbolic_updater
+    def train(self, x, targets):
+        mask = self.rng.binomial(size = x.shape, p = 1 - self.drop_rate, nstreams = 64, dtype = x.dtype)
+        self.predictor.train(x * mask / (1 - self.drop_rate), targets)
+
+
+def test_resume_from_checkpoint():
+
+    dataset = get_synthetic_clusters_dataset(dtype = 'float32')
+
+    class Interruption(Exception):
+        pass
+
+    def get_interrupt_at_third_test():
+        n_tests = [0]
+        def interrupt_at_third_test(predictor):
+            n_tests[0] += 1
+            if n_tests[0] == 3:
+                raise Interruption()
+        return interrupt_at_third_test
+
+    # The dropout predictor checks that the state of random streams (which is updated through default_updates) is saved.
+    for make_predictor in (
+            lambda: OnlineRegressor(input_size = dataset.input_size, output_size=dataset.n_categories, optimizer=Adam(alpha = 0.01), regressor_type = 'multinomial'),
+            lambda: InputDropoutPredictor(OnlineRegressor(input_size = dataset.input_size, output_size=dataset.n_categories, optimizer=Adam(alpha = 0.01), regressor_type = 'multinomial'))
+            ):
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), 'checkpoint.pkl')
+
+        def train(checkpointer = None, test_callback = None):
+            predictor = make_predictor()
+            record = assess_online_symbolic_predictor(predictor = predictor, dataset = dataset, evaluation_function='percent_argmax_correct',
+                test_epochs=[0, 0.5, 1, 2], minibatch_size=20, steps_per_call=4, checkpointer=checkpointer, test_callback=test_callback)
+            return predictor, record
+
+        uninterrupted_predictor, uninterrupted_record = train()
+        with pytest.raises(Interruption):
+            train(checkpointer = PeriodicCheckpointer(checkpoint_path, every_n_samples = 150), test_callback = get_interrupt_at_third_test())
+        assert os.path.exists(checkpoint_path)
+        resumed_predictor, resumed_record = train(checkpointer = PeriodicCheckpointer(checkpoint_path, every_n_samples = 150))
+
+        _, scores = resumed_record.get_results()
+        assert np.array_equal(scores['Test'], uninterrupted_record.get_scores('Test'))  # Including the scores from before the interruption
+        get_parameters = lambda p: p.predictor.parameters if isinstance(p, InputDropoutPredictor) else p.parameters
+        for p1, p2 in zip(get_parameters(uninterrupted_predictor), get_parameters(resumed_predictor)):
+            assert np.allclose(p1.get_value(), p2.get_value(), atol = 1e-6)
+
+
 if __name__ == '__main__':
-    test_assess_online_symbolic_predictor()
\ No newline at end of file
+    test_assess_online_symbolic_predictor()
+    test_multi_step_training_calls()
+    test_chunked_symbolic_evaluation()
+    test_training_matches_compiled_predictor_loop()
+    test_resume_from_checkpoint()
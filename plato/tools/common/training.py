@@ -1,10 +1,18 @@
+from copy import deepcopy
 from artemis.general.checkpoint_counter import CheckPointCounter
-from plato.core import create_shared_variable, symbolic
+from plato.core import create_shared_variable, symbolic, select_rows, StateCatcher, add_update
+from plato.fused_functions import FusedSymbolicFunction
 from plato.interfaces.decorators import symbolic_updater, symbolic_simple
+from plato.tools.common.metrics import get_symbolic_metric_sums
 from utils.benchmarks.predictor_comparison import LearningCurveData, dataset_to_testing_sets
-from utils.benchmarks.train_and_test import get_evaluation_function
+from utils.benchmarks.train_and_test import get_evaluation_function, get_metric_accumulator
 from utils.tools.iteration import minibatch_index_generator
 from utils.tools.processors import RunningAverage
+from theano.compile.sharedvalue import SharedVariable
+import itertools
+import numpy as np
+import theano
+import theano.tensor as tt
 import time
 
 __author__ = 'peter'
@@ -39,7 +47,8 @@ class SupervisedTestFunction(object):
 
 
 def assess_online_symbolic_predictor(predictor, dataset, evaluation_function, test_epochs, minibatch_size, test_on = 'training+test',
-        accumulator = None, report_test_scores=True, test_callback = None, add_test_values = True):
+        accumulator = None, report_test_scores=True, test_callback = None, add_test_values = True, steps_per_call = 1,
+        test_batch_size = None, checkpointer = None):
     """
     Train an online predictor and return the LearningCurveData.
 
@@ -55,8 +64,28 @@ def assess_online_symbolic_predictor(predictor, dataset, evaluation_function, te
     :param report_test_scores: Print out the test scores as they're computed (T/F)
     :param test_callback: A callback which takes the predictor, and is called every time a test
         is done.  This can be useful for plotting/debugging the state.
+    :param add_test_values: Compile the functions with test values (see AutoCompilingFunction).  Predictors that only
+        need the shapes of variables (var.ishape) don't need them, since shapes are inferred statically (see
+        plato.shape_inference), so you can turn them off to make the first pass faster.
+    :param steps_per_call: Number of minibatches to train on in each call to the compiled training function.  With
+        steps_per_call > 1, the training steps are done in a theano scan, so the python and call overhead is paid once
+        per steps_per_call minibatches, which can make small models train several times faster.  Blocks of steps are
+        cut short at test points, and the scan is built from the same trace of predictor.train as the single training
+        step, so it updates the same state (the optimizer's, e.g. Adam's moments, and any that the predictor creates as
+        it trains, e.g. the persistent chain of an RBM).  So the training steps (and so the results, up to float
+        rounding) are the same as with steps_per_call = 1.
+    :param test_batch_size: If the evaluation function can be computed incrementally (see get_metric_accumulator), it is
+        computed in the graph, so that the compiled test functions only return scalars.  If test_batch_size is given,
+        the test sets are also evaluated chunk by chunk, so the predictions for a whole set are never computed at once.
+    :param checkpointer: Optionally, a PeriodicCheckpointer (see utils.tools.checkpointing).  The shared variables updated
+        by the compiled training function (the model's parameters, the optimizer's state, any state that the predictor
+        creates as it trains, and the state of theano's random streams), the position in the training data, the results
+        so far and numpy's global random state are saved on its schedule.  If it already holds a checkpoint, training
+        resumes from there, and continues as it would have without the interruption, unless something else in training
+        is random (e.g. python's random module) or has state that training doesn't update through theano.
     :return: LearningCurveData containing the score on the test sets
     """
+    assert isinstance(steps_per_call, int) and steps_per_call >= 1, 'steps_per_call must be a positive int.  You gave %s' % (steps_per_call, )
 
     record = LearningCurveData()
 
@@ -72,53 +101,151 @@ def assess_online_symbolic_predictor(predictor, dataset, evaluation_function, te
 
     if isinstance(evaluation_function, str):
         evaluation_function = get_evaluation_function(evaluation_function)
+    metric_sums = get_symbolic_metric_sums(evaluation_function)
+    chunked_tests = metric_sums is not None and test_batch_size is not None
+
+    # The training data is shared between training and testing on the training set, so only upload it once.
+    x_tr = create_shared_variable(dataset.training_set.input)
+    y_tr = create_shared_variable(dataset.training_set.target)
+    test_inputs = {'Training': x_tr, 'Test': create_shared_variable(dataset.test_set.input)}
+    test_targets = {'Training': y_tr, 'Test': create_shared_variable(dataset.test_set.target)} if metric_sums is not None else None
+
+    # predictor.train is traced once, and every compiled training function (a training step, and several steps in a
+    # scan) reuses that graph.  So any state that the predictor creates as it trains (e.g. the persistent chain of an
+    # RBM) is shared between them, like its parameters and the optimizer's state.
+    traced_train_step = []  # Holds (indices, updates) once predictor.train has been traced
 
     @symbolic
     def train(indices):
-        x_tr = create_shared_variable(dataset.training_set.input)
-        y_tr = create_shared_variable(dataset.training_set.target)
-        predictor.train(x_tr[indices], y_tr[indices])
+        if len(traced_train_step) == 0:
+            with StateCatcher(swallow_updates = True) as sc:
+                predictor.train(select_rows(x_tr, indices), y_tr[indices])
+            updates = sc.get_updates()
+            # Random streams update their state through default_updates, which may depend on the indices too (e.g. on
+            # the shape of the minibatch), so they have to be made explicit to be replaced along with the rest.
+            for var in theano.gof.graph.inputs([new_value for _, new_value in updates]):
+                if isinstance(var, SharedVariable) and getattr(var, 'default_update', None) is not None and var not in [v for v, _ in updates]:
+                    updates.append((var, var.default_update))
+            traced_train_step.append((indices, updates))
+        traced_indices, updates = traced_train_step[0]
+        for shared_var, new_value in updates:
+            add_update(shared_var, new_value if indices is traced_indices else theano.clone(new_value, replace = {traced_indices: indices}))
 
-    @symbolic
-    def test_on_test_set():
-        x_ts = create_shared_variable(dataset.test_set.input)
-        outputs = predictor.predict(x_ts)
-        return outputs
+    def get_test_function(set_name):
+        @symbolic
+        def test_on_set():
+            predictions = predictor.predict(test_inputs[set_name])
+            return predictions if metric_sums is None else metric_sums(predictions, test_targets[set_name])
+        return test_on_set
 
-    @symbolic
-    def test_on_training_set():
-        x_tr = create_shared_variable(dataset.training_set.input)
-        outputs = predictor.predict(x_tr)
-        return outputs
+    def get_chunk_test_function(set_name):
+        @symbolic
+        def test_on_chunk(start):
+            rows = tt.arange(start, tt.minimum(start+test_batch_size, test_inputs[set_name].shape[0]))
+            return metric_sums(predictor.predict(select_rows(test_inputs[set_name], rows)), test_targets[set_name][rows])
+        return test_on_chunk
 
     train_fcn = train.compile(add_test_values=add_test_values)
-    prediction_functions = {
-        'Training': test_on_training_set.compile(add_test_values=add_test_values),
-        'Test': test_on_test_set.compile(add_test_values=add_test_values),
-        }
+    if chunked_tests:
+        chunk_test_fcns = {k: get_chunk_test_function(k).compile(add_test_values=add_test_values) for k in testing_sets}
+    else:  # All the test sets are done in one call
+        test_fcn = FusedSymbolicFunction([(k, get_test_function(k), []) for k in testing_sets]).compile(add_test_values=add_test_values)
+
+    @symbolic
+    def train_steps(index_block):
+        train.scan(sequences = [index_block])
+
+    train_steps_fcn = train_steps.compile(add_test_values=add_test_values) if steps_per_call > 1 else None
+    pending_indices = []  # Minibatches that have not been trained on yet, when steps_per_call > 1
+
+    def train_on_pending():
+        if len(pending_indices) == 1:
+            train_fcn(pending_indices[0])
+        elif len(pending_indices) > 1:
+            train_steps_fcn(np.array(pending_indices))
+        del pending_indices[:]
+
+    def get_scores(test_outputs):
+        """
+        :param test_outputs: The outputs of the compiled tests: the predictions for each set, or the sums of their
+            per-sample scores.
+        :return: A list of (set_name, score)
+        """
+        if metric_sums is None:
+            return [(k, evaluation_function(test_outputs[k], y)) for k, (x, y) in testing_sets.iteritems()]
+        scores = []
+        for k in testing_sets:
+            metric_accumulator = get_metric_accumulator(evaluation_function)
+            metric_accumulator.add_sums(test_outputs['%s[0]' % (k, )], test_outputs['%s[1]' % (k, )])
+            scores.append((k, metric_accumulator.get_score()))
+        return scores
+
+    def get_chunked_scores():
+        scores = []
+        for k, (x, _) in testing_sets.iteritems():
+            metric_accumulator = get_metric_accumulator(evaluation_function)
+            for start in xrange(0, x.shape[0], test_batch_size):
+                metric_accumulator.add_sums(*chunk_test_fcns[k](start))
+            scores.append((k, metric_accumulator.get_score()))
+        return scores
 
     def do_test(current_epoch):
-        scores = [(k, evaluation_function(prediction_functions[k](), y)) for k, (x, y) in testing_sets.iteritems()]
+        scores = get_chunked_scores() if chunked_tests else get_scores(test_fcn())
         if report_test_scores:
             print 'Scores at Epoch %s: %s, (after %ss)' % (current_epoch, ', '.join('%s: %.3f' % (set_name, score) for set_name, score in scores), time.time()-start_time)
         record.add(current_epoch, scores)
         if test_callback is not None:
             record.add(current_epoch, ('callback', test_callback(predictor)))
 
+    def get_state_variables(indices):
+        """
+        :param indices: The indices of a minibatch that is about to be trained on (the training function is compiled for
+            it, if it hasn't been called yet)
+        :return: The shared variables that training updates: the model's parameters, the optimizer's state, any state
+            the predictor creates as it trains, and the state of random streams.  All the compiled training functions
+            use the same trace of predictor.train, so they all update the same ones.
+        """
+        return train_fcn.precompile(indices).get_state_variables()
+
     checker = CheckPointCounter(test_epochs)
     last_n_samples_seen = 0
+    checkpoint = checkpointer.load() if checkpointer is not None else None
+    if checkpoint is not None:
+        last_n_samples_seen, (state_values, record, checker, random_state) = checkpoint
+    index_generator = minibatch_index_generator(n_samples=dataset.training_set.n_samples, minibatch_size=minibatch_size, n_epochs=float('inf'), slice_when_possible=False, start=last_n_samples_seen)
+    if checkpoint is not None:
+        first_indices = next(index_generator)
+        index_generator = itertools.chain([first_indices], index_generator)
+        state_variables = get_state_variables(first_indices)
+        assert [v.get_value(borrow=True).shape for v in state_variables] == [value.shape for value in state_values], \
+            'The checkpoint holds state with shapes %s, but training updates state with shapes %s' % ([value.shape for value in state_values], [v.get_value(borrow=True).shape for v in state_variables])
+        for var, value in zip(state_variables, state_values):
+            var.set_value(value)
+        np.random.set_state(random_state)
+        print 'Resuming from checkpoint at epoch %s' % (float(last_n_samples_seen)/dataset.training_set.n_samples, )
     start_time = time.time()
 
-    for indices in minibatch_index_generator(n_samples=dataset.training_set.n_samples, minibatch_size=minibatch_size, n_epochs=float('inf'), slice_when_possible=False):
+    for indices in index_generator:
         current_epoch = (float(last_n_samples_seen))/dataset.training_set.n_samples
         last_n_samples_seen += minibatch_size
         time_for_a_test, done = checker.check(current_epoch)
         if time_for_a_test:
+            train_on_pending()
             do_test(current_epoch)
         if done:
             break
-        train_fcn(indices)
+        elif steps_per_call > 1:
+            pending_indices.append(indices)
+            if len(pending_indices) == steps_per_call:
+                train_on_pending()
+        else:
+            train_fcn(indices)
+        if checkpointer is not None and checkpointer.is_due(last_n_samples_seen):
+            train_on_pending()
+            checkpointer.save(last_n_samples_seen, ([v.get_value() for v in get_state_variables(indices)], deepcopy(record), deepcopy(checker), np.random.get_state()))
 
+    if checkpointer is not None:
+        checkpointer.wait()
     return record
     #         time_for_a_test, done = checker.check(current_epoch)
     #     for (n_samples_seen, input_minibatch, target_minibatch) in \
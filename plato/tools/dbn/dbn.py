@@ -95,7 +95,7 @@ class DeepBeliefNet(object):
             wake_visible = input_signals if input_layers is None else up_path(*input_signals)
             wake_hidden = propup(*wake_visible)
 
-            initial_hidden =[theano.shared(np.zeros(wh.tag.test_value.shape, dtype = theano.config.floatX), name = 'persistent_hidden_state') for wh in wake_hidden] \
+            initial_hidden =[theano.shared(np.zeros(wh.ishape, dtype = theano.config.floatX), name = 'persistent_hidden_state') for wh in wake_hidden] \
                 if persistent else wake_hidden
 
             gibbs_path = [(hidden_layers, visible_layers)] + [(visible_layers, hidden_layers), (hidden_layers, visible_layers)] * (n_gibbs-1)
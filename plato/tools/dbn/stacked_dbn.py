@@ -75,7 +75,7 @@ class BaseRBM(IGenerativeNet):
         def train(wake_visible):
 
             wake_hidden = self.propup(wake_visible)
-            persistent_state = sleep_hidden = create_shared_variable(np.zeros(wake_hidden.tag.test_value.shape),
+            persistent_state = sleep_hidden = create_shared_variable(np.zeros(wake_hidden.ishape),
                 name = 'persistend_hidden_state') if persistent else wake_hidden
             for _ in xrange(n_gibbs):
                 sleep_visible = self.propdown(sleep_hidden)
@@ -66,7 +66,7 @@ class DifferenceTargetLayer(ITargetPropLayer, ISymbolicPredictor):
             parameters = [self.w, self.b] if self.use_bias else [self.w],
             constants = [target]
             )  # The "constants" (above) is really important - otherwise it can just try to change the target (which is a function of the weights too).
-        noisy_x = x + self.noise*self.rng.normal(size = x.tag.test_value.shape)
+        noisy_x = x + self.noise*self.rng.normal(size = x.ishape)
         if self.backward_activation is not None:
             recon = self.backward(self.predict(noisy_x))
             self.backward_optimizer(
@@ -25,6 +25,10 @@ def tdbplot(var, name = None, plot_type = None, **kwargs):
             will be made given the data.  "live" tends to make streaming plots, which
             make mores sense when you're running and monitoring.  "static" makes static
             plots, which make more sence for step-by-step debugging.
+
+    To keep plotting from stalling the function being traced, set a TraceSink (see plato.trace_sink), and use its
+    min_interval or set_sample_period to plot only every so often.  Leave background = False, since matplotlib is not
+    thread-safe.
     """
 
     if name is None:
@@ -3,6 +3,8 @@ from artemis.general.should_be_builtins import bad_value
 from plato.interfaces.helpers import get_named_activation_function, batch_normalize
 from plato.core import create_shared_variable, symbolic_simple, symbolic
 from plato.interfaces.interfaces import IParameterized
+from theano.sparse import SparseType
+import theano
 import theano.tensor as tt
 import numpy as np
 
@@ -146,7 +148,8 @@ class FullyConnectedTransform(IParameterized):
         self._use_bias = use_bias
 
     def __call__(self, x):
-        current = x.flatten(2).dot(self.w)
+        # Sparse inputs (e.g. bag-of-words) are multiplied without densifying them.  The gradient wrt w is dense.
+        current = theano.dot(x, self.w) if isinstance(x.type, SparseType) else x.flatten(2).dot(self.w)
         current = self.normalizer(current) if self.normalizer is not None else current
         if self.log_scale is not None:
             current = current * tt.exp(self.log_scale)
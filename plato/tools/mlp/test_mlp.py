@@ -5,10 +5,12 @@ from plato.tools.mlp.mlp import create_maxout_network, MultiLayerPerceptron
 from plato.tools.optimization.cost import negative_log_likelihood_dangerous
 from plato.tools.optimization.optimizers import SimpleGradientDescent
 import pytest
+from scipy.sparse import csr_matrix
 from utils.benchmarks.train_and_test import percent_argmax_correct
 from utils.tools.iteration import zip_minibatch_iterate
 from utils.datasets.synthetic_clusters import get_synthetic_clusters_dataset
 from utils.predictors.predictor_tests import assert_online_predictor_not_broken
+import numpy as np
 
 __author__ = 'peter'
 
@@ -135,6 +137,31 @@ def test_all_maxout_mlp():
             )
 
 
+def test_sparse_input_mlp():
+
+    rng = np.random.RandomState(1234)
+    x = rng.rand(30, 50)*(rng.rand(30, 50) < 0.1)
+    y = rng.randint(3, size=30)
+    mlp = MultiLayerPerceptron.from_init(layer_sizes = [50, 10, 3], hidden_activation = 'relu',
+        output_activation = 'softmax', w_init = 0.1, rng = 1234)
+    assert np.allclose(mlp.compile()(csr_matrix(x)), mlp.compile()(x))
+
+    optimizer = SimpleGradientDescent(eta = 0.1)
+
+    @symbolic_updater
+    def train(x, y):
+        optimizer(negative_log_likelihood_dangerous(mlp(x), y), mlp.parameters)
+
+    initial_params = [p.get_value() for p in mlp.parameters]
+    train.compile()(x, y)
+    dense_params = [p.get_value() for p in mlp.parameters]
+    for p, v in zip(mlp.parameters, initial_params):
+        p.set_value(v)
+    train.compile()(csr_matrix(x), y)
+    assert all(np.allclose(p.get_value(), v) for p, v in zip(mlp.parameters, dense_params))
+    assert not np.allclose(dense_params[0], initial_params[0])
+
+
 if __name__ == '__main__':
 
     test_all_maxout_mlp()
@@ -142,6 +169,7 @@ if __name__ == '__main__':
     test_bare_bones_mlp()
     test_mlp()
     test_mlp_with_scale_learning()
+    test_sparse_input_mlp()
 
 
 def test_demo_mnist_mlp():
@@ -42,6 +42,23 @@ class UniformParameterOptimizer(IGradientOptimizer):
     def _update_param(self, param, gradient):
         pass
 
+    def _get_state_variable(self, param, name, initializer_fcn):
+        """
+        Get the shared variable holding some of the optimizer's state for a parameter (e.g. a momentum), creating it
+        the first time.  All functions compiled with this optimizer (e.g. a training step, and several training steps in
+        a scan) then update the same state, rather than each keeping their own.
+
+        :param param: The parameter
+        :param name: The name of the state variable
+        :param initializer_fcn: A function that creates the shared variable
+        :return: The shared variable
+        """
+        if not hasattr(self, '_state_variables'):  # Subclasses don't call our constructor.
+            self._state_variables = {}
+        if (param, name) not in self._state_variables:
+            self._state_variables[param, name] = initializer_fcn()
+        return self._state_variables[param, name]
+
 
 class GradientStepUpdater(UniformParameterOptimizer):
     """
@@ -106,9 +123,9 @@ class Adam(UniformParameterOptimizer):
 
     def _update_param(self, param, gradient):
         # Initialize variables
-        i = create_shared_variable(0.)
-        m = theano.shared(param.get_value() * 0.)
-        v = theano.shared(param.get_value() * 0.)
+        i = self._get_state_variable(param, 'i', lambda: create_shared_variable(0.))
+        m = self._get_state_variable(param, 'm', lambda: theano.shared(param.get_value() * 0.))
+        v = self._get_state_variable(param, 'v', lambda: theano.shared(param.get_value() * 0.))
 
         # Recompute values
         i_t = i + 1.
@@ -134,8 +151,8 @@ class AdaMax(UniformParameterOptimizer):
         self._eps = eps
 
     def _update_param(self, param, gradient):
-        mom1 = theano.shared(np.zeros_like(param.get_value()))
-        mom2 = theano.shared(np.zeros_like(param.get_value()))
+        mom1 = self._get_state_variable(param, 'mom1', lambda: theano.shared(np.zeros_like(param.get_value())))
+        mom2 = self._get_state_variable(param, 'mom2', lambda: theano.shared(np.zeros_like(param.get_value())))
         mom1_new = mom1 + self._beta_1 * (gradient - mom1)
         mom2_new = tt.maximum(abs(gradient) + self._eps, (1. - self._beta_2) * mom2)
         new_param = param - self._alpha * mom1_new / mom2_new
@@ -152,7 +169,7 @@ class RMSProp(UniformParameterOptimizer):
         self.learning_rate = learning_rate
 
     def _update_param(self, param, gradient):
-        mean_squared_grad = theano.shared(np.zeros_like(param.get_value()))
+        mean_squared_grad = self._get_state_variable(param, 'mean_squared_grad', lambda: theano.shared(np.zeros_like(param.get_value())))
         new_mean_squared_grad = self.decay * mean_squared_grad + (1-self.decay) * gradient**2
         delta_p = - self.learning_rate * gradient / tt.maximum(tt.sqrt(new_mean_squared_grad), self.epsilon)
         add_update(param, param + delta_p)
@@ -175,7 +192,7 @@ class AdaGrad(UniformParameterOptimizer):
         self.decay_rate = decay_rate
 
     def _update_param(self, param, gradient):
-        sum_squared_grad = theano.shared(param.get_value()*0)
+        sum_squared_grad = self._get_state_variable(param, 'sum_squared_grad', lambda: theano.shared(param.get_value()*0))
         new_ssg = (1-self.decay_rate)*sum_squared_grad + gradient**2
         scale = tt.maximum(self.eps, tt.sqrt(new_ssg))
         add_update(param, param - (self.learning_rate / scale) * gradient)
@@ -196,7 +213,7 @@ class GradientDescent(UniformParameterOptimizer):
     def _update_param(self, param, gradient):
 
         if self.momentum != 0:
-            mom = theano.shared(np.zeros_like(param.get_value()))
+            mom = self._get_state_variable(param, 'mom', lambda: theano.shared(np.zeros_like(param.get_value())))
             new_mom = self.momentum * mom + gradient
             add_update(mom, new_mom)
             direction = new_mom  # Or mom, something about Nesterov...
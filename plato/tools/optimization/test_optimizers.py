@@ -1,7 +1,10 @@
+from plato.interfaces.decorators import symbolic_updater
 from plato.tools.optimization.demo_compare_optimizers import get_experiments
 from plato.tools.optimization.optimizers import GradientDescent, Adam, AdaMax
 from plato.tools.regressors.online_regressor import OnlineRegressor
 from utils.predictors.predictor_tests import assert_online_predictor_not_broken
+import numpy as np
+import theano
 
 
 def _test_optimizer_on_simple_classification_problem(optimizer):
@@ -32,10 +35,38 @@ def test_adamax_optimizer():
     _test_optimizer_on_simple_classification_problem(AdaMax(alpha=0.01))
 
 
+def test_optimizer_state_is_shared_between_signatures():
+    """
+    Each input signature compiles its own variant of a function.  The variants must all update the same optimizer state
+    (here Adam's moments and step count), so that alternating between signatures trains exactly as one signature does.
+    """
+
+    def train_on(data):
+        w = theano.shared(np.zeros(3), name = 'w')
+        optimizer = Adam(alpha = 0.1)
+
+        @symbolic_updater
+        def train(x):
+            optimizer(cost = ((x-w)**2).sum(), parameters = [w])
+
+        f = train.compile()
+        for x in data:
+            f(x)
+        return w.get_value(), f.get_dispatch_stats()['n_variants']
+
+    data = [np.random.RandomState(i).randint(-5, 5, size = 3) for i in xrange(6)]
+    w_one_signature, n_variants = train_on([x.astype(float) for x in data])
+    assert n_variants == 1
+    w_two_signatures, n_variants = train_on([x.astype(float) if i % 2 == 0 else x for i, x in enumerate(data)])
+    assert n_variants == 2
+    assert np.allclose(w_one_signature, w_two_signatures)
+
+
 if __name__ == '__main__':
     test_gradient_descent_optimizer()
     test_adam_optimizer()
     test_adamax_optimizer()
+    test_optimizer_state_is_shared_between_signatures()
 
 
 def test_demo_compare_optimizers():
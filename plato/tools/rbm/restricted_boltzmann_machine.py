@@ -29,7 +29,7 @@ def simple_rbm(visible_layer, bridge, hidden_layer):
 
             wake_hidden = propup(wake_visible)
 
-            persistent_state = sleep_hidden = theano.shared(np.zeros(wake_hidden.tag.test_value.shape, dtype = theano.config.floatX),
+            persistent_state = sleep_hidden = theano.shared(np.zeros(wake_hidden.ishape, dtype = theano.config.floatX),
                 name = 'persistend_hidden_state') if persistent else wake_hidden
 
             for _ in xrange(n_gibbs):
@@ -32,15 +32,15 @@ class OnlineRegressor(ISymbolicPredictor, IParameterized):
     @symbolic_simple
     def predict(self, x):
         """
-        :param x: An (n_samples, input_size) array of inputs
+        :param x: An (n_samples, input_size) array (or sparse matrix) of inputs
         :return: An (n_samples, output_sze) array of output class probabilities
         """
-        return self.activation(x.dot(self.w)+self.b)
+        return self.activation(theano.dot(x, self.w)+self.b)
 
     @symbolic_updater
     def train(self, x, targets):
         """
-        :param x: An (n_samples, input_size) array of inputs
+        :param x: An (n_samples, input_size) array (or sparse matrix) of inputs
         :param targets: If this is a multinomial regressor, we expect an (n_samples, ) array of integer targets
             Otherwise (for logistic and linear), it's a (n_samples, output_size) array.
         :return: A list of parameter updates
@@ -37,9 +37,9 @@ class GibbsRegressor(ISymbolicPredictor):
         """
         Compute the probability the weights at index alpha taking on each of the values in possible_ws
         """
-        assert x.tag.test_value.ndim == y.tag.test_value.ndim == 2
-        assert x.tag.test_value.shape[0] == y.tag.test_value.shape[0]
-        assert w.get_value().shape[1] == y.tag.test_value.shape[1]
+        assert x.indim == y.indim == 2
+        assert x.ishape[0] == y.ishape[0]
+        assert w.get_value().shape[1] == y.ishape[1]
         v_current = x.dot(w)  # (n_samples, n_dim_out)
         v_0 = v_current[None, :, :] - w[alpha, None, :]*x.T[alpha, :, None]  # (n_alpha, n_samples, n_dim_out)
         possible_vs = v_0[:, :, :, None] + possible_ws[None, None, None, :]*x.T[alpha, :, None, None]  # (n_alpha, n_samples, n_dim_out, n_possible_ws)
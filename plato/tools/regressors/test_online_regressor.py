@@ -1,7 +1,11 @@
+from plato.tools.common.training import assess_online_symbolic_predictor
 from plato.tools.optimization.optimizers import GradientDescent
 from plato.tools.regressors.demo_mnist_regression import demo_mnist_online_regression
 from plato.tools.regressors.online_regressor import OnlineRegressor
+from scipy.sparse import csr_matrix
+from utils.datasets.synthetic_clusters import get_synthetic_clusters_dataset
 from utils.predictors.predictor_tests import assert_online_predictor_not_broken
+import numpy as np
 
 __author__ = 'peter'
 
@@ -48,5 +52,40 @@ def test_online_regressors():
         )
 
 
+def test_sparse_online_regressor():
+    """
+    Sparse inputs should give the same results as the equivalent dense inputs.
+    """
+    dataset = get_synthetic_clusters_dataset(dtype = 'float32')
+    sparsify = lambda (x, ): (csr_matrix(x*(x>0.5)), )
+    sparse_dataset = dataset.process_with(inputs_processor = sparsify)
+    dense_dataset = sparse_dataset.process_with(inputs_processor = lambda (x, ): (x.toarray(), ))
+    assert isinstance(sparse_dataset.training_set.input, csr_matrix)
+
+    weights = []
+    for d in (dense_dataset, sparse_dataset):
+        predictor = OnlineRegressor(input_size = d.input_size, output_size = d.n_categories,
+            optimizer = GradientDescent(eta = 0.1), regressor_type = 'multinomial')
+        train_fcn = predictor.train.compile()
+        for _, x, y in d.training_set.minibatch_iterator(minibatch_size = 30, epochs = 1.5, single_channel = True):
+            train_fcn(x, y)
+        weights.append(predictor.w.get_value())
+    assert np.allclose(weights[0], weights[1], atol = 1e-5)
+    assert not np.allclose(weights[0], 0)
+
+    # With the data uploaded as a sparse shared variable
+    predictor = OnlineRegressor(input_size = sparse_dataset.input_size, output_size = sparse_dataset.n_categories,
+        optimizer = GradientDescent(eta = 0.1), regressor_type = 'multinomial')
+    record = assess_online_symbolic_predictor(predictor = predictor, dataset = sparse_dataset,
+        evaluation_function = 'percent_argmax_correct', test_epochs = [0, 2], minibatch_size = 20, add_test_values = False)
+    assert record.get_scores('Test')[-1] > record.get_scores('Test')[0]
+
+
 def test_demo_mnist_regression():
-    demo_mnist_online_regression()
\ No newline at end of file
+    demo_mnist_online_regression()
+
+
+if __name__ == '__main__':
+    test_online_regressors()
+    test_sparse_online_regressor()
+    test_demo_mnist_regression()
@@ -280,7 +280,7 @@ class MultipleBernoulliDistribution(IDistribution):
         self.means = means
 
     def sample(self, n, rng):
-        shape = self.means.tag.test_value.shape
+        shape = self.means.ishape
         return self.means > rng.uniform(size = (n, )+shape)
 
     def log_prob(self, x):
@@ -0,0 +1,193 @@
+from collections import deque, OrderedDict
+import logging
+import threading
+import time
+
+__author__ = 'peter'
+
+"""
+A sink for the callbacks of tdb traces (see tdb_trace, tdbprint, and tdbplot), which keeps them from stalling the loop
+that calls the traced function.
+
+Normally, trace callbacks are run at the end of every call to a compiled function, so printing and plotting stall
+whatever loop is calling it.  When a TraceSink is set, the compiled function just hands the traced arrays over to the
+sink, which runs the callbacks only every so often.  Usage:
+
+    set_trace_sink(TraceSink(capacity = 16, min_interval = 0.5))  # Run callbacks at most every 0.5s
+    get_trace_sink().set_sample_period('mean_abs_relu4_2', 100)  # Only print this one every 100 calls
+
+The handed-over values go into a ring buffer.  If the buffer is full, the oldest values are dropped.  By default, the
+callbacks are run on the thread that calls the compiled function, because plotting (matplotlib) is not thread-safe.
+With background = True, they are run on a worker thread instead, so the calling thread never waits - only use this
+if the callbacks are thread-safe (e.g. printing).  Within a callback, get_tdb_traces() returns the values that were
+handed over with it.
+
+Trace callbacks are only run if traces are enabled (see plato.core.set_enable_traces).
+"""
+
+PLATO_LOGGER = logging.getLogger('plato')
+
+
+class TraceSink(object):
+
+    def __init__(self, capacity = 16, sample_period = 1, min_interval = 0., background = False):
+        """
+        :param capacity: Maximum number of calls' worth of trace values to buffer.  When full, the oldest are dropped.
+        :param sample_period: Default sampling period: the callbacks of each trace are run on every Nth call.  This can
+            be overridden for individual traces with set_sample_period.
+        :param min_interval: When running callbacks on the calling thread, run the buffered callbacks at most once every
+            min_interval seconds.
+        :param background: Run the callbacks on a worker thread instead of the calling thread.  Only do this if the
+            callbacks are thread-safe.
+        """
+        self.capacity = capacity
+        self.default_sample_period = sample_period
+        self.min_interval = min_interval
+        self.background = background
+        self._last_run_time = None
+        self.n_submitted = 0
+        self.n_dropped = 0
+        self.n_processed = 0
+        self.n_errors = 0
+        self._sample_periods = {}  # A dict<trace_name: sampling period>
+        self._counts = {}  # A dict<trace_name: number of times this trace has been computed>
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._busy = False
+        self._closed = False
+        self._latest_values = OrderedDict()  # The trace values, as seen from the callbacks
+        if background:
+            self._thread = threading.Thread(target = self._run, name = 'TraceSink')
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._thread = None
+
+    def set_sample_period(self, name, period):
+        """
+        :param name: The name of a trace
+        :param period: Run the callback of this trace on every period'th call.
+        """
+        self._sample_periods[name] = period
+
+    def submit(self, trace_values, callbacks):
+        """
+        Hand over the trace values computed in a call.  This is called from the compiled function.  With background =
+        True it does not wait.  Otherwise, it runs the buffered callbacks if min_interval has passed since they were last
+        run.
+        :param trace_values: A dict<trace_name: array> of the trace values computed in the call.
+        :param callbacks: A dict<trace_name: callback> of the callbacks of the traces.
+        """
+        entry = []
+        for name, callback in callbacks.iteritems():
+            if name not in trace_values:
+                continue
+            count = self._counts.get(name, 0)
+            self._counts[name] = count + 1
+            if count % self._sample_periods.get(name, self.default_sample_period) == 0:
+                entry.append((name, trace_values[name], callback))
+        if len(entry) == 0:
+            return
+        with self._condition:
+            assert not self._closed, 'This TraceSink has been closed.'
+            if len(self._queue) >= self.capacity:
+                self._queue.popleft()
+                self.n_dropped += 1
+            self._queue.append(entry)
+            self.n_submitted += 1
+            self._condition.notify_all()
+        if not self.background and (self._last_run_time is None or time.time() - self._last_run_time >= self.min_interval):
+            self._run_buffered()
+
+    def flush(self):
+        """
+        Run all buffered callbacks (on the calling thread), or with background = True, wait until the worker has run
+        them.
+        """
+        if not self.background:
+            self._run_buffered()
+            return
+        with self._condition:
+            while len(self._queue) > 0 or self._busy:
+                self._condition.wait()
+
+    def close(self):
+        """
+        Run the buffered callbacks, and stop the worker thread (if there is one).
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self.background:
+            self._thread.join()
+        else:
+            self._run_buffered()
+
+    def _run_buffered(self):
+        """
+        Run the buffered callbacks on this thread.
+        """
+        self._last_run_time = time.time()
+        with self._condition:
+            entries = list(self._queue)
+            self._queue.clear()
+        old_trace_values = get_worker_trace_values()
+        _WORKER_STATE.trace_values = self._latest_values
+        try:
+            for entry in entries:
+                self._run_entry(entry)
+        finally:
+            _WORKER_STATE.trace_values = old_trace_values
+
+    def _run(self):
+        _WORKER_STATE.trace_values = self._latest_values
+        while True:
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+                while len(self._queue) == 0 and not self._closed:
+                    self._condition.wait()
+                if len(self._queue) == 0:
+                    return
+                entry = self._queue.popleft()
+                self._busy = True
+            self._run_entry(entry)
+
+    def _run_entry(self, entry):
+        for name, value, _ in entry:
+            self._latest_values[name] = value
+        for name, _, callback in entry:
+            try:
+                callback()
+            except Exception:
+                self.n_errors += 1
+                PLATO_LOGGER.exception('Error in callback of trace "%s"' % (name, ))
+        self.n_processed += 1
+
+
+_WORKER_STATE = threading.local()
+_TRACE_SINK = None
+
+
+def get_worker_trace_values():
+    """
+    :return: If called from within a callback run by a TraceSink, the dict<trace_name: value> of the values most recently
+        handed over to it.  Otherwise None.
+    """
+    return getattr(_WORKER_STATE, 'trace_values', None)
+
+
+def set_trace_sink(sink):
+    """
+    :param sink: A TraceSink that the callbacks of all compiled functions will be sent to, or None to run callbacks
+        synchronously at the end of each call (the default).  Traces must be enabled (see
+        plato.core.set_enable_traces), or the sink would never get anything.
+    """
+    from plato import core  # Imported here, since plato.core imports this module
+    assert sink is None or core.ENABLE_TRACES, "Traces are disabled (see set_enable_traces), so a TraceSink would never run any callbacks."
+    global _TRACE_SINK
+    _TRACE_SINK = sink
+
+
+def get_trace_sink():
+    return _TRACE_SINK
@@ -1,9 +1,13 @@
 import time
 from artemis.general.checkpoint_counter import CheckPointCounter
 from artemis.general.should_be_builtins import bad_value
-from utils.benchmarks.train_and_test import get_evaluation_function
+from utils.benchmarks.train_and_test import get_evaluation_function, get_metric_accumulator
+from utils.datasets.prefetch import PrefetchingMinibatchIterator
 from collections import OrderedDict
-from utils.tools.iteration import checkpoint_minibatch_index_generator
+from contextlib import closing
+from copy import deepcopy
+from multiprocessing import Pool
+from utils.tools.iteration import checkpoint_minibatch_index_generator, map_in_chunks
 from utils.tools.mymath import sqrtspace
 import numpy as np
 from utils.tools.processors import RunningAverage
@@ -11,7 +15,8 @@ from utils.tools.processors import RunningAverage
 
 def compare_predictors(dataset, online_predictors={}, offline_predictors={}, minibatch_size = 'full',
         evaluation_function = 'mse', test_epochs = sqrtspace(0, 1, 10), report_test_scores = True,
-        test_on = 'training+test', test_batch_size = None, accumulators = None, online_test_callbacks = {}):
+        test_on = 'training+test', test_batch_size = None, accumulators = None, online_test_callbacks = {}, n_workers = 1,
+        result_callback = None):
     """
     Compare a set of predictors by running them on a dataset, and return the learning curves for each predictor.
 
@@ -35,14 +40,26 @@ def compare_predictors(dataset, online_predictors={}, offline_predictors={}, min
     :param report_test_scores: Boolean indicating whether you'd like to report results online.
     :param test_on: 'training', 'test', 'training+test'
     :param test_batch_size: When the test set is too large to process in one step, use this to break it
-        up into chunks.
+        up into chunks.  If the evaluation function can be computed incrementally (see get_metric_accumulator), each
+        chunk is scored as it is predicted, so the predictions for the whole set are never held in memory.
     :param accumulators: A dict<str: accum_fcn>, where accum_fcn is a stateful-function of the form:
         accmulated_output = accum_fcn(this_output)
         Special case: accum_fcn can be 'avg' to make a running average.
     :param online_test_callbacks: A dict<str: fcn> where fcn is a callback that takes an online
         predictor as an argument.  Useful for logging/plotting/debugging progress during training.
+    :param n_workers: Number of predictors to run at once, each in its own process.  The dataset is copied into shared
+        memory once, and the worker processes are forked with it (and the predictors) already in place, so nothing but
+        the results is pickled.  Each predictor runs in a fresh process forked from this one, so it sees the same
+        global state (e.g. numpy's random state) whatever order the predictors run in.  Results are reported as
+        they arrive, but are returned in the same order as with n_workers = 1.  Test callbacks must return picklable
+        results.  Note that the predictors are trained in the worker processes, so unlike with n_workers = 1, the
+        predictor objects you pass in are left untrained.
+    :param result_callback: Optionally, a function of the form fcn(predictor_name, record), called with the
+        LearningCurveData of each predictor as soon as it is done (so with n_workers > 1, in the order they finish).
+        Use this to look at (e.g. plot or save) results before the whole comparison is done.
     :return: An OrderedDict<LearningCurveData>
     """
+    assert isinstance(n_workers, int) and n_workers >= 1, 'n_workers must be a positive int.  You gave %s' % (n_workers, )
 
     all_keys = online_predictors.keys()+offline_predictors.keys()
     assert len(all_keys) > 0, 'You have to give at least one predictor.  Is that too much to ask?'
@@ -59,12 +76,10 @@ def compare_predictors(dataset, online_predictors={}, offline_predictors={}, min
     if isinstance(evaluation_function, str):
         evaluation_function = get_evaluation_function(evaluation_function)
 
-    records = OrderedDict()
-
-    # Run the offline predictors
-    for predictor_name, (predictor_type, predictor) in type_constructor_dict.iteritems():
+    def assess_predictor(predictor_name):
+        predictor_type, predictor = type_constructor_dict[predictor_name]
         print '%s\nRunning predictor %s\n%s' % ('='*20, predictor_name, '-'*20)
-        records[predictor_name] = \
+        return \
             assess_offline_predictor(
                 predictor=predictor,
                 dataset = dataset,
@@ -87,11 +102,62 @@ def compare_predictors(dataset, online_predictors={}, offline_predictors={}, min
                 ) if predictor_type == 'online' else \
             bad_value(predictor_type)
 
+    if n_workers > 1:
+        dataset = dataset.to_shared_memory()
+    results = ((predictor_name, assess_predictor(predictor_name)) for predictor_name in type_constructor_dict) if n_workers == 1 else \
+        imap_in_forked_processes(assess_predictor, type_constructor_dict.keys(), n_workers = n_workers)
+    unordered_records = {}
+    with closing(results):
+        for predictor_name, record in results:
+            unordered_records[predictor_name] = record
+            if n_workers > 1:
+                print 'Finished predictor %s (%s of %s)' % (predictor_name, len(unordered_records), len(type_constructor_dict))
+            if result_callback is not None:
+                result_callback(predictor_name, record)
+    records = OrderedDict((predictor_name, unordered_records[predictor_name]) for predictor_name in type_constructor_dict)
+
     print 'Done!'
 
     return records
 
 
+_FORKED_FUNCTION = None  # The function being run by imap_in_forked_processes, inherited by its worker processes
+
+
+def _call_forked_function(arg):
+    return arg, _FORKED_FUNCTION(arg)
+
+
+def imap_in_forked_processes(fcn, args, n_workers):
+    """
+    Call fcn(arg) for each arg, in a pool of worker processes, and yield the results as they are ready.
+
+    Unlike Pool.imap, fcn does not need to be picklable (it can be a closure, and refer to unpicklable things), because
+    the workers are forked with it in place.  Only the args and results are pickled.  Each call gets a freshly forked
+    process, so calls don't affect each other through global state.
+
+    :param fcn: A function of one argument
+    :param args: A list of arguments
+    :param n_workers: Number of processes to run at once
+    :return: A generator of (arg, fcn(arg)) pairs, in the order in which they finish.  If you may stop iterating
+        before the end, close it (e.g. with contextlib.closing), which stops the workers.
+    """
+    global _FORKED_FUNCTION
+    assert _FORKED_FUNCTION is None, "imap_in_forked_processes can't be nested."
+    _FORKED_FUNCTION = fcn
+    try:
+        pool = Pool(processes = min(n_workers, len(args)), maxtasksperchild = 1)
+        try:
+            for arg, result in pool.imap_unordered(_call_forked_function, args):
+                yield arg, result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _FORKED_FUNCTION = None
+
+
 def _pack_into_dict(value_or_dict, expected_keys, allow_subset = False):
     """
     Used for when you want to either
@@ -137,7 +203,7 @@ def assess_offline_predictor(predictor, dataset, evaluation_function, test_on =
     record = LearningCurveData()
     predictor.fit(dataset.training_set.input, dataset.training_set.target)
     testing_sets = dataset_to_testing_sets(dataset, test_on)
-    scores = [(k, evaluation_function(process_in_batches(predictor.predict, x, test_batch_size), y)) for k, (x, y) in testing_sets.iteritems()]
+    scores = [(k, evaluate_in_batches(predictor.predict, x, y, evaluation_function, test_batch_size)) for k, (x, y) in testing_sets.iteritems()]
     record.add(None, scores)
     if report_test_scores:
         print 'Scores: %s' % (scores, )
@@ -145,7 +211,8 @@ def assess_offline_predictor(predictor, dataset, evaluation_function, test_on =
 
 
 def assess_online_predictor(predictor, dataset, evaluation_function, test_epochs, minibatch_size, test_on = 'training+test',
-        accumulator = None, report_test_scores=True, test_batch_size = None, test_callback = None):
+        accumulator = None, report_test_scores=True, test_batch_size = None, test_callback = None, prefetch = 0,
+        checkpointer = None):
     """
     Train an online predictor and return the LearningCurveData.
 
@@ -160,13 +227,22 @@ def assess_online_predictor(predictor, dataset, evaluation_function, test_epochs
     :param report_test_scores: Print out the test scores as they're computed (T/F)
     :param test_callback: A callback which takes the predictor, and is called every time a test
         is done.  This can be useful for plotting/debugging the state.
+    :param prefetch: If > 0, prepare this many training minibatches ahead, on a background thread (see
+        PrefetchingMinibatchIterator), and report how long training waited for data.
+    :param checkpointer: Optionally, a PeriodicCheckpointer (see utils.tools.checkpointing).  The state of the training
+        loop (the predictor's state (see IPredictor.get_state), the position in the training data, and the results so
+        far, and numpy's global random state) is saved on its schedule.  If it already holds a checkpoint, training resumes
+        from there, and continues as it would have without the interruption, provided the predictor's state includes
+        all its random number generators other than numpy's global one.  Not supported with minibatch_size = 'stretch'.
     :return: LearningCurveData containing the score on the test sets
     """
+    assert checkpointer is None or minibatch_size != 'stretch', "Checkpointing doesn't work with minibatch_size = 'stretch'"
 
     record = LearningCurveData()
 
     testing_sets = dataset_to_testing_sets(dataset, test_on)
     if accumulator is None:
+        accumulators = None
         prediction_functions = {k: predictor.predict for k in testing_sets}
     else:
         accum_constructor = {'avg': RunningAverage}[accumulator] \
@@ -179,7 +255,9 @@ def assess_online_predictor(predictor, dataset, evaluation_function, test_epochs
         evaluation_function = get_evaluation_function(evaluation_function)
 
     def do_test(current_epoch):
-        scores = [(k, evaluation_function(process_in_batches(prediction_functions[k], x, test_batch_size), y)) for k, (x, y) in testing_sets.iteritems()]
+        scores = [(k, evaluation_function(process_in_batches(prediction_functions[k], x, test_batch_size), y)) for k, (x, y) in testing_sets.iteritems()] \
+            if accumulator is not None else \
+            [(k, evaluate_in_batches(predictor.predict, x, y, evaluation_function, test_batch_size)) for k, (x, y) in testing_sets.iteritems()]
         if report_test_scores:
             print 'Scores at Epoch %s: %s, after %.2fs' % (current_epoch, ', '.join('%s: %.3f' % (set_name, score) for set_name, score in scores), time.time()-start_time)
         record.add(current_epoch, scores)
@@ -201,8 +279,17 @@ def assess_online_predictor(predictor, dataset, evaluation_function, test_epochs
     else:
         checker = CheckPointCounter(test_epochs)
         last_n_samples_seen = 0
-        for (n_samples_seen, input_minibatch, target_minibatch) in \
-                dataset.training_set.minibatch_iterator(minibatch_size = minibatch_size, epochs = float('inf'), single_channel = True):
+        checkpoint = checkpointer.load() if checkpointer is not None else None
+        if checkpoint is not None:
+            last_n_samples_seen, (predictor_state, record, checker, accumulator_states, random_state) = checkpoint
+            predictor.set_state(predictor_state)
+            np.random.set_state(random_state)
+            if accumulators is not None:
+                accumulators.update(accumulator_states)
+            print 'Resuming from checkpoint at epoch %s' % (float(last_n_samples_seen)/dataset.training_set.n_samples, )
+        iterator = PrefetchingMinibatchIterator(dataset.training_set, minibatch_size = minibatch_size, epochs = float('inf'), single_channel = True, n_prefetch = prefetch, start = last_n_samples_seen) \
+            if prefetch > 0 else dataset.training_set.minibatch_iterator(minibatch_size = minibatch_size, epochs = float('inf'), single_channel = True, start = last_n_samples_seen)
+        for (n_samples_seen, input_minibatch, target_minibatch) in iterator:
             current_epoch = (float(last_n_samples_seen))/dataset.training_set.n_samples
             last_n_samples_seen = n_samples_seen
             time_for_a_test, done = checker.check(current_epoch)
@@ -211,6 +298,14 @@ def assess_online_predictor(predictor, dataset, evaluation_function, test_epochs
             if done:
                 break
             predictor.train(input_minibatch, target_minibatch)
+            if checkpointer is not None and checkpointer.is_due(n_samples_seen):
+                checkpointer.save(n_samples_seen, (predictor.get_state(), deepcopy(record), deepcopy(checker), deepcopy(accumulators), np.random.get_state()))
+        if checkpointer is not None:
+            checkpointer.wait()
+        if prefetch > 0:
+            iterator.close()
+            if report_test_scores:
+                print 'Waited %(wait_time).2fs for data, and spent %(compute_time).2fs training and testing.' % iterator.get_stats()
 
     return record
 
@@ -221,18 +316,30 @@ def process_in_batches(func, data, batch_size):
     """
     if batch_size is None:
         return func(data)
+    return map_in_chunks(func, data, chunk_size=batch_size, pipeline=True)
 
-    n_samples = len(data)
-    chunks = np.arange(int(np.ceil(float(n_samples)/batch_size))+1)*batch_size
-    assert len(chunks)>1
-    out = None
-    for ix_start, ix_end in zip(chunks[:-1], chunks[1:]):
-        x = data[ix_start:ix_end]
-        y = func(x)
-        if out is None:
-            out = np.empty((n_samples, )+y.shape[1:], dtype = y.dtype)
-            out[ix_start:ix_end] = y
-    return out
+
+def evaluate_in_batches(predict, data, target, evaluation_function, batch_size):
+    """
+    Score a predictor's predictions on a data set.  If batch_size is given and the evaluation function can be computed
+    incrementally (see get_metric_accumulator), each batch is scored as it is predicted, and only the running score is
+    kept.  Otherwise, the predictions are collected (see process_in_batches) and scored all at once.
+
+    :param predict: A function that takes a batch of data and returns predictions
+    :param data: An (n_samples, ...) array of inputs
+    :param target: An (n_samples, ...) array of targets
+    :param evaluation_function: A function of the form: score=fcn(actual_values, target_values), or its name
+    :param batch_size: The number of samples to predict at a time, or None to do them all at once.
+    :return: The score
+    """
+    accumulator = get_metric_accumulator(evaluation_function) if batch_size is not None else None
+    if accumulator is None:
+        if isinstance(evaluation_function, str):
+            evaluation_function = get_evaluation_function(evaluation_function)
+        return evaluation_function(process_in_batches(predict, data, batch_size), target)
+    for start in xrange(0, data.shape[0], batch_size):
+        accumulator.add(predict(data[start:start+batch_size]), target[start:start+batch_size])
+    return accumulator.get_score()
 
 
 class LearningCurveData(object):
@@ -267,6 +374,23 @@ class LearningCurveData(object):
             self._times[k].append(time)
             self._scores[k].append(v)
 
+    @staticmethod
+    def from_repetitions(records):
+        """
+        Merge the records of repeated runs of an experiment (e.g. with different seeds) into one record, whose scores
+        have a trailing repetitions axis.  So in the merged record, get_scores gives an (n_tests, n_reps) array for an
+        online predictor, or a (1, n_reps) array for an offline one.
+        :param records: A list of LearningCurveData, which must have been tested at the same times.
+        :return: A LearningCurveData
+        """
+        assert len(records) > 0
+        merged = LearningCurveData()
+        for k in records[0]._scores:
+            assert all(r._times.get(k) == records[0]._times[k] for r in records), 'The records for "%s" were not all tested at the same times.' % (k, )
+            for i, t in enumerate(records[0]._times[k]):
+                merged.add(t, (k, np.array([r._scores[k][i] for r in records])))
+        return merged
+
     def get_results(self):
         """
         :return: (times, results), where:
@@ -0,0 +1,189 @@
+from collections import OrderedDict
+from contextlib import closing
+import ctypes
+from multiprocessing import cpu_count
+import os
+import numpy as np
+from scipy import stats
+from utils.benchmarks.predictor_comparison import LearningCurveData, assess_online_predictor, \
+    assess_offline_predictor, imap_in_forked_processes
+
+__author__ = 'peter'
+
+"""
+Run an experiment several times with different seeds, and combine the learning curves.  Usage:
+
+    record = run_with_seeds(
+        predictor_factory = lambda seed: GradientBasedPredictor(MultiLayerPerceptron.from_init(..., rng = seed), ...).compile(),
+        dataset = dataset,
+        seeds = range(10),
+        evaluation_function = 'percent_argmax_correct',
+        test_epochs = [0, 1, 2, 4],
+        minibatch_size = 20,
+        n_workers = 4
+        )
+    mean, (lower, upper) = get_repetition_statistics(record).get_mean_and_interval('Test')
+
+The repetitions run in parallel worker processes.  Each worker limits its BLAS library to its share of the cores, so
+that N workers each running multithreaded BLAS don't oversubscribe the machine.
+"""
+
+_BLAS_THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+_BLAS_THREAD_SETTERS = ('openblas_set_num_threads', 'MKL_Set_Num_Threads')
+
+
+def run_with_seeds(predictor_factory, dataset, seeds, evaluation_function = 'mse', online = True, n_workers = 1,
+        blas_threads = None, confidence = 0.95, report_progress = True, **assess_kwargs):
+    """
+    Train and test a predictor once for each seed, and merge the results into a single LearningCurveData, with a
+    repetitions axis (see LearningCurveData.from_repetitions).
+
+    :param predictor_factory: A function of the form predictor = predictor_factory(seed).  numpy's global random state
+        is also seeded with the seed while the repetition runs.
+    :param dataset: A DataSet object
+    :param seeds: A list of seeds.  Each defines one repetition.
+    :param evaluation_function: A function of the form: score=fcn(actual_values, target_values), or its name
+    :param online: True if the factory makes online predictors (see assess_online_predictor), False if they're offline
+        (see assess_offline_predictor)
+    :param n_workers: Number of repetitions to run at once, each in its own process (see imap_in_forked_processes).
+    :param blas_threads: Number of BLAS threads for each worker process.  Defaults to an even share of the cores.
+    :param confidence: The confidence level of the intervals printed as repetitions finish.
+    :param report_progress: Print the mean and confidence interval of the final scores as each repetition finishes.
+    :param assess_kwargs: Other arguments to assess_online_predictor/assess_offline_predictor, e.g. test_epochs and
+        minibatch_size.  Test scores for each repetition are not printed unless you pass report_test_scores = True.
+    :return: A LearningCurveData, whose scores have a trailing repetitions axis, in the order of the seeds.
+    """
+    assert len(seeds) > 0 and len(seeds) == len(set(seeds)), 'Seeds must be a non-empty list of unique seeds.  You gave %s' % (seeds, )
+    assert isinstance(n_workers, int) and n_workers >= 1, 'n_workers must be a positive int.  You gave %s' % (n_workers, )
+    if blas_threads is None:
+        blas_threads = max(1, cpu_count() // min(n_workers, len(seeds)))
+    assess_kwargs.setdefault('report_test_scores', False)
+    assess = assess_online_predictor if online else assess_offline_predictor
+
+    def run_repetition(seed):
+        if n_workers > 1:  # Only limit the threads in worker processes, not in the caller's.
+            limit_blas_threads(blas_threads)
+        old_random_state = np.random.get_state()
+        np.random.seed(seed)
+        try:
+            return assess(predictor = predictor_factory(seed), dataset = dataset, evaluation_function = evaluation_function, **assess_kwargs)
+        finally:
+            np.random.set_state(old_random_state)
+
+    if n_workers > 1:
+        dataset = dataset.to_shared_memory()
+    results = ((seed, run_repetition(seed)) for seed in seeds) if n_workers == 1 else \
+        imap_in_forked_processes(run_repetition, seeds, n_workers = n_workers)
+    records = {}
+    statistics = RepetitionStatistics()
+    with closing(results):
+        for seed, record in results:
+            records[seed] = record
+            statistics.add(record)
+            if report_progress:
+                print 'Finished seed %s (%s of %s).  Final scores: %s' % (seed, len(records), len(seeds), ', '.join(
+                    '%s: %.3f (%s%% interval: %.3f to %.3f)' % (k, mean[-1], int(confidence*100), lower[-1], upper[-1])
+                    for k, (mean, (lower, upper)) in ((k, statistics.get_mean_and_interval(k, confidence)) for k in statistics.get_score_names())))
+    return LearningCurveData.from_repetitions([records[seed] for seed in seeds])
+
+
+class RepetitionStatistics(object):
+    """
+    Keeps a running mean and variance of the scores of repeated runs, updated as each run comes in (using Welford's
+    algorithm), so that the confidence intervals can be reported before all runs are done.
+    """
+
+    def __init__(self):
+        self._n = 0
+        self._means = OrderedDict()  # A dict<score_name: array of mean score at each test>
+        self._sum_squared_deviations = OrderedDict()
+
+    def add(self, record):
+        """
+        :param record: The LearningCurveData of one run.  All runs must be tested at the same times.
+        """
+        _, scores = record.get_results()
+        self._n += 1
+        for k, score in scores.iteritems():
+            if score.dtype == object:  # e.g. The results of a test callback
+                continue
+            score = score.astype(float)
+            if k not in self._means:
+                self._means[k] = np.zeros_like(score)
+                self._sum_squared_deviations[k] = np.zeros_like(score)
+            delta = score - self._means[k]
+            self._means[k] += delta / self._n
+            self._sum_squared_deviations[k] += delta * (score - self._means[k])
+
+    @property
+    def n_reps(self):
+        return self._n
+
+    def get_score_names(self):
+        return self._means.keys()
+
+    def get_mean_and_interval(self, score_name, confidence = 0.95):
+        """
+        :param score_name: The name of the score (e.g. 'Test')
+        :param confidence: The confidence level of the interval
+        :return: mean, (lower, upper), where each is an array with one element per test.  These are the mean score
+            and the bounds of the Student-t confidence interval on the mean.  The interval is infinite if there's only
+            been one run.
+        """
+        mean = self._means[score_name]
+        if self._n < 2:
+            return mean.copy(), (np.full_like(mean, -np.inf), np.full_like(mean, np.inf))
+        std_error = np.sqrt(self._sum_squared_deviations[score_name] / (self._n-1) / self._n)
+        half_width = stats.t.ppf((1+confidence)/2., self._n-1) * std_error
+        return mean.copy(), (mean - half_width, mean + half_width)
+
+
+def get_repetition_statistics(record):
+    """
+    :param record: A LearningCurveData with a repetitions axis (see LearningCurveData.from_repetitions)
+    :return: A RepetitionStatistics object containing the repetitions.
+    """
+    times, scores = record.get_results()
+    statistics = RepetitionStatistics()
+    n_reps = scores.values()[0].shape[-1]
+    for i in xrange(n_reps):
+        rep_record = LearningCurveData()
+        for k, score in scores.iteritems():
+            for t, s in zip(times[k], score[..., i]):
+                rep_record.add(t, (k, s))
+        statistics.add(rep_record)
+    return statistics
+
+
+def limit_blas_threads(n_threads):
+    """
+    Limit the number of threads used by BLAS in this process.  BLAS libraries read their thread count from the
+    environment when they are loaded, which has usually already happened (numpy loads one), so we also set it directly
+    on any OpenBLAS or MKL library that's loaded.  This only works on Linux - elsewhere only the environment variables
+    are set, which affects libraries loaded afterwards, and subprocesses.
+
+    :param n_threads: The maximum number of threads
+    :return: The number of loaded BLAS libraries whose thread count was set.
+    """
+    assert isinstance(n_threads, int) and n_threads >= 1
+    for var in _BLAS_THREAD_ENV_VARS:
+        os.environ[var] = str(n_threads)
+    if not os.path.exists('/proc/self/maps'):
+        return 0
+    with open('/proc/self/maps') as f:
+        library_paths = set(line.split()[-1] for line in f if line.rstrip().endswith('.so') or '.so.' in line)
+    n_set = 0
+    for path in sorted(library_paths):
+        if 'blas' not in os.path.basename(path).lower() and 'mkl' not in os.path.basename(path).lower():
+            continue
+        try:
+            library = ctypes.CDLL(path)
+        except OSError:
+            continue
+        for setter_name in _BLAS_THREAD_SETTERS:
+            setter = getattr(library, setter_name, None)
+            if setter is not None:
+                setter(ctypes.c_int(n_threads))
+                n_set += 1
+                break
+    return n_set
@@ -1,11 +1,15 @@
 from sklearn.svm import SVC
-from utils.benchmarks.predictor_comparison import compare_predictors, assess_online_predictor
+from utils.benchmarks.predictor_comparison import compare_predictors, assess_online_predictor, imap_in_forked_processes
 from utils.benchmarks.plot_learning_curves import plot_learning_curves
 from utils.datasets.synthetic_clusters import get_synthetic_clusters_dataset
 from utils.predictors.i_predictor import IPredictor
 from utils.predictors.perceptron import Perceptron
 import numpy as np
+from utils.tools.checkpointing import PeriodicCheckpointer
 from utils.tools.mymath import sqrtspace
+import os
+import pytest
+import tempfile
 
 __author__ = 'peter'
 
@@ -78,6 +82,87 @@ def test_stretch_minibatches():
     assert np.array_equal(p1_trained_out, p2_trained_out)
 
 
+def test_parallel_compare_predictors():
+
+    dataset = get_synthetic_clusters_dataset()
+
+    def get_predictors():
+        rng = np.random.RandomState(45)
+        return dict(
+            offline_predictors = {'SVM': SVC()},
+            online_predictors = {
+                'fast-perceptron': Perceptron(alpha = 0.1, w = .1*rng.randn(dataset.input_shape[0], dataset.n_categories)).to_categorical(),
+                'slow-perceptron': Perceptron(alpha = 0.001, w = .1*rng.randn(dataset.input_shape[0], dataset.n_categories)).to_categorical()
+                }
+            )
+
+    records = {}
+    streamed_records = {}
+    for n_workers in (1, 2):
+        streamed_records[n_workers] = {}
+        records[n_workers] = compare_predictors(dataset = dataset, minibatch_size = 10, test_epochs = sqrtspace(0, 2, 5),
+            evaluation_function='percent_correct', n_workers = n_workers, result_callback = streamed_records[n_workers].__setitem__,
+            **get_predictors())
+
+    assert records[1].keys() == records[2].keys() == ['SVM', 'fast-perceptron', 'slow-perceptron']
+    assert all(streamed_records[n_workers] == dict(records[n_workers]) for n_workers in (1, 2))
+    for name in records[1]:
+        times_1, scores_1 = records[1][name].get_results()
+        times_2, scores_2 = records[2][name].get_results()
+        assert scores_1.keys() == scores_2.keys()
+        assert all(np.array_equal(times_1[k], times_2[k]) and np.array_equal(scores_1[k], scores_2[k]) for k in scores_1)
+
+
+def test_abandoned_imap_in_forked_processes():
+
+    results = imap_in_forked_processes(lambda x: x**2, [1, 2, 3], n_workers = 2)
+    assert next(results) in [(1, 1), (2, 4), (3, 9)]
+    results.close()  # Stop before the end
+    assert sorted(imap_in_forked_processes(lambda x: x**2, [1, 2, 3], n_workers = 2)) == [(1, 1), (2, 4), (3, 9)]
+
+
+class NoisyPerceptron(Perceptron):
+    """
+    A perceptron that trains on noisy inputs, with noise from numpy's global random state.
+    """
+    def train(self, x, target_data):
+        Perceptron.train(self, x + 0.1*np.random.randn(*x.shape), target_data)
+
+
+def test_resume_from_checkpoint():
+
+    dataset = get_synthetic_clusters_dataset()
+    checkpoint_path = os.path.join(tempfile.mkdtemp(), 'checkpoint.pkl')
+
+    class Interruption(Exception):
+        pass
+
+    def interrupt_at_third_test(predictor, n_tests = [0]):
+        n_tests[0] += 1
+        if n_tests[0] == 3:
+            raise Interruption()
+
+    def train(checkpointer = None, test_callback = None):
+        np.random.seed(1234)  # The checkpoint must restore the random state, or the resumed run gets different noise.
+        predictor = NoisyPerceptron(alpha = 0.001, w = .1*np.random.RandomState(45).randn(dataset.input_shape[0], dataset.n_categories)).to_categorical()
+        record = assess_online_predictor(predictor, dataset, evaluation_function = 'percent_correct', test_epochs = [0, 0.5, 1, 2],
+            minibatch_size = 10, checkpointer = checkpointer, test_callback = test_callback)
+        return predictor, record
+
+    uninterrupted_predictor, uninterrupted_record = train()
+    with pytest.raises(Interruption):
+        train(checkpointer = PeriodicCheckpointer(checkpoint_path, every_n_samples = 150), test_callback = interrupt_at_third_test)
+    resumed_predictor, resumed_record = train(checkpointer = PeriodicCheckpointer(checkpoint_path, every_n_samples = 150))
+
+    _, scores = resumed_record.get_results()
+    assert np.array_equal(scores['Test'], uninterrupted_record.get_scores('Test'))
+    assert np.array_equal(resumed_predictor.predict(dataset.test_set.input), uninterrupted_predictor.predict(dataset.test_set.input))
+    assert np.array_equal(resumed_predictor.get_state()[0]['_w'], uninterrupted_predictor.get_state()[0]['_w'])
+
+
 if __name__ == '__main__':
     test_compare_predictors(hang_plot=True)
     test_stretch_minibatches()
+    test_parallel_compare_predictors()
+    test_abandoned_imap_in_forked_processes()
+    test_resume_from_checkpoint()
@@ -0,0 +1,61 @@
+from scipy import stats
+from sklearn.svm import SVC
+from utils.benchmarks.repeated_runs import run_with_seeds, get_repetition_statistics, limit_blas_threads
+from utils.datasets.synthetic_clusters import get_synthetic_clusters_dataset
+from utils.predictors.perceptron import Perceptron
+import numpy as np
+import os
+import pytest
+import subprocess
+import sys
+
+__author__ = 'peter'
+
+
+def test_run_with_seeds():
+
+    dataset = get_synthetic_clusters_dataset()
+    make_perceptron = lambda seed: Perceptron(alpha = 0.001, w = .1*np.random.RandomState(seed).randn(dataset.input_shape[0], dataset.n_categories)).to_categorical()
+    test_epochs = [0, 0.5, 1, 2]
+
+    records = [run_with_seeds(make_perceptron, dataset, seeds = [3, 1, 4, 5], evaluation_function = 'percent_correct',
+        test_epochs = test_epochs, minibatch_size = 10, n_workers = n_workers) for n_workers in (1, 2)]
+
+    for record in records:
+        times, scores = record.get_results()
+        assert list(times['Test']) == test_epochs
+        assert scores['Test'].shape == scores['Training'].shape == (4, 4)
+    assert np.array_equal(records[0].get_scores('Test'), records[1].get_scores('Test'))
+    assert len(np.unique(records[0].get_scores('Test')[0])) > 1  # Different seeds give different initial weights
+
+    test_scores = records[0].get_scores('Test')
+    mean, (lower, upper) = get_repetition_statistics(records[0]).get_mean_and_interval('Test', confidence = 0.9)
+    assert np.allclose(mean, test_scores.mean(axis = 1))
+    assert np.allclose(upper-mean, stats.t.ppf(0.95, 3)*test_scores.std(axis = 1, ddof = 1)/2)
+    assert np.allclose(mean-lower, upper-mean)
+
+    offline_record = run_with_seeds(lambda seed: SVC(random_state = seed), dataset, seeds = [0, 1], evaluation_function = 'percent_correct', online = False)
+    assert offline_record.get_scores('Test').shape == (1, 2)
+
+
+def test_limit_blas_threads():
+    # Run in a fresh process, so that the thread limit and environment variables don't leak into the other tests.
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join([p for p in sys.path if p]))
+    output = subprocess.check_output([sys.executable, '-c',
+        'import os\n'
+        'import numpy\n'
+        'from utils.benchmarks.repeated_runs import limit_blas_threads\n'
+        'maps = open("/proc/self/maps").read() if os.path.exists("/proc/self/maps") else ""\n'
+        'n_blas = len(set(line.split()[-1] for line in maps.split("\\n") if ".so" in line and ("blas" in line.split()[-1].lower() or "mkl" in line.split()[-1].lower())))\n'
+        'print n_blas, limit_blas_threads(1), os.environ["OPENBLAS_NUM_THREADS"]'
+        ], env = env)
+    n_blas_libraries, n_set, env_threads = output.strip().split('\n')[-1].split()
+    assert env_threads == '1'
+    if int(n_blas_libraries) == 0:
+        pytest.skip('No BLAS or MKL library is loaded by numpy, so there are no thread counts to set.')
+    assert int(n_set) >= 1
+
+
+if __name__ == '__main__':
+    test_run_with_seeds()
+    test_limit_blas_threads()
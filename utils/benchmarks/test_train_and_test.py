@@ -0,0 +1,41 @@
+from utils.benchmarks.predictor_comparison import evaluate_in_batches
+from utils.benchmarks.train_and_test import get_evaluation_function, get_metric_accumulator, STREAMING_METRICS
+import numpy as np
+
+__author__ = 'peter'
+
+
+def test_metric_accumulators():
+
+    rng = np.random.RandomState(1234)
+    actual = rng.randn(103, 4)
+    targets = {
+        'mean_squared_error': rng.randn(103, 4),
+        'mean_l1_error': rng.randn(103, 4),
+        'percent_correct': rng.randint(4, size = 103),
+        'percent_argmax_correct': rng.randint(4, size = 103),
+        'percent_argmax_incorrect': rng.randint(4, size = 103),
+        }
+    actual_labels = np.argmax(actual, axis = 1)
+
+    for name in STREAMING_METRICS:
+        act = actual_labels if name == 'percent_correct' else actual
+        target = targets[name]
+        full_score = get_evaluation_function(name)(act, target)
+
+        # Chunks of different sizes, including a single sample, accumulated in two parts and merged
+        first, second = get_metric_accumulator(name), get_metric_accumulator(get_evaluation_function(name))
+        for start, stop in [(0, 1), (1, 40), (40, 50)]:
+            first.add(act[start:stop], target[start:stop])
+        second.add(act[50:], target[50:])
+        assert np.allclose(first.merge(second).get_score(), full_score)
+
+        predict = lambda x: x
+        assert np.allclose(evaluate_in_batches(predict, act, target, name, batch_size = 10), full_score)
+
+    assert get_metric_accumulator('percent_binary_correct') is None
+    assert get_metric_accumulator(lambda actual, target: 0) is None
+
+
+if __name__ == '__main__':
+    test_metric_accumulators()
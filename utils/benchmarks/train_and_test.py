@@ -1,3 +1,4 @@
+from utils.datasets.prefetch import PrefetchingMinibatchIterator
 import numpy as np
 
 __author__ = 'peter'
@@ -11,20 +12,34 @@ Where:
     score is a scalar
     actual is an (n_samples, ...) array
     target is an (n_samples, ....) array
+
+Most of them are means of a per-sample score, so they can also be computed chunk by chunk, without ever holding all
+the predictions in memory (see get_metric_accumulator).
 """
 
 
-def train_online_predictor(predictor, training_set, minibatch_size, n_epochs = 1):
+def train_online_predictor(predictor, training_set, minibatch_size, n_epochs = 1, prefetch = 0):
     """
     Train a predictor on the training set
     :param predictor: An IPredictor object
     :param training_set: A DataCollection object
     :param minibatch_size: An integer, or 'full' for full batch training
     :param n_epochs: Number of passes to make over the training set.
+    :param prefetch: If > 0, prepare this many minibatches ahead, on a background thread (see
+        PrefetchingMinibatchIterator), and report how long training waited for data.
+    :return: If prefetch > 0, a dict of statistics on time spent waiting for data vs training.  Otherwise None.
     """
     print 'Training Predictor %s...' % (predictor, )
-    for (_, data, target) in training_set.minibatch_iterator(minibatch_size = minibatch_size, epochs = n_epochs, single_channel = True):
+    if prefetch > 0:
+        iterator = PrefetchingMinibatchIterator(training_set, minibatch_size = minibatch_size, epochs = n_epochs, single_channel = True, n_prefetch = prefetch)
+    else:
+        iterator = training_set.minibatch_iterator(minibatch_size = minibatch_size, epochs = n_epochs, single_channel = True)
+    for (_, data, target) in iterator:
         predictor.train(data, target)
+    if prefetch > 0:
+        stats = iterator.get_stats()
+        print 'Done.  Waited %(wait_time).2fs for data, and spent %(compute_time).2fs training.' % stats
+        return stats
     print 'Done.'
 
 
@@ -118,3 +133,95 @@ def collapse_onehot_if_necessary(output_data):
     else:
         assert output_data.ndim == 1 and output_data.dtype in (int, 'int32', bool)
         return output_data
+
+
+class MetricAccumulator(object):
+    """
+    Computes an evaluation function incrementally, over chunks of data.  Usage:
+
+        accumulator = get_metric_accumulator('percent_argmax_correct')
+        for x, y in chunks:
+            accumulator.add(predictor.predict(x), y)
+        score = accumulator.get_score()
+
+    The evaluation functions that can be accumulated are means of a per-sample score, so the accumulator only keeps a
+    running sum and count.  Accumulators of the same metric (e.g. from different workers) can be merged.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: The name of the evaluation function (see STREAMING_METRICS)
+        """
+        assert name in STREAMING_METRICS, 'No streaming version of "%s".  Choose from %s' % (name, STREAMING_METRICS.keys())
+        self.name = name
+        self.total = 0.
+        self.count = 0
+
+    def add(self, actual, target):
+        """
+        :param actual: An (n_samples, ...) array of predictions for a chunk of data
+        :param target: The (n_samples, ...) array of targets for the chunk
+        """
+        sample_score_function, _ = STREAMING_METRICS[self.name]
+        scores = sample_score_function(actual, target)
+        self.add_sums(np.sum(scores, dtype = np.float64), scores.size)
+
+    def add_sums(self, total, count):
+        """
+        Add the sum and count of per-sample scores that have been computed elsewhere (e.g. in a symbolic graph).
+        """
+        self.total += float(total)
+        self.count += int(count)
+
+    def merge(self, other):
+        """
+        :param other: Another MetricAccumulator of the same metric
+        :return: A new MetricAccumulator that has accumulated the data of both.
+        """
+        assert other.name == self.name, "Can't merge accumulators of different metrics: %s and %s" % (self.name, other.name)
+        merged = MetricAccumulator(self.name)
+        merged.add_sums(self.total + other.total, self.count + other.count)
+        return merged
+
+    def get_score(self):
+        assert self.count > 0, 'No data has been accumulated'
+        _, scale = STREAMING_METRICS[self.name]
+        return scale * self.total / self.count
+
+
+def get_metric_accumulator(evaluation_function):
+    """
+    :param evaluation_function: The name of an evaluation function, or the function itself
+    :return: A new MetricAccumulator for the function, or None if it can not be computed incrementally.
+    """
+    name = get_streaming_metric_name(evaluation_function)
+    return MetricAccumulator(name) if name is not None else None
+
+
+def get_streaming_metric_name(evaluation_function):
+    """
+    :param evaluation_function: The name of an evaluation function, or the function itself
+    :return: Its name in STREAMING_METRICS, or None if it can not be computed incrementally.
+    """
+    if isinstance(evaluation_function, str):
+        name = {'mse': 'mean_squared_error'}.get(evaluation_function, evaluation_function)
+        return name if name in STREAMING_METRICS else None
+    else:  # Only our own functions - a user-defined function could have the same name.
+        name = getattr(evaluation_function, '__name__', None)
+        return name if name in STREAMING_METRICS and get_evaluation_function(name) is evaluation_function else None
+
+
+def _collapse_onehot_chunk(output_data):
+    """
+    Like collapse_onehot_if_necessary, but never squeezes the sample axis, so it also works on chunks of one sample.
+    """
+    return np.argmax(output_data, axis = 1) if output_data.ndim == 2 and output_data.shape[1] > 1 else output_data.reshape(len(output_data))
+
+
+STREAMING_METRICS = {  # A dict<name: (per-sample score function, scale)>
+    'mean_squared_error': (lambda actual, target: np.sum((actual-target)**2, axis = -1), 1.),
+    'mean_l1_error': (lambda actual, target: np.sum(np.abs(actual-target), axis = -1), 1.),
+    'percent_correct': (lambda actual, target: actual == target, 100.),
+    'percent_argmax_correct': (lambda actual, target: _collapse_onehot_chunk(actual) == _collapse_onehot_chunk(target), 100.),
+    'percent_argmax_incorrect': (lambda actual, target: _collapse_onehot_chunk(actual) != _collapse_onehot_chunk(target), 100.),
+    }
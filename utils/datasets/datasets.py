@@ -1,5 +1,7 @@
 from artemis.general.should_be_builtins import all_equal, bad_value
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
+from scipy.sparse import issparse
 from utils.tools.processors import OneHotEncoding
 
 __author__ = 'peter'
@@ -102,6 +104,14 @@ class DataSet(object):
         encoder = OneHotEncoding(n_categories, form=form)
         return self.process_with(targets_processor=lambda (t, ): (encoder(t), ))
 
+    def to_shared_memory(self):
+        """
+        Copy the data into shared memory, so that processes forked afterwards (e.g. by multiprocessing.Pool) read the
+        same copy rather than each needing their own.  Sparse data is left as is.
+        """
+        to_shared = lambda arrays: tuple(to_shared_array(x) for x in arrays)
+        return self.process_with(inputs_processor=to_shared, targets_processor=to_shared)
+
 
 class DataCollection(object):
 
@@ -155,54 +165,143 @@ class DataCollection(object):
         return DataCollection(new_inputs, new_targets)
 
 
-def minibatch_iterator(minibatch_size = 1, epochs = 1, final_treatment = 'stop', single_channel = False):
+def to_shared_array(array):
     """
-    :param minibatch_size:
-    :param epochs:
-    :param final_treatment:
-    :param single_channel:
-    :return: A function that, when called with a Data Collection, returns an iterator.
+    :param array: A numpy array
+    :return: A copy of the array whose data is in shared memory, or the array itself if it's not a numeric numpy array.
+    """
+    if not isinstance(array, np.ndarray) or array.dtype.hasobject:
+        return array
+    buffer = RawArray('b', max(array.nbytes, 1))
+    shared_array = np.frombuffer(buffer, dtype = array.dtype, count = array.size).reshape(array.shape)
+    shared_array[...] = array
+    return shared_array
+
+
+def minibatch_iterator(minibatch_size = 1, epochs = 1, final_treatment = 'stop', single_channel = False, prefetch = 0,
+        order = 'sequential', block_size = None, seed = None, start = 0):
+    """
+    :param minibatch_size: Number of samples per minibatch, or 'full' for the whole collection.
+    :param epochs: Number of passes through the data (can be fractional, or inf)
+    :param final_treatment: What to do when there is not enough data left for a full minibatch: 'stop' or 'truncate'
+    :param single_channel: If True, yield the minibatches of the (only) input and target as arrays.  Otherwise, yield
+        tuples of minibatches of all the inputs and all the targets.
+    :param prefetch: If > 0, prepare this many minibatches ahead on a background thread, into reused buffers (see
+        utils.datasets.prefetch.PrefetchingMinibatchIterator).
+    :param order: The order in which to visit the samples:
+        'sequential': In order.  Minibatches are views (slices) of the data, except where they wrap around the end.
+        'blocks': Shuffle each epoch, but only at the level of blocks of block_size consecutive samples.  Minibatches
+            that fall within a block are still views, so this is almost as cheap as 'sequential'.
+        'random': Shuffle all the samples each epoch.  Every minibatch is gathered, with fancy indexing, into a new
+            array.  (Gathering into a reused buffer with np.take(..., out=buffer) is slower: with numpy 1.16, 64 rows
+            of 784 float32s take ~9us with fancy indexing and ~30us with np.take.  If you want reused buffers, use
+            prefetch > 0, which gathers into them off the main thread.)
+    :param block_size: The block size for order='blocks'.  Defaults to the minibatch size.  For minibatches to be views,
+        it should be a multiple of the minibatch size.
+    :param seed: Seed (or RandomState) for the shuffling.
+    :param start: The number of samples already seen, to resume an earlier iteration with the same arguments from
+        one of the n_samples_seen it yielded.  The minibatches are the same as that iteration's from there on.
+    :return: A function that, when called with a Data Collection, returns an iterator of 3-tuples of
+        (n_samples_seen, input_data, label_data).  Note that minibatches which are views share memory with the data.
     """
 
     def iterator(data_collection):
         """
         :param data_collection: A DataCollection object
-        :yield: A 2-tuple of (input_data, label_data)
+        :return: An iterator of 3-tuples of (n_samples_seen, input_data, label_data)
         """
         assert isinstance(data_collection, DataCollection)
-        i = 0
-        n_samples = data_collection.n_samples
-        total_samples = epochs * n_samples
-
-        true_minibatch_size = n_samples if minibatch_size == 'full' else \
-            minibatch_size if isinstance(minibatch_size, int) else \
-            bad_value(minibatch_size)
-
-        if single_channel:
-            input_data = data_collection.input
-            target_data = data_collection.target
-        else:
-            input_data = data_collection.inputs
-            target_data = data_collection.targets
-
-        while i < total_samples:
-            next_i = i + true_minibatch_size
-            segment = np.arange(i, next_i) % n_samples
-            if next_i > total_samples:
-                if final_treatment == 'stop':
-                    break
-                elif final_treatment == 'truncate':
-                    next_i = total_samples
-                else:
-                    raise Exception('Unknown final treatment: %s' % final_treatment)
+        segment_kwargs = dict(minibatch_size = minibatch_size, epochs = epochs, final_treatment = final_treatment,
+            order = order, block_size = block_size, seed = seed, start = start)
+        if prefetch > 0:
+            from utils.datasets.prefetch import PrefetchingMinibatchIterator
+            return iter(PrefetchingMinibatchIterator(data_collection, single_channel = single_channel, n_prefetch = prefetch, **segment_kwargs))
+        return _iterate_minibatches(data_collection, segment_kwargs)
+
+    def _iterate_minibatches(data_collection, segment_kwargs):
+        assert not single_channel or (len(data_collection.inputs) == 1 and len(data_collection.targets) == 1), \
+            'single_channel only works for collections with one input and one target'
+        channels = list(data_collection.inputs) + list(data_collection.targets)
+        n_inputs = len(data_collection.inputs)
+        for next_i, segment in minibatch_segments(data_collection, **segment_kwargs):
+            # (Gathering rows with fancy indexing is ~3x faster than np.take into a reused buffer - see order='random')
+            minibatch = [data[segment] for data in channels]
             if single_channel:
-                input_minibatch = input_data[segment]
-                target_minibatch = target_data[segment]
+                yield next_i, minibatch[0], minibatch[1]
             else:
-                input_minibatch, = [d[segment] for d in input_data]
-                target_minibatch, = [d[segment] for d in target_data]
-
-            yield next_i, input_minibatch, target_minibatch
-            i = next_i
+                yield next_i, tuple(minibatch[:n_inputs]), tuple(minibatch[n_inputs:])
 
     return iterator
+
+
+def minibatch_segments(data_collection, minibatch_size = 1, epochs = 1, final_treatment = 'stop', order = 'sequential',
+        block_size = None, seed = None, start = 0):
+    """
+    The indices of the minibatches that minibatch_iterator produces.
+    :param data_collection: A DataCollection object
+    :param minibatch_size, epochs, final_treatment, order, block_size, seed, start: See minibatch_iterator
+    :yield: (n_samples_seen, segment), where segment is a slice when the minibatch is a contiguous range of samples, and
+        an array of indices into the data otherwise.
+    """
+    assert order in ('sequential', 'blocks', 'random'), "order must be 'sequential', 'blocks', or 'random'.  You gave %s" % (order, )
+    i = 0
+    n_samples = data_collection.n_samples
+    total_samples = epochs * n_samples
+
+    true_minibatch_size = n_samples if minibatch_size == 'full' else \
+        minibatch_size if isinstance(minibatch_size, int) else \
+        bad_value(minibatch_size)
+    if block_size is None:
+        block_size = true_minibatch_size
+    rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+    epoch_orders = {}  # A dict<epoch: order of sample indices in that epoch>
+
+    def get_epoch_order(epoch):
+        if epoch not in epoch_orders:
+            for old_epoch in [e for e in epoch_orders if e < epoch-1]:
+                del epoch_orders[old_epoch]
+            if order == 'random':
+                epoch_orders[epoch] = rng.permutation(n_samples)
+            else:
+                # Line the blocks up with the minibatches: the epoch starts with the end of a minibatch that started
+                # in the last epoch, so we start with a short block to fill it up.  The leftover samples at the end
+                # go in another short block.  Only the full blocks in between are shuffled.
+                head = min((-epoch*n_samples) % true_minibatch_size, n_samples)
+                n_blocks = (n_samples - head) // block_size
+                block_starts = head + block_size * rng.permutation(n_blocks)
+                epoch_orders[epoch] = np.concatenate([np.arange(head), (block_starts[:, None] + np.arange(block_size)).ravel(),
+                    np.arange(head + n_blocks*block_size, n_samples)])
+        return epoch_orders[epoch]
+
+    if start > 0:
+        if order != 'sequential':
+            for epoch in xrange(int(start // n_samples)):  # Draw the shuffles of the skipped epochs
+                get_epoch_order(epoch)
+        i = start
+
+    while i < total_samples:
+        next_i = i + true_minibatch_size
+        if next_i > total_samples:
+            if final_treatment == 'stop':
+                break
+            elif final_treatment == 'truncate':
+                next_i = total_samples
+            else:
+                raise Exception('Unknown final treatment: %s' % final_treatment)
+        end = int(np.ceil(next_i))
+        if order == 'sequential':
+            segment = slice(i % n_samples, (end-1) % n_samples + 1) if i//n_samples == (end-1)//n_samples \
+                else np.arange(i, end) % n_samples
+        else:
+            parts = []
+            j = i
+            while j < end:
+                epoch, offset = divmod(j, n_samples)
+                stop = min(offset + end - j, n_samples)
+                parts.append(get_epoch_order(epoch)[offset:stop])
+                j += stop - offset
+            segment = parts[0] if len(parts) == 1 else np.concatenate(parts)
+            if segment[-1] - segment[0] == len(segment) - 1 and np.all(np.diff(segment) == 1):
+                segment = slice(segment[0], segment[-1]+1)
+        yield next_i, segment
+        i = next_i
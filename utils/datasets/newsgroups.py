@@ -1,6 +1,7 @@
 from artemis.fileman.file_getter import get_file
 from artemis.general.should_be_builtins import memoize
 import numpy as np
+from scipy.sparse import csr_matrix
 from utils.datasets.datasets import DataSet
 
 __author__ = 'peter'
@@ -21,7 +22,8 @@ def get_20_newsgroups_dataset(filter_most_common = 2000, numeric = False, shuffl
         (int N, int M): Filter out words that are not between the Nth and Mth most common words.
     :param numeric: Convert everything from words to numbers
     :param shuffling_seed: Random seed for shuffling (you want to shuffle, because everything's sorted by topic)
-    :param bag_of_words: Return count vectors for each word
+    :param bag_of_words: Return count vectors for each word, as sparse (n_samples, n_words) csr_matrices, so that a
+        large vocabulary doesn't mean a large dense matrix.
     :param count_scaling: If using bag_of_words, apply the transformation:
         vector = log(1+word_counts)
         To generate the input data (this scaling makes it more suitable for some types of classifiers).
@@ -63,8 +65,8 @@ def get_20_newsgroups_dataset(filter_most_common = 2000, numeric = False, shuffl
             train_counts = _list_of_ixs_to_count_matrix(train_ixs_list, n_words=len(filtered_vocab))
             test_counts = _list_of_ixs_to_count_matrix(test_ixs_list, n_words=len(filtered_vocab))
             if count_scaling == 'log':
-                train_counts = np.log(1+train_counts)
-                test_counts = np.log(1+test_counts)
+                train_counts = train_counts.log1p()
+                test_counts = test_counts.log1p()
             return DataSet.from_xyxy(training_inputs = train_counts, training_targets = train_labels, test_inputs = test_counts, test_targets = test_labels)
         else:
             return DataSet.from_xyxy(training_inputs = train_ixs_list, training_targets = train_labels, test_inputs = test_ixs_list, test_targets = test_labels)
@@ -123,11 +125,15 @@ def _list_of_posts_to_list_of_ixs(list_of_posts, vocabulary):
 
 
 def _list_of_ixs_to_count_matrix(list_of_ixs, n_words):
+    """
+    :param list_of_ixs: A list of arrays of word indices, one for each sample
+    :param n_words: The number of words in the vocabulary
+    :return: An (n_samples, n_words) csr_matrix of the number of times each word appears in each sample
+    """
     n_samples = len(list_of_ixs)
-    counts = np.zeros((n_samples, n_words), dtype = int)
-    for c, ixs in zip(counts, list_of_ixs):
-        np.add.at(c, ixs, 1)
-    return counts
+    rows = np.repeat(np.arange(n_samples), [len(ixs) for ixs in list_of_ixs])
+    cols = np.concatenate(list_of_ixs) if n_samples > 0 else np.zeros(0, dtype = int)
+    return csr_matrix((np.ones(len(cols), dtype = int), (rows, cols)), shape = (n_samples, n_words))  # Duplicates are summed
 
 
 def _shuffle(arrays, rng):
@@ -0,0 +1,124 @@
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import time
+from scipy.sparse import issparse
+from utils.datasets.datasets import DataCollection, minibatch_segments
+import numpy as np
+
+__author__ = 'peter'
+
+"""
+A minibatch iterator that prepares the next minibatches on background threads while the current one is being used.
+
+Gathering a minibatch (data[indices]) is a copy of the minibatch's worth of data, which for large inputs (e.g. images)
+is a significant part of a training step.  The PrefetchingMinibatchIterator gathers the next n_prefetch minibatches
+ahead of time, into a ring of preallocated buffers, so that no memory is allocated per minibatch.  Usage:
+
+    iterator = PrefetchingMinibatchIterator(dataset.training_set, minibatch_size = 64, epochs = 10, single_channel = True)
+    for n_samples_seen, input_minibatch, target_minibatch in iterator:
+        predictor.train(input_minibatch, target_minibatch)
+    print iterator.get_stats()  # Shows how long training waited for data
+
+Because the buffers are reused, a minibatch is only valid until the next one is requested.  Copy it if you need to keep
+it (predictors that just train on it are fine).
+"""
+
+
+class PrefetchingMinibatchIterator(object):
+
+    def __init__(self, data_collection, minibatch_size = 1, epochs = 1, final_treatment = 'stop', single_channel = False,
+            n_prefetch = 2, n_workers = 1, order = 'sequential', block_size = None, seed = None, start = 0):
+        """
+        :param data_collection: A DataCollection object
+        :param minibatch_size, epochs, final_treatment, single_channel, order, block_size, seed, start: See
+            utils.datasets.datasets.minibatch_iterator.  The same minibatches are produced, in the same order.
+        :param n_prefetch: Number of minibatches to prepare ahead of the one being used.
+        :param n_workers: Number of threads gathering minibatches.
+        """
+        assert isinstance(data_collection, DataCollection)
+        assert n_prefetch >= 1 and n_workers >= 1
+        self._data_collection = data_collection
+        self._segment_kwargs = dict(minibatch_size = minibatch_size, epochs = epochs, final_treatment = final_treatment,
+            order = order, block_size = block_size, seed = seed, start = start)
+        self._single_channel = single_channel
+        self._n_prefetch = n_prefetch
+        self._n_workers = n_workers
+        self._pool = None
+        self.n_minibatches = 0
+        self.wait_time = 0.  # Time spent waiting for minibatches to be ready
+        self.compute_time = 0.  # Time spent by the caller between receiving a minibatch and asking for the next one
+
+    def __iter__(self):
+        channels = list(self._data_collection.inputs) + list(self._data_collection.targets)
+        n_inputs = len(self._data_collection.inputs)
+        # One buffer per channel for each prefetched minibatch, plus the one being used.
+        n_slots = self._n_prefetch + 1
+        buffers = [[None]*len(channels) for _ in xrange(n_slots)]
+        minibatches = [[None]*len(channels) for _ in xrange(n_slots)]
+
+        def gather(slot, segment):
+            """ Fill a slot with the minibatch for a segment.  Runs on a worker thread. """
+            for c, data in enumerate(channels):
+                if issparse(data) or isinstance(segment, slice):
+                    minibatches[slot][c] = data[segment]  # Slices are views, so there's no need to copy.
+                else:
+                    buffers[slot][c] = minibatches[slot][c] = _gather_rows(data, segment, out = buffers[slot][c])
+            return slot
+
+        def submit(k, (n_samples_seen, segment)):
+            slot = k % n_slots  # This slot last held minibatch k-n_slots, which the caller is done with.
+            return n_samples_seen, self._pool.apply_async(gather, (slot, segment))
+
+        segments = minibatch_segments(self._data_collection, **self._segment_kwargs)
+        self._pool = ThreadPool(processes = self._n_workers)
+        try:
+            pending = deque(submit(k, segment) for k, segment in zip(xrange(self._n_prefetch), segments))
+            k = len(pending)  # Index of the next minibatch to submit
+            while len(pending) > 0:
+                start_time = time.time()
+                n_samples_seen, result = pending.popleft()
+                slot = result.get()
+                self.wait_time += time.time() - start_time
+                next_segment = next(segments, None)
+                if next_segment is not None:
+                    # Safe to overwrite: the slot after the last prefetched one is the one the caller just gave back.
+                    pending.append(submit(k, next_segment))
+                    k += 1
+                minibatch = minibatches[slot]
+                inputs, targets = minibatch[:n_inputs], minibatch[n_inputs:]
+                self.n_minibatches += 1
+                start_time = time.time()
+                yield (n_samples_seen, inputs[0], targets[0]) if self._single_channel else \
+                    (n_samples_seen, tuple(inputs), tuple(targets))
+                self.compute_time += time.time() - start_time
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop the worker threads.  This is done automatically when iteration finishes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def get_stats(self):
+        """
+        :return: A dict of statistics on how much time the caller spent waiting for data, versus doing its own work.
+        """
+        total_time = self.wait_time + self.compute_time
+        return dict(n_minibatches = self.n_minibatches, wait_time = self.wait_time, compute_time = self.compute_time,
+            wait_fraction = self.wait_time / total_time if total_time > 0 else 0.)
+
+
+def _gather_rows(data, indices, out = None):
+    """
+    :param data: An (n_samples, ...) array
+    :param indices: An array of row indices
+    :param out: A buffer to write the rows into, or None.  It's only used if it has the right shape and dtype.
+    :return: An (len(indices), ...) array of the selected rows.
+    """
+    if out is None or out.shape != (len(indices), )+data.shape[1:] or out.dtype != data.dtype:
+        out = np.empty((len(indices), )+data.shape[1:], dtype = data.dtype)
+    return np.take(data, indices, axis = 0, out = out, mode = 'clip')  # With mode='raise', np.take copies out again
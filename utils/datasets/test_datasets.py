@@ -0,0 +1,58 @@
+from utils.datasets.datasets import DataCollection, minibatch_iterator
+import numpy as np
+
+__author__ = 'peter'
+
+
+def _collect(iterator):
+    return [(n, tuple(x.copy() for x in inputs), tuple(y.copy() for y in targets)) for n, inputs, targets in iterator]
+
+
+def test_minibatch_iterator_orders():
+
+    rng = np.random.RandomState(1234)
+    x1 = rng.randn(100, 3)
+    x2 = np.arange(100)
+    y = rng.randint(5, size = 100)
+    collection = DataCollection((x1, x2), (y, ))
+
+    # Sequential: Minibatches are views of the data, except where they wrap around.
+    n_views = 0
+    for n, (b1, b2), (by, ) in collection.minibatch_iterator(minibatch_size = 30, epochs = 2):
+        assert np.array_equal(b2, np.arange(n-30, n) % 100)
+        assert np.array_equal(b1, x1[b2]) and np.array_equal(by, y[b2])
+        n_views += np.may_share_memory(b1, x1)
+    assert n_views == 5  # 6 minibatches, one of which wraps around
+
+    for order in ('blocks', 'random'):
+        minibatches = _collect(collection.minibatch_iterator(minibatch_size = 10, epochs = 3, order = order, seed = 5))
+        assert len(minibatches) == 30
+        visited = np.concatenate([b2 for _, (_, b2), _ in minibatches])
+        for epoch in xrange(3):  # Every sample is visited once per epoch, in a different order each time
+            assert np.array_equal(np.sort(visited[epoch*100:(epoch+1)*100]), np.arange(100))
+        assert not np.array_equal(visited[:100], np.arange(100)) and not np.array_equal(visited[:100], visited[100:200])
+        for _, (b1, b2), (by, ) in minibatches:
+            assert np.array_equal(b1, x1[b2]) and np.array_equal(by, y[b2])
+        # Same seed, same order
+        assert np.array_equal(visited, np.concatenate([b2 for _, (_, b2), _ in _collect(collection.minibatch_iterator(minibatch_size = 10, epochs = 3, order = order, seed = 5))]))
+
+    # With blocks of one minibatch, minibatches are views, except the ones that span two epochs.
+    assert all(np.may_share_memory(b1, x1) for _, (b1, _), _ in collection.minibatch_iterator(minibatch_size = 10, epochs = 3, order = 'blocks', seed = 5))
+    assert [np.may_share_memory(b1, x1) for _, (b1, _), _ in collection.minibatch_iterator(minibatch_size = 30, epochs = 3, order = 'blocks', seed = 5)] \
+        == [True, True, True, False, True, True, False, True, True, True]
+
+    # A short final minibatch
+    minibatches = _collect(collection.minibatch_iterator(minibatch_size = 30, epochs = 1, final_treatment = 'truncate', order = 'random'))
+    assert [len(b2) for _, (_, b2), _ in minibatches] == [30, 30, 30, 10]
+
+    # Resuming from a position gives the rest of the same iteration
+    for order in ('sequential', 'blocks', 'random'):
+        kwargs = dict(minibatch_size = 30, epochs = 4, order = order, seed = 5)
+        minibatches = _collect(collection.minibatch_iterator(**kwargs))
+        resumed = _collect(collection.minibatch_iterator(start = minibatches[6][0], **kwargs))
+        assert [n for n, _, _ in resumed] == [n for n, _, _ in minibatches[7:]]
+        assert all(np.array_equal(b2, r2) for (_, (_, b2), _), (_, (_, r2), _) in zip(minibatches[7:], resumed))
+
+
+if __name__ == '__main__':
+    test_minibatch_iterator_orders()
@@ -0,0 +1,18 @@
+from scipy.sparse import csr_matrix
+from utils.datasets.newsgroups import _list_of_ixs_to_count_matrix
+import numpy as np
+
+__author__ = 'peter'
+
+
+def test_count_matrix():
+
+    counts = _list_of_ixs_to_count_matrix([np.array([0, 2, 2]), np.array([], dtype = int), np.array([3, 0])], n_words = 5)
+    assert isinstance(counts, csr_matrix)
+    assert np.array_equal(counts.toarray(), [[1, 0, 2, 0, 0], [0, 0, 0, 0, 0], [1, 0, 0, 1, 0]])
+    assert counts.nnz == 4  # Repeated words are summed, not stored twice
+    assert np.allclose(counts.log1p().toarray(), np.log(1+counts.toarray()))
+
+
+if __name__ == '__main__':
+    test_count_matrix()
@@ -0,0 +1,57 @@
+from itertools import izip
+from scipy.sparse import csr_matrix
+from utils.benchmarks.predictor_comparison import assess_online_predictor
+from utils.datasets.datasets import DataCollection, minibatch_iterator
+from utils.datasets.prefetch import PrefetchingMinibatchIterator
+from utils.datasets.synthetic_clusters import get_synthetic_clusters_dataset
+from utils.predictors.perceptron import Perceptron
+import numpy as np
+
+__author__ = 'peter'
+
+
+def test_prefetching_minibatch_iterator():
+
+    rng = np.random.RandomState(1234)
+    collection = DataCollection(rng.randn(47, 3, 2), rng.randint(5, size = 47))
+
+    expected = [(n, x.copy(), y.copy()) for n, x, y in minibatch_iterator(minibatch_size = 10, epochs = 2.5, single_channel = True, order = 'random', seed = 4)(collection)]
+    for n_prefetch, n_workers in [(1, 1), (3, 2)]:
+        iterator = PrefetchingMinibatchIterator(collection, minibatch_size = 10, epochs = 2.5, single_channel = True,
+            n_prefetch = n_prefetch, n_workers = n_workers, order = 'random', seed = 4)
+        buffer_ids = set()
+        n_minibatches = 0
+        for (n, x, y), (n_exp, x_exp, y_exp) in izip(iterator, expected):  # (zip would hold on to reused buffers)
+            assert n == n_exp and np.array_equal(x, x_exp) and np.array_equal(y, y_exp)
+            buffer_ids.add(id(x))
+            n_minibatches += 1
+        assert n_minibatches == len(expected) == 11
+        assert len(buffer_ids) == n_prefetch + 1  # Buffers are reused (every minibatch is gathered with order='random')
+        stats = iterator.get_stats()
+        assert stats['n_minibatches'] == 11 and 0 <= stats['wait_fraction'] <= 1
+
+    # Same as the regular iterator, with the same minibatches
+    assert all(np.array_equal(a, b) for (_, (a, ), _), (_, b, _) in izip(collection.minibatch_iterator(minibatch_size = 10, epochs = 2.5, prefetch = 2, order = 'random', seed = 4), expected))
+
+    # Multiple channels, and sparse data
+    collection = DataCollection((rng.randn(20, 4), csr_matrix(rng.rand(20, 6) > 0.5)), (rng.randint(5, size = 20), ))
+    for (n, (x1, x2), (y, )) in PrefetchingMinibatchIterator(collection, minibatch_size = 8, epochs = 1.5):
+        segment = np.arange(n-8, n) % 20
+        assert np.array_equal(x1, collection.inputs[0][segment])
+        assert np.array_equal(x2.toarray(), collection.inputs[1][segment].toarray())
+        assert np.array_equal(y, collection.targets[0][segment])
+
+
+def test_prefetch_in_assess_online_predictor():
+
+    dataset = get_synthetic_clusters_dataset()
+    w_constructor = lambda: .1*np.random.RandomState(45).randn(dataset.input_shape[0], dataset.n_categories)
+    records = [assess_online_predictor(Perceptron(alpha = 0.1, w = w_constructor()).to_categorical(), dataset,
+        evaluation_function='percent_correct', test_epochs=[0, 1, 2], minibatch_size=10, prefetch=prefetch) for prefetch in (0, 2)]
+    assert np.array_equal(records[0].get_scores('Test'), records[1].get_scores('Test'))
+    assert records[1].get_scores('Test')[-1] > 95
+
+
+if __name__ == '__main__':
+    test_prefetching_minibatch_iterator()
+    test_prefetch_in_assess_online_predictor()
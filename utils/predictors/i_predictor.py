@@ -1,6 +1,8 @@
 from abc import abstractmethod, ABCMeta
+from copy import deepcopy
 from utils.tools.processors import OneHotEncoding
 import numpy as np
+import sys
 
 __author__ = 'peter'
 
@@ -21,6 +23,60 @@ class IPredictor(object):
         :return: The output given the input data
         """
 
+    def get_state(self):
+        """
+        :return: A snapshot of everything the predictor has learned, which can be pickled, and which later changes to
+            the predictor do not affect.  By default, a copy of its attributes.  Override this for predictors that hold
+            things which can't be copied this way (like compiled functions).  Raises a PredictorStateError if the
+            predictor holds theano shared variables, because their copies would not be the variables that its compiled
+            functions use.
+        """
+        shared_variable = _find_shared_variable(self.__dict__)
+        if shared_variable is not None:
+            raise PredictorStateError("%s holds the theano shared variable %s, so its state can't be copied.  Override "
+                "get_state and set_state to save and load the values of its shared variables (as CompiledSymbolicPredictor "
+                "does)." % (self.__class__.__name__, shared_variable))
+        return deepcopy(self.__dict__)
+
+    def set_state(self, state):
+        """
+        :param state: A state returned by get_state
+        """
+        self.__dict__.update(deepcopy(state))
+
+
+class PredictorStateError(Exception):
+    pass
+
+
+def _find_shared_variable(obj, _seen = None):
+    """
+    :param obj: Any object
+    :return: The first theano shared variable found in the object, its contents, or its attributes, or None if there is
+        none.
+    """
+    theano = sys.modules.get('theano')  # If theano was never imported, there can't be any shared variables.
+    if theano is None:
+        return None
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen or isinstance(obj, (basestring, int, long, float, bool, np.ndarray, np.generic, type(None))):
+        return None
+    _seen.add(id(obj))
+    if isinstance(obj, theano.compile.SharedVariable):
+        return obj
+    if isinstance(obj, dict):
+        children = obj.values()
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = obj
+    else:
+        children = getattr(obj, '__dict__', {}).values()
+    for child in children:
+        shared_variable = _find_shared_variable(child, _seen)
+        if shared_variable is not None:
+            return shared_variable
+    return None
+
 
 class CategoricalPredictor(IPredictor):
     """
@@ -39,6 +95,13 @@ class CategoricalPredictor(IPredictor):
         new_target_data = self._encoder(target_data)
         return self._predictor.train(input_data, new_target_data)
 
+    def get_state(self):
+        return self._predictor.get_state(), deepcopy((self._n_categories, self._encoder))
+
+    def set_state(self, (predictor_state, (n_categories, encoder))):
+        self._predictor.set_state(predictor_state)
+        self._n_categories, self._encoder = deepcopy((n_categories, encoder))
+
     def predict(self, input_data):
         out = self._predictor.predict(input_data)
         if self._argmax_outputs:
@@ -0,0 +1,123 @@
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
+import os
+import time
+
+__author__ = 'peter'
+
+"""
+Periodic checkpoints of a training loop, so that it can resume after a crash.
+
+The loop takes a snapshot of its state in memory (which is quick), and the PeriodicCheckpointer pickles it and writes it
+to disk on a background thread while training continues.  Writes are atomic (the file is written under a temporary
+name and then renamed), so a crash during a write leaves the previous checkpoint in place.  Usage:
+
+    checkpointer = PeriodicCheckpointer('~/checkpoints/my_experiment.pkl', every_n_samples = 100000, every_seconds = 600)
+    checkpoint = checkpointer.load()
+    n_samples_seen, state = checkpoint if checkpoint is not None else (0, initial_state)
+    for ... in training_loop(start = n_samples_seen):
+        ...
+        if checkpointer.is_due(n_samples_seen):
+            checkpointer.save(n_samples_seen, copy_of_state)
+    checkpointer.close()
+
+assess_online_predictor and assess_online_symbolic_predictor take a checkpointer, and do this for you.
+"""
+
+
+class PeriodicCheckpointer(object):
+
+    def __init__(self, path, every_n_samples = None, every_seconds = None):
+        """
+        :param path: The file to save checkpoints to.  Each checkpoint replaces the last one.
+        :param every_n_samples: Save a checkpoint when this many samples have been seen since the last one.
+        :param every_seconds: Save a checkpoint when this much time has passed since the last one.
+        """
+        assert every_n_samples is not None or every_seconds is not None, 'Give a schedule: every_n_samples and/or every_seconds'
+        self.path = os.path.expanduser(path)
+        self._every_n_samples = every_n_samples
+        self._every_seconds = every_seconds
+        self._last_n_samples = 0
+        self._last_time = time.time()
+        self._pool = None
+        self._pending_write = None
+        self.n_saved = 0
+        self.write_time = 0.  # Total time spent pickling and writing, on the background thread.
+
+    def load(self):
+        """
+        :return: The latest checkpoint, as a tuple of (n_samples_seen, state), or None if there isn't one.
+        """
+        self.wait()
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            n_samples_seen, state = pickle.load(f)
+        self._last_n_samples = n_samples_seen
+        self._last_time = time.time()
+        return n_samples_seen, state
+
+    def is_due(self, n_samples_seen):
+        """
+        :param n_samples_seen: The number of samples the loop has trained on
+        :return: True if it's time to save a checkpoint.
+        """
+        return (self._every_n_samples is not None and n_samples_seen - self._last_n_samples >= self._every_n_samples) \
+            or (self._every_seconds is not None and time.time() - self._last_time >= self._every_seconds)
+
+    def save(self, n_samples_seen, state):
+        """
+        Save a checkpoint on the background thread.  If the last one is still being written, wait for it first.
+
+        :param n_samples_seen: The number of samples the loop has trained on
+        :param state: A picklable snapshot of the loop's state.  It must not be modified afterwards, so copy anything
+            the loop will go on changing.
+        """
+        self.wait()
+        self._last_n_samples = n_samples_seen
+        self._last_time = time.time()
+        if self._pool is None:
+            self._pool = ThreadPool(processes = 1)
+        self._pending_write = self._pool.apply_async(self._write, ((n_samples_seen, state), ))
+
+    def _write(self, checkpoint):
+        start_time = time.time()
+        directory = os.path.dirname(self.path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(checkpoint, f, protocol = pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.path)
+        self.n_saved += 1
+        self.write_time += time.time() - start_time
+
+    def wait(self):
+        """
+        Wait until the last checkpoint is written.  Raises any exception that happened while writing it.
+        """
+        if self._pending_write is not None:
+            pending_write, self._pending_write = self._pending_write, None
+            pending_write.get()
+
+    def close(self):
+        """
+        Finish writing, and stop the background thread.
+        """
+        try:
+            self.wait()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def delete(self):
+        """
+        Delete the checkpoint (e.g. once the run it belongs to has finished).
+        """
+        self.wait()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,10 +1,13 @@
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from artemis.general.should_be_builtins import bad_value
+from scipy.sparse import issparse
 import numpy as np
 
 __author__ = 'peter'
 
 
-def minibatch_index_generator(n_samples, minibatch_size, n_epochs = 1, final_treatment = 'stop', slice_when_possible = True):
+def minibatch_index_generator(n_samples, minibatch_size, n_epochs = 1, final_treatment = 'stop', slice_when_possible = True, start = 0):
     """
     Generates the indices for minibatch-iteration.
 
@@ -16,16 +19,17 @@ def minibatch_index_generator(n_samples, minibatch_size, n_epochs = 1, final_tre
         'truncate': Produce a runt-minibatch at the end.
     :param slice_when_possible: Return slices, instead of indices, as long as the indexing does not wrap around.  This
         can be more efficient, since it avoids array copying, but you have to be careful not to modify your source array.
+    :param start: Number of samples to skip.  Use this to resume an iteration after it has yielded start samples.
     :yield: IIndices that you can use to slice arrays for minibatch iteration.
     """
 
     true_minibatch_size = n_samples if minibatch_size == 'full' else \
         minibatch_size if isinstance(minibatch_size, int) else \
         bad_value(minibatch_size)
-    remaining_samples = int(n_epochs * n_samples) if not np.isinf(n_epochs) else np.inf
+    remaining_samples = int(n_epochs * n_samples) - start if not np.isinf(n_epochs) else np.inf
     base_indices = np.arange(minibatch_size)
     standard_indices = (lambda: slice(i, i+minibatch_size)) if slice_when_possible else (lambda: base_indices+i)
-    i = 0
+    i = start % n_samples
     while True:
         next_i = i + true_minibatch_size
         if remaining_samples < minibatch_size:  # Final minibatch case
@@ -94,15 +98,88 @@ def zip_minibatch_iterate(arrays, minibatch_size, n_epochs=1):
 def minibatch_iterate(data, minibatch_size, n_epochs=1):
     """
     Yields minibatches in sequence.
-    :param data: A (n_samples, ...) data array
+    :param data: A (n_samples, ...) data array, or a scipy.sparse matrix
     :param minibatch_size: The number of samples per minibatch
     :param n_epochs: The number of epochs to run for
     :yield: (minibatch_size, ...) data arrays.
     """
+    n_samples = data.shape[0]
     if minibatch_size == 'full':
-        minibatch_size = len(data)
-    end = len(data)*n_epochs
+        minibatch_size = n_samples
+    end = n_samples*n_epochs
     ixs = np.arange(minibatch_size)
     while ixs[0] < end:
-        yield data[ixs % len(data)]
+        yield data[ixs % n_samples]
         ixs+=minibatch_size
+
+
+def map_in_chunks(fcn, data, chunk_size, out = None, pipeline = False):
+    """
+    Run a function over large arrays in chunks (along the first axis), writing the results into an output array.  This
+    is useful when calling the function on the full array at once would take too much memory.
+
+    :param fcn: A function that takes one array per element of data and returns an array, a tuple of arrays, or a dict
+        of arrays, each of which has its first axis aligned with the inputs.
+    :param data: An array, or a tuple of arrays with the same length, to pass to fcn.
+    :param chunk_size: The number of samples to process in each call to fcn.
+    :param out: Optionally, a preallocated output (e.g. a np.memmap), in the same structure (array/tuple/dict) as the
+        output of fcn.  If None, it is allocated after the first chunk is processed.
+    :param pipeline: If True, slice the next chunk and copy the previous result into the output on a background
+        thread, while fcn works on the current chunk.  This helps when the data is a memmap or needs conversion, or
+        when the outputs are large.  fcn itself is always called on the calling thread.
+    :return: The output, in the same structure as the output of fcn.  If the inputs are empty, fcn is called once on
+        them, so the output is empty, but of the right structure, dtype and shape.
+    """
+    inputs = list(data) if isinstance(data, (list, tuple)) else [data]
+    n_samples = inputs[0].shape[0]
+    assert all(x.shape[0] == n_samples for x in inputs), 'All inputs must have the same length.  Lengths are: %s' % ([x.shape[0] for x in inputs], )
+    starts = range(0, n_samples, chunk_size) if n_samples > 0 else [0]
+    output_holder = [out]
+
+    def get_chunk(start):
+        return [x[start:start+chunk_size] if issparse(x) else np.ascontiguousarray(x[start:start+chunk_size]) for x in inputs]
+
+    def write_chunk(start, result):
+        out = output_holder[0]
+        pairs = [(out[k], v) for k, v in result.iteritems()] if isinstance(result, dict) else \
+            zip(out, result) if isinstance(result, (list, tuple)) else \
+            [(out, result)]
+        for dest, src in pairs:
+            dest[start:start+len(src)] = src
+
+    def allocate(result):
+        if isinstance(result, dict):
+            return OrderedDict((k, np.empty((n_samples, )+v.shape[1:], dtype=v.dtype)) for k, v in result.iteritems())
+        elif isinstance(result, (list, tuple)):
+            return type(result)(np.empty((n_samples, )+r.shape[1:], dtype=r.dtype) for r in result)
+        else:
+            return np.empty((n_samples, )+result.shape[1:], dtype=result.dtype)
+
+    if not pipeline:
+        for start in starts:
+            result = fcn(*get_chunk(start))
+            if output_holder[0] is None:
+                output_holder[0] = allocate(result)
+            write_chunk(start, result)
+    else:
+        pool = ThreadPool(processes=2)
+        try:
+            next_chunk = pool.apply_async(get_chunk, (starts[0], )) if len(starts) > 0 else None
+            pending_write = None
+            for i, start in enumerate(starts):
+                chunk = next_chunk.get()
+                if i+1 < len(starts):
+                    next_chunk = pool.apply_async(get_chunk, (starts[i+1], ))
+                result = fcn(*chunk)
+                if pending_write is not None:
+                    pending_write.get()
+                if output_holder[0] is None:
+                    output_holder[0] = allocate(result)
+                pending_write = pool.apply_async(write_chunk, (start, result))
+            if pending_write is not None:
+                pending_write.get()
+        finally:
+            pool.close()
+            pool.join()
+    return output_holder[0]
+
@@ -1,5 +1,5 @@
 import pytest
-from utils.tools.iteration import minibatch_index_generator, checkpoint_minibatch_index_generator
+from utils.tools.iteration import minibatch_index_generator, checkpoint_minibatch_index_generator, map_in_chunks
 
 __author__ = 'peter'
 import numpy as np
@@ -50,6 +50,33 @@ def test_checkpoint_minibatch_generator():
                 raise Exception("Failed to stop iteration")
 
 
+def test_map_in_chunks():
+
+    x = np.random.randn(103, 4)
+    y = np.random.randn(103)
+
+    for pipeline in (False, True):
+        # Single output, allocated automatically
+        out = map_in_chunks(lambda a: a.sum(axis=1), x, chunk_size=10, pipeline=pipeline)
+        assert np.allclose(out, x.sum(axis=1))
+
+        # Multiple inputs and outputs
+        out_sum, out_prod = map_in_chunks(lambda a, b: (a.sum(axis=1)+b, a*b[:, None]), (x, y), chunk_size=25, pipeline=pipeline)
+        assert np.allclose(out_sum, x.sum(axis=1)+y)
+        assert np.allclose(out_prod, x*y[:, None])
+
+        # Preallocated output
+        preallocated = np.zeros(103)
+        out = map_in_chunks(lambda a: {'max': a.max(axis=1)}, x, chunk_size=7, out={'max': preallocated}, pipeline=pipeline)
+        assert out['max'] is preallocated
+        assert np.array_equal(preallocated, x.max(axis=1))
+
+        # Empty inputs give empty outputs
+        out_sum, out_prod = map_in_chunks(lambda a, b: (a.sum(axis=1)+b, a*b[:, None]), (x[:0], y[:0]), chunk_size=25, pipeline=pipeline)
+        assert out_sum.shape == (0, ) and out_prod.shape == (0, 4)
+
+
 if __name__ == '__main__':
     test_minibatch_index_generator()
     test_checkpoint_minibatch_generator()
+    test_map_in_chunks()